@@ -1,17 +1,19 @@
 import logging
 import os
-import re
 import socket
 import tempfile
 import time
 import uuid
 
 import paramiko
+import yaml
 from boto.ec2 import blockdevicemapping, elb
 from boto.ec2.connection import EC2Connection
 from boto.exception import BotoServerError
 from fabric.api import env
 
+from fabulaws.instance_types import ephemeral_devices, get_instance_type
+
 logger = logging.getLogger("fabulaws.ec2")
 
 
@@ -72,20 +74,19 @@ class EC2Instance(object):
     security_groups = []  # Names of the instance's security groups
     key_prefix = ""
     ssh_timeout = 5
-
-    _saved_contexts = []
-
-    instance_storage = {
-        "m1.small": ["/dev/xvdb"],
-        "m3.medium": ["/dev/xvdb"],
-        "m3.large": ["/dev/xvdb"],
-        "m3.xlarge": ["/dev/xvdb", "/dev/xvdc"],
-        "c3.large": ["/dev/xvdb", "/dev/xvdc"],
-    }
-
-    # instances that have EBS optimization by default
-    # (see http://docs.aws.amazon.com/AWSEC2/latest/UserGuide/EBSOptimized.html)
-    ebs_optimized_regex = re.compile(r"^(c4|m4|d2)")
+    # whether to pass the ``cloud_config()`` to new instances as user data,
+    # so that cloud-init can set them up while they boot
+    cloud_init = False
+    # how many times to retry a failed setup step (see ``setup_step()``) on
+    # the same instance, and the delay before the first retry, in seconds
+    setup_step_retries = 0
+    setup_step_retry_delay = 10
+    # Deprecated overrides of the instance type catalog (see
+    # ``instance_type_info``): the Xen device names of the instance store
+    # volumes to map, by instance type, and a regular expression matching the
+    # instance types to launch as EBS-optimized
+    instance_storage = {}
+    ebs_optimized_regex = None
 
     def __init__(
         self,
@@ -109,6 +110,9 @@ class EC2Instance(object):
         # ensure these attributes exist
         self.conn = self.elb_conn = None
         self.key = self.key_file = self.instance = None
+        # Fabric contexts saved by this instance only, so that contexts entered
+        # for other instances (e.g., in other threads) can't be restored here
+        self._saved_contexts = []
         self._terminate = terminate
         self._placement = placement
         self._tags = tags
@@ -175,6 +179,26 @@ class EC2Instance(object):
             raise
         return key, key_file
 
+    def cloud_config(self):
+        """
+        Returns a dictionary of cloud-init configuration for new instances.
+        Extend this method in subclasses (or mixins) to have setup steps that
+        don't need secrets done by cloud-init while the instance boots.
+        """
+        return {}
+
+    def _user_data(self):
+        """
+        Returns the cloud-init user data for new instances, or None if
+        ``cloud_init`` is not enabled.
+        """
+        if not self.cloud_init:
+            return None
+        config = self.cloud_config()
+        if not config:
+            return None
+        return "#cloud-config\n" + yaml.safe_dump(config, default_flow_style=False)
+
     def _create_instances(
         self, instance_id=None, count=1, ami=None, placement=None, wait_ssh=True
     ):
@@ -196,11 +220,25 @@ class EC2Instance(object):
             if image is None:
                 raise ValueError("AMI {0} not found".format(ami))
             key_name = self.key and self.key.name or None
+            info = self.instance_type_info
+            if not info["known"] and self.instance_type not in self.instance_storage:
+                logger.warning(
+                    "Instance type {0} is not in the instance type catalog; "
+                    "not mapping instance store volumes".format(self.instance_type)
+                )
             bdm = blockdevicemapping.BlockDeviceMapping()
-            for i, dev in enumerate(self.instance_storage.get(self.instance_type, [])):
+            for i, dev in enumerate(self.instance_storage_devices()):
                 eph_name = "ephemeral{}".format(i)
                 bdm[dev] = blockdevicemapping.BlockDeviceType(ephemeral_name=eph_name)
-            ebs_optimized = bool(self.ebs_optimized_regex.match(self.instance_type))
+            ebs_optimized = info["ebs_optimized"]
+            if self.ebs_optimized_regex is not None:
+                logger.warning(
+                    "{0}.ebs_optimized_regex is deprecated; add the instance type "
+                    "to the instance type catalog instead".format(
+                        self.__class__.__name__
+                    )
+                )
+                ebs_optimized = bool(self.ebs_optimized_regex.match(self.instance_type))
             if hasattr(env, "subnets"):
                 # We're in a VPC, so provide the 'subnet_id' and 'security_group_ids'.
                 extra_kwargs = {
@@ -221,6 +259,7 @@ class EC2Instance(object):
                 min_count=count,
                 max_count=count,
                 ebs_optimized=ebs_optimized,
+                user_data=self._user_data(),
                 **extra_kwargs
             )
             time.sleep(5)  # wait for AWS to catch up
@@ -313,6 +352,34 @@ class EC2Instance(object):
         for key, value in context.items():
             setattr(env, key, value)
 
+    @property
+    def instance_type_info(self):
+        """
+        Returns the catalog entry for this instance's type (see
+        ``fabulaws.instance_types``).
+        """
+        if self.instance:
+            return get_instance_type(self.instance.instance_type)
+        return get_instance_type(self.instance_type)
+
+    def instance_storage_devices(self):
+        """
+        Returns the Xen device names to map this instance's instance store
+        volumes to: those in the deprecated ``instance_storage`` attribute, if
+        it has an entry for the instance type, or else those in the catalog.
+        """
+        if self.instance:
+            instance_type = self.instance.instance_type
+        else:
+            instance_type = self.instance_type
+        if instance_type in self.instance_storage:
+            logger.warning(
+                "{0}.instance_storage is deprecated; add the instance type to "
+                "the instance type catalog instead".format(self.__class__.__name__)
+            )
+            return list(self.instance_storage[instance_type])
+        return ephemeral_devices(self.instance_type_info)
+
     @property
     def region(self):
         if self._placement:
@@ -336,11 +403,35 @@ class EC2Instance(object):
         if len(self._saved_contexts) > 0:
             raise ValueError(
                 "reset_authentication() can only be called when "
-                "a FabulAWS context is inactive."
+                "this instance's FabulAWS context is inactive."
             )
         self.user = env.user
         self.key_filename = None
 
+    def setup_step(self, func, *args, **kwargs):
+        """
+        Runs ``func``, one idempotent step of ``setup()``, with the given
+        arguments.  If it fails, it's retried up to ``setup_step_retries``
+        times, waiting a little longer before each retry, before the error is
+        raised.
+        """
+        retries = int(self.setup_step_retries or 0)
+        attempt = 1
+        while True:
+            try:
+                return func(*args, **kwargs)
+            # Fabric's abort() raises SystemExit unless env.abort_exception is set
+            except (Exception, SystemExit):
+                if attempt > retries:
+                    raise
+                delay = int(self.setup_step_retry_delay) * attempt
+                logger.exception(
+                    "Setup step {0} failed (attempt {1} of {2}); retrying in {3} "
+                    "seconds".format(func.__name__, attempt, retries + 1, delay)
+                )
+                time.sleep(delay)
+                attempt += 1
+
     def attach_to(self, instance_id):
         """
         Attaches to an existing EC2 instance, identified by instance_id.
@@ -492,6 +583,27 @@ class EC2Instance(object):
         self._terminate = True
         self.cleanup()
 
+    def stop(self):
+        """
+        Stops this instance in EC2, and waits for it to enter the "stopped"
+        state.
+        """
+        logger.info("Stopping instance {0}".format(self.instance.id))
+        self.instance.stop()
+        while self.instance.update() != "stopped":
+            time.sleep(2)
+
+    def start(self):
+        """
+        Starts this (stopped) instance in EC2, and waits for it to enter the
+        "running" state.  Note that its public DNS name and IP address are
+        likely to change.
+        """
+        logger.info("Starting instance {0}".format(self.instance.id))
+        self.instance.start()
+        while self.instance.update() != "running":
+            time.sleep(2)
+
     def add_tags(self, tags):
         """
         Associate specified tags with instance
@@ -0,0 +1,106 @@
+"""
+Catalog of EC2 instance types, used to decide which instance store volumes to
+map (and how they're named on the instance), whether to launch instances as
+EBS-optimized, and where to put swap.
+
+The catalog ships with FabulAWS in ``instance_types.json``.  To add new
+instance types, save the output of ``aws ec2 describe-instance-types`` (in
+each region you use) and merge it into the catalog with::
+
+    python -m fabulaws.instance_types describe-instance-types.json [...]
+"""
+
+import json
+import os
+import string
+import sys
+
+__all__ = ["get_instance_type", "ephemeral_devices", "catalog_from_aws"]
+
+CATALOG_FILE = os.path.join(os.path.dirname(__file__), "instance_types.json")
+
+# assumed for instance types missing from the catalog
+DEFAULT_INSTANCE_TYPE = {
+    "vcpus": None,
+    "memory": None,  # MiB
+    "network": None,
+    "ephemeral_disks": 0,
+    "ephemeral_disk_size": 0,  # GB
+    "ephemeral_type": None,
+    "nvme": False,  # whether instance store volumes are NVMe devices
+    "ebs_optimized": False,  # whether instances are EBS-optimized by default
+}
+
+_catalog = None
+
+
+def _load_catalog():
+    global _catalog
+    if _catalog is None:
+        with open(CATALOG_FILE) as f:
+            _catalog = json.load(f)
+    return _catalog
+
+
+def get_instance_type(name):
+    """
+    Returns a dictionary describing the given instance type (see
+    ``DEFAULT_INSTANCE_TYPE``), with ``known`` set to whether it's in the
+    catalog.
+    """
+    info = dict(DEFAULT_INSTANCE_TYPE)
+    entry = _load_catalog().get(name)
+    if entry:
+        info.update(entry)
+    info["known"] = bool(entry)
+    return info
+
+
+def ephemeral_devices(info):
+    """
+    Returns the device names to map the instance store volumes of the given
+    instance type to, i.e., /dev/xvdb, /dev/xvdc, and so on.  Instance types
+    with NVMe instance store volumes get them automatically, with names like
+    /dev/nvme1n1 that can't be chosen in advance, so no devices are returned.
+    """
+    if info["nvme"]:
+        return []
+    letters = string.ascii_lowercase[1:]
+    return ["/dev/xvd{0}".format(letters[i]) for i in range(info["ephemeral_disks"])]
+
+
+def catalog_from_aws(data):
+    """
+    Converts the output of ``aws ec2 describe-instance-types`` (as parsed from
+    JSON) to catalog entries, keyed by instance type.
+    """
+    catalog = {}
+    for item in data["InstanceTypes"]:
+        storage = item.get("InstanceStorageInfo", {})
+        disks = storage.get("Disks", [])
+        catalog[item["InstanceType"]] = {
+            "vcpus": item["VCpuInfo"]["DefaultVCpus"],
+            "memory": item["MemoryInfo"]["SizeInMiB"],
+            "network": item["NetworkInfo"]["NetworkPerformance"],
+            "ephemeral_disks": sum(disk["Count"] for disk in disks),
+            "ephemeral_disk_size": disks[0]["SizeInGB"] if disks else 0,
+            "ephemeral_type": disks[0]["Type"] if disks else None,
+            "nvme": storage.get("NvmeSupport") == "required",
+            "ebs_optimized": item["EbsInfo"]["EbsOptimizedSupport"] == "default",
+        }
+    return catalog
+
+
+def main(paths):
+    catalog = dict(_load_catalog())
+    for path in paths:
+        with open(path) as f:
+            catalog.update(catalog_from_aws(json.load(f)))
+    with open(CATALOG_FILE, "w") as f:
+        json.dump(catalog, f, indent=1, sort_keys=True)
+        f.write("\n")
+    print("Wrote {0} instance types to {1}".format(len(catalog), CATALOG_FILE))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,12 +1,16 @@
 import datetime
+import hashlib
+import json
 import logging
 import multiprocessing
 import os
 import random
+import re
 import string
 import subprocess
 import sys
 import time
+from contextlib import contextmanager
 from getpass import getpass
 from io import BytesIO
 from runpy import run_path
@@ -14,7 +18,13 @@ from tempfile import mkstemp
 
 import yaml
 from boto.cloudfront import CloudFrontConnection
-from boto.ec2.autoscale import AutoScaleConnection, LaunchConfiguration, Tag
+from boto.ec2.autoscale import (
+    AutoScaleConnection,
+    AutoScalingGroup,
+    LaunchConfiguration,
+    Tag,
+)
+from boto.ec2.connection import EC2Connection
 from boto.ec2.elb import ELBConnection
 from boto.exception import BotoServerError
 from fabric import operations
@@ -23,6 +33,7 @@ from fabric.api import (
     cd,
     env,
     execute,
+    get,
     hide,
     local,
     parallel,
@@ -33,6 +44,7 @@ from fabric.api import (
     run,
     runs_once,
     settings,
+    shell_env,
     sudo,
     task,
 )
@@ -43,7 +55,10 @@ from fabric.main import list_commands
 from fabric.network import disconnect_all
 
 from fabulaws.api import answer_sudo, ec2_instances, sshagent_run
+from fabulaws.ubuntu.packages.base import apt_update
 
+from .dag import Step, run_steps
+from .journal import Journal
 from .servers import (
     CacheInstance,
     CombinedInstance,
@@ -52,6 +67,10 @@ from .servers import (
     WebInstance,
     WorkerInstance,
 )
+from .timeline import estimates as timeline_estimates
+from .timeline import recorded
+from .timeline import report as timeline_report
+from .timeline import set_changeset, span, timed
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -107,16 +126,20 @@ for key in ["ssh_keys", "localsettings_template"]:
     setattr(env, key, new_path)
 
 
-def _get_servers(deployment, environment, role, instance_ids=None):
+def _get_servers(deployment, environment, role, instance_ids=None, any_role=False):
     """
     Queries EC2 and returns the list of FabulAWS server instances for the given
-    deployment, environment, and role.
+    deployment, environment, and role. With ``any_role``, the given instances
+    are returned as servers of ``role`` even if their role tag has changed
+    (e.g., to ``db-replica-OLD``).
     """
     env.filters = {
         "tag:environment": environment,
         "tag:deployment": deployment,
         "tag:role": role,
     }
+    if any_role:
+        del env.filters["tag:role"]
     inst_kwargs = {
         "instance_type": _find(env.instance_types, environment, role),
         "volume_size": _find(env.volume_sizes, environment, role),
@@ -169,6 +192,8 @@ def _setup_env(deployment_tag=None, environment=None, override_servers=None):
         env.environment = environment
     env.root = os.path.join(env.home, "www", env.environment)
     env.log_dir = os.path.join(env.root, "log")
+    # access log with request times, in logstash_fmt (see nginx.conf)
+    env.timing_log = os.path.join(env.log_dir, "timing.log")
     env.code_root = os.path.join(env.root, "code_root")
     env.project_root = os.path.join(env.code_root, env.project)
     env.virtualenv_root = os.path.join(env.root, "env")
@@ -176,6 +201,14 @@ def _setup_env(deployment_tag=None, environment=None, override_servers=None):
     env.static_root = os.path.join(env.root, "static_media")
     env.services = os.path.join(env.home, "services")
     env.nginx_conf = os.path.join(env.services, "nginx", "%s.conf" % env.environment)
+    env.static_manifest_script = os.path.join(env.services, "static_manifest.py")
+    env.warmup_script = os.path.join(env.services, "warmup.py")
+    env.static_inputs_file = os.path.join(env.root, "static-inputs.json")
+    env.static_files_file = os.path.join(env.root, "static-files.json")
+    env.releases_dir = os.path.join(env.root, "releases")
+    # written (on tmpfs, so it disappears on reboot) once a server has booted
+    # and mounted its encrypted drive
+    env.ready_marker = "/run/%s-%s-ready" % (env.project, env.environment)
     env.setdefault("local_settings_py_relative_path", "local_settings.py")
     env.local_settings_py = os.path.join(
         env.project_root, env.local_settings_py_relative_path
@@ -258,6 +291,59 @@ def _setup_env(deployment_tag=None, environment=None, override_servers=None):
     if "use_basic_auth" not in env:
         env.use_basic_auth = {}
     env.setdefault("extra_log_files", {})
+    env.setdefault("update_source_mode", "git")
+    env.setdefault("artifact_relay", False)
+    env.setdefault("release_cache_dir", "fabulaws-releases")
+    env.setdefault("release_keep_paths", [])
+    env.setdefault("skip_unchanged_static", False)
+    env.setdefault("rolling_max_unavailable", 1)
+    env.setdefault("rolling_min_healthy", 0)
+    env.setdefault("ready_timeout", 600)
+    env.setdefault("reuse_images", False)
+    env.setdefault("layered_images", False)
+    env.setdefault("max_parallel_steps", 4)
+    env.setdefault("step_retries", 0)
+    env.setdefault("setup_step_retries", 2)
+    env.setdefault("record_timeline", True)
+    env.setdefault("timeline_db", "fabulaws-timeline.sqlite")
+    env.setdefault("journal_dir", "fabulaws-journals")
+    env.setdefault("canary_window", 0)
+    env.setdefault("blue_green", False)
+    env.setdefault("graceful_reload", False)
+    env.setdefault("graceful_reload_check_port", None)
+    env.setdefault("check_migrations", True)
+    env.setdefault("warmup_urls", [])
+    env.setdefault("warmup_concurrency", 4)
+    env.setdefault("warmup_duration", 30)
+    env.setdefault("canary_max_latency_increase", 0.2)
+    env.setdefault("canary_max_error_rate_increase", 0.01)
+    env.setdefault("canary_min_requests", 100)
+    env.setdefault("base_image_max_age", 30)
+    env.setdefault("cloudfront_invalidation_max_paths", 3000)
+    env.setdefault("cloudfront_invalidation_batch_size", 1000)
+    env.setdefault("cloudfront_invalidation_wait", False)
+    env.setdefault("cloudfront_invalidation_timeout", 1800)
+    env.setdefault("warm_pool", {})
+    env.setdefault("package_cache_role", None)
+    env.setdefault("package_cache_apt_port", 3142)
+    env.setdefault("package_cache_artifact_port", 3143)
+    env.setdefault("package_cache_artifact_valid", "1d")
+    env.setdefault("package_cache_artifact_max_size", "5g")
+    env.setdefault(
+        "package_cache_artifact_hosts",
+        [
+            "bootstrap.pypa.io",
+            "deb.nodesource.com",
+            "download.elasticsearch.org",
+            "s3.amazonaws.com",
+        ],
+    )
+    env.setdefault(
+        "package_cache_https_repos", ["deb.nodesource.com", "download.newrelic.com"]
+    )
+    env.package_cache_server = None
+    if env.package_cache_role and env.servers.get(env.package_cache_role):
+        env.package_cache_server = env.servers[env.package_cache_role][0]
     env.log_files = [
         ("munin", "/var/log/munin/munin-node.log", "%Y/%m/%d-%H:%M:%S"),
         ("postgresql", "/var/log/postgresql/postgresql-*.log", "%Y-%m-%d %H:%M:%S"),
@@ -512,6 +598,61 @@ def run_shell_command(method, use_sudo=False):
 # NEW SERVER SETUP
 
 
+def _package_cache_settings():
+    """
+    Returns the instance settings that point new servers at the package cache
+    (see ``install_package_cache``), if there is one.
+    """
+    server = env.package_cache_server
+    if not server:
+        return {}
+    return {
+        "apt_proxy": "http://%s:%s" % (server.internal_ip, env.package_cache_apt_port),
+        "artifact_cache": "http://%s:%s"
+        % (server.internal_ip, env.package_cache_artifact_port),
+        "artifact_cache_hosts": env.package_cache_artifact_hosts,
+    }
+
+
+def _artifact_url(url):
+    """
+    Returns the URL to download the given HTTPS ``url`` from on the servers,
+    through the package cache's artifact cache if there is one and it serves
+    the URL's host.
+    """
+    artifact_cache = _package_cache_settings().get("artifact_cache")
+    if not artifact_cache or not url.startswith("https://"):
+        return url
+    path = url[len("https://") :]
+    if path.split("/")[0] not in env.package_cache_artifact_hosts:
+        return url
+    return "/".join([artifact_cache, path])
+
+
+def _new_server(role, placement, tags, ami=None, **kwargs):
+    """
+    Returns a FabulAWS server object for a new (not yet created) server with
+    the given role, optionally overriding the configured AMI.
+    """
+    extra_args = kwargs.copy()
+    extra_args.update(env.instance_settings)
+    extra_args.update(_package_cache_settings())
+    extra_args.setdefault("setup_step_retries", env.setup_step_retries)
+    if ami:
+        extra_args["ami"] = ami
+    return env.role_class_map[role](
+        instance_type=_find(env.instance_types, env.environment, role),
+        placement=placement,
+        deploy_user_home=env.home,
+        tags=tags,
+        volume_size=_find(env.volume_sizes, env.environment, role),
+        volume_type=_find(env.volume_types, env.environment, role),
+        deploy_user=env.deploy_user,
+        security_groups=_find(env.security_groups, env.environment, role),
+        **extra_args,
+    )
+
+
 def _new(
     deployment,
     environment,
@@ -519,9 +660,14 @@ def _new(
     avail_zone=None,
     count=1,
     terminate_on_failure=False,
+    warm=False,
+    extra_tags=None,
     **kwargs,
 ):
-    """create new server on AWS using the given deployment, environment, and role"""
+    """
+    create new server on AWS using the given deployment, environment, and role
+    (or, with ``warm``, for the role's warm pool), with any ``extra_tags``
+    """
     if deployment not in env.deployments:
         abort("Choose a valid deployment: %s" % ", ".join(env.deployments))
     if environment not in env.environments:
@@ -542,6 +688,7 @@ def _new(
         + "-PENDING",  # don't add servers to this role until they're fully created (below)
         "Name": _instance_name(role + "-PENDING"),
     }
+    tags.update(extra_tags or {})
     if not avail_zone:
         avail_zone = random.choice(env.avail_zones)
         print('Note: Assigning random availability zone "{0}"'.format(avail_zone))
@@ -552,38 +699,12 @@ def _new(
     if env.instance_settings["fs_encrypt"]:
         password_names.append("luks_passphrase")
     _load_passwords(password_names)
-    servers = []
-    for x in range(count):
-        type_ = _find(env.instance_types, env.environment, role)
-        cls = env.role_class_map[role]
-        vol_size = _find(env.volume_sizes, environment, role)
-        vol_type = _find(env.volume_types, environment, role)
-        sec_grps = _find(env.security_groups, environment, role)
-        extra_args = kwargs.copy()
-        extra_args.update(env.instance_settings)
-        server = cls(
-            instance_type=type_,
-            placement=placement,
-            deploy_user_home=env.home,
-            tags=tags,
-            volume_size=vol_size,
-            volume_type=vol_type,
-            deploy_user=env.deploy_user,
-            security_groups=sec_grps,
-            **extra_args,
+    if count > 1:
+        servers = _setup_many(
+            role, placement, tags, count, terminate_on_failure, kwargs
         )
-        try:
-            server.setup()
-        except:  # noqa: E722
-            logger.exception(
-                "server.setup() failed. tags=%s; terminate_on_failure=%s.",
-                tags,
-                terminate_on_failure,
-            )
-            if terminate_on_failure:
-                server.terminate()
-            raise
-        servers.append(server)
+    else:
+        servers = [_setup_server(role, placement, tags, terminate_on_failure, kwargs)]
     # the methods below should only be run on the created server(s), so
     # replace that role definition accordingly
     saved_roledefs = env.roledefs[role]
@@ -591,17 +712,7 @@ def _new(
     try:
         env.roledefs[role] = [server.hostname for server in servers]
         env.servers[role] = servers
-        executel("update_server_passwords", hosts=env.roledefs[role])
-        executel("install_newrelic_infrastructure_agent", hosts=env.roledefs[role])
-        executel("install_munin", hosts=env.roledefs[role])
-        if env.gelf_log_host:
-            executel("install_logstash", hosts=env.roledefs[role])
-        if env.syslog_server:
-            executel("install_rsyslog", hosts=env.roledefs[role])
-        if env.awslogs_access_key_id:
-            executel("install_awslogs", hosts=env.roledefs[role])
-        if role in ("worker", "web"):
-            executel("bootstrap", hosts=env.roledefs[role])
+        _run_post_setup(role, env.roledefs[role])
     except:  # noqa: E722
         logger.exception(
             "server post-setup failed. tags=%s; terminate_on_failure=%s.",
@@ -617,18 +728,159 @@ def _new(
         env.servers[role] = saved_servers
     # now that the servers have been created, give them the correct role
     for server in servers:
-        _change_role(server, role)
+        _change_role(server, _warm_role(role) if warm else role)
+    return servers
+
+
+def _setup_server(role, placement, tags, terminate_on_failure, kwargs, results=None):
+    """
+    Creates and sets up a new server, terminating it on failure if requested.
+    Returns the server, or puts its instance ID in the ``results`` queue (when
+    run in a child process).
+    """
+    server = _new_server(role, placement, tags, **kwargs)
+    try:
+        server.setup()
+    except:  # noqa: E722
+        logger.exception(
+            "server.setup() failed. tags=%s; terminate_on_failure=%s.",
+            tags,
+            terminate_on_failure,
+        )
+        if terminate_on_failure:
+            server.terminate()
+        raise
+    if results is None:
+        return server
+    # the parent re-attaches to the instance, so remove the temporary key
+    # pair here
+    server.cleanup()
+    results.put(server.instance.id)
+
+
+def _setup_many(role, placement, tags, count, terminate_on_failure, kwargs):
+    """
+    Sets up ``count`` new servers at once, each in its own process (and hence
+    its own Fabric env), at most ``max_parallel_steps`` at a time. Returns
+    the servers, or terminates the ones that were set up (if requested) and
+    aborts if any of them failed.
+    """
+    results = multiprocessing.Queue()
+    steps = [
+        Step(
+            "setup-%s-%s" % (role, x + 1),
+            _setup_server,
+            args=[role, placement, tags, terminate_on_failure, kwargs, results],
+        )
+        for x in range(count)
+    ]
+    instance_ids = []
+    try:
+        run_steps(steps, max_parallel=env.max_parallel_steps)
+    finally:
+        succeeded = [step for step in steps if step.proc and step.proc.exitcode == 0]
+        while len(instance_ids) < len(succeeded):
+            instance_ids.append(results.get())
+        servers = []
+        if instance_ids:
+            servers = _get_servers(
+                env.deployment_tag,
+                env.environment,
+                role,
+                instance_ids=instance_ids,
+                any_role=True,
+            )
+        if len(instance_ids) < count and terminate_on_failure:
+            for server in servers:
+                server.terminate()
     return servers
 
 
+def _task_step(task_name, hosts, deps=None, locks=None, retries=None):
+    """
+    Returns a Step that runs the given task on the given hosts, retrying it
+    ``retries`` times (by default, ``step_retries``).
+    """
+    if retries is None:
+        retries = env.step_retries
+    return Step(
+        task_name,
+        executel,
+        args=[task_name],
+        kwargs={"hosts": hosts},
+        deps=deps,
+        hosts=hosts,
+        locks=locks,
+        retries=retries,
+    )
+
+
+def _run_post_setup(role, hosts):
+    """
+    Installs the monitoring and logging agents (and bootstraps the code, for
+    web servers and workers) on the given new servers. The agent installs
+    all use apt, so they take turns on each host, while the bootstrap runs
+    alongside them.
+    """
+    steps = [
+        _task_step("update_server_passwords", hosts),
+        _task_step(
+            "install_newrelic_infrastructure_agent",
+            hosts,
+            deps=["update_server_passwords"],
+            locks=["apt"],
+        ),
+        _task_step(
+            "install_munin", hosts, deps=["update_server_passwords"], locks=["apt"]
+        ),
+    ]
+    if env.gelf_log_host:
+        steps.append(
+            _task_step(
+                "install_logstash",
+                hosts,
+                deps=["update_server_passwords"],
+                locks=["apt"],
+            )
+        )
+    if env.syslog_server:
+        steps.append(
+            _task_step(
+                "install_rsyslog",
+                hosts,
+                deps=["update_server_passwords"],
+                locks=["apt"],
+            )
+        )
+    if env.awslogs_access_key_id:
+        steps.append(
+            _task_step(
+                "install_awslogs",
+                hosts,
+                deps=["update_server_passwords"],
+                locks=["apt"],
+            )
+        )
+    if role in ("worker", "web"):
+        steps.append(_task_step("bootstrap", hosts, deps=["update_server_passwords"]))
+    # retry failed steps on the same servers before giving up on them
+    for step in steps:
+        step.retries = max(step.retries, int(env.setup_step_retries))
+    run_steps(steps, max_parallel=env.max_parallel_steps)
+
+
 class RetryFailure(Exception):
     """To be used as env.abort_exception in Fabric."""
 
 
+@timed
 def _retry_new(*args, **kwargs):
     """
     Retries instance creation up to three times (or ``tries``, if supplied).
     Helps circumvent temporary network failures (e.g., while running apt-get).
+    Failed setup steps are first retried on the same server (see
+    ``setup_step_retries``), so the server is only terminated and created
+    again once a step has failed that many times.
     """
     tries = kwargs.pop("tries", 3)
     with settings(abort_exception=RetryFailure, abort_on_prompts=True):
@@ -658,13 +910,19 @@ class BackgroundCommand(multiprocessing.Process):
         self.args = args or []
         self.capture_result = capture_result
         self.queue = multiprocessing.Queue()
+        self.started = datetime.datetime.now()
+
+    @property
+    def log_file(self):
+        """The file the command's output is logged to (once it's started)."""
+        date = self.started.strftime("%Y-%m-%d_%H:%M:%S")
+        return "_".join([date] + list(self.args[1:]) + [str(self.pid)]) + ".out"
 
     def run(self):
-        date = datetime.datetime.now().strftime("%Y-%m-%d_%H:%M:%S")
-        filename = "_".join([date] + list(self.args[1:]) + [str(os.getpid())]) + ".out"
+        filename = self.log_file
         print("Starting log file %s" % filename)
-        # redirect stdout to a log file
-        sys.stdout = open(filename, "w")
+        # redirect stdout to a log file, line buffered so the parent can follow it
+        sys.stdout = open(filename, "w", buffering=1)
         sys.stderr = sys.stdout
         # reset logging handler to point to the new stdout
         root_logger = logging.getLogger()
@@ -684,28 +942,280 @@ class BackgroundCommand(multiprocessing.Process):
         return self._result
 
 
+# lines in the background command logs that mark the start of a step: tasks
+# run with executel() and steps run with run_steps()
+LOG_STEP_RE = re.compile(r"\*\*\*\* (\S+) \(|^Starting step (\S+)\.\.\.", re.M)
+
+
+class _LogFollower(object):
+    """Follows a BackgroundCommand's log file, tracking its current step."""
+
+    def __init__(self, proc):
+        self.proc = proc
+        self.offset = 0
+        self.step = "starting"
+        self.last_line = ""
+
+    def update(self):
+        if not os.path.exists(self.proc.log_file):
+            return
+        with open(self.proc.log_file, "rb") as f:
+            f.seek(self.offset)
+            data = f.read()
+        # only consume complete lines
+        data = data[: data.rfind(b"\n") + 1]
+        self.offset += len(data)
+        data = data.decode("utf-8", "replace")
+        for match in LOG_STEP_RE.finditer(data):
+            self.step = (match.group(1) or match.group(2)).lower()
+        lines = [line.strip() for line in data.splitlines() if line.strip()]
+        if lines:
+            self.last_line = lines[-1]
+
+    def tail(self, count=20):
+        """Returns the last ``count`` lines of the log."""
+        if not os.path.exists(self.proc.log_file):
+            return []
+        with open(self.proc.log_file) as f:
+            return f.read().splitlines()[-count:]
+
+
+def _print_progress(followers, redraw=False):
+    """
+    Prints a table of the servers being created, with the elapsed time,
+    current step, and last line of output of each, redrawing the previous
+    table in place if requested (on a terminal).
+    """
+    now = datetime.datetime.now()
+    lines = []
+    for follower in followers:
+        proc = follower.proc
+        if proc.is_alive():
+            status = follower.step
+        else:
+            status = "done" if proc.exitcode == 0 else "FAILED"
+        elapsed = int((now - proc.started).total_seconds())
+        lines.append(
+            "{0:<30.30} {1:>3}m{2:02}s  {3:<30.30} {4:.60}".format(
+                " ".join(proc.args[2:]),
+                elapsed // 60,
+                elapsed % 60,
+                status,
+                follower.last_line,
+            )
+        )
+    if redraw:
+        # move the cursor back up to the start of the previous table
+        sys.stdout.write("\033[%sA" % len(lines))
+    for line in lines:
+        sys.stdout.write("\033[K" + line + "\n" if redraw else line + "\n")
+    sys.stdout.flush()
+
+
 def _create_many(servers):
-    """Create many servers at once, in parallel."""
+    """
+    Create many servers at once, in parallel, showing a table of their
+    progress, and the end of the log of any that failed.
+    """
     procs = []
-    print("Creating servers in parallel; see individual log files for progress...")
+    print("Creating servers in parallel; see individual log files for details...")
     # make sure we don't pass open SSH connections down to the child procs
     disconnect_all()
     for server in servers:
         proc = BackgroundCommand(_retry_new, args=list(server))
         proc.start()
         procs.append(proc)
-    time.sleep(2)
-    print("Waiting for servers to be created...")
-    for proc in procs:
-        proc.join()
-        if proc.exitcode != 0:
-            abort(
-                "Server creation failed for: %s. Inspect the appropriate log file."
-                % proc.args
-            )
+    followers = [_LogFollower(proc) for proc in procs]
+    # redraw the table in place on a terminal; otherwise, print it every so often
+    live = sys.stdout.isatty()
+    printed = False
+    last_print = 0
+    while any(proc.is_alive() for proc in procs):
+        time.sleep(2)
+        for follower in followers:
+            follower.update()
+        if live or time.time() - last_print >= 60:
+            _print_progress(followers, redraw=live and printed)
+            printed = True
+            last_print = time.time()
+    failed = []
+    for follower in followers:
+        follower.proc.join()
+        follower.update()
+        if follower.proc.exitcode != 0:
+            failed.append(follower)
+    _print_progress(followers, redraw=live and printed)
+    for follower in failed:
+        print("")
+        print(
+            "Server creation failed for %s; last lines of %s:"
+            % (follower.proc.args, follower.proc.log_file)
+        )
+        for line in follower.tail():
+            print("    %s" % line)
+    if failed:
+        abort(
+            "Server creation failed for: %s. Inspect the appropriate log file."
+            % ", ".join(str(follower.proc.args) for follower in failed)
+        )
     print("Done.")
 
 
+def _create_missing(journal, step, servers):
+    """
+    Creates the given servers (see _create_many) as a step of the journal.
+    When resuming, servers that were created by the failed run (i.e., that
+    have their final role and weren't there when the journal was started) are
+    re-attached rather than created again.
+    """
+    if journal.done(step):
+        return
+    original = set(i for ids in journal.get("original_servers").values() for i in ids)
+    created = []
+    missing = []
+    for server in servers:
+        deployment, environment, role, zone = server
+        existing = []
+        if journal.resuming:
+            existing = [
+                s
+                for s in _get_servers(deployment, environment, role)
+                if s.instance.id not in original
+                and s.instance.id not in created
+                and s._placement[-1] == zone
+            ]
+        if existing:
+            print("Re-attaching %s server %s." % (role, existing[0].instance.id))
+            created.append(existing[0].instance.id)
+        else:
+            missing.append(server)
+    if missing:
+        _create_many(missing)
+        for deployment, environment, role, zone in missing:
+            created.extend(
+                s.instance.id
+                for s in _get_servers(deployment, environment, role)
+                if s.instance.id not in original and s.instance.id not in created
+            )
+    journal.complete(step, **{step: created})
+
+
+def _original_servers(journal):
+    """
+    Returns a dictionary of the servers in the current environment, by role,
+    as they were when the journal was started (recording them on the first
+    run).
+    """
+    if not journal.resuming:
+        journal.set(
+            "original_servers",
+            dict(
+                (role, [s.instance.id for s in servers])
+                for role, servers in env.servers.items()
+            ),
+        )
+        journal.set(
+            "zones",
+            dict(
+                (role, [s._placement[-1] for s in servers])
+                for role, servers in env.servers.items()
+            ),
+        )
+    servers = {}
+    for role, instance_ids in journal.get("original_servers").items():
+        servers[role] = []
+        if instance_ids:
+            servers[role] = _get_servers(
+                env.deployment_tag,
+                env.environment,
+                role,
+                instance_ids=instance_ids,
+                any_role=True,
+            )
+    return servers
+
+
+def _start_image_server(journal):
+    """
+    Starts creating the server for the new launch config's image in the
+    background, unless the journal shows it was already created. Returns the
+    BackgroundCommand (or None).
+
+    The server is tagged with the journal's ``image_server_tag`` when it's
+    launched, so that when resuming, a server the failed run finished setting
+    up (i.e., no longer ``web-PENDING``) is re-attached, and one it didn't is
+    terminated instead of being left behind.
+    """
+    if journal.get("launch_config") or journal.get("image_server"):
+        return None
+    image_server_tag = journal.get("image_server_tag")
+    if image_server_tag is None:
+        image_server_tag = "%s-%d" % (os.path.basename(journal.path), time.time())
+        journal.set("image_server_tag", image_server_tag)
+    elif journal.resuming:
+        servers = [
+            server
+            for server in _get_servers(
+                env.deployment_tag, env.environment, "web", any_role=True
+            )
+            if server.instance.tags.get("image_server") == image_server_tag
+        ]
+        for server in servers:
+            if server.instance.tags.get("role") == "web" and not journal.get(
+                "image_server"
+            ):
+                print("Re-attaching image server %s." % server.instance.id)
+                journal.set("image_server", server.instance.id)
+            else:
+                print("Terminating unfinished image server %s." % server.instance.id)
+                server.terminate()
+        if journal.get("image_server"):
+            return None
+    print("Starting AMI and launch config creation in the background")
+    # make sure we don't pass open SSH connections down to the child procs
+    disconnect_all()
+    lc_creator = BackgroundCommand(
+        _create_server_for_image,
+        args=[{"image_server": image_server_tag}],
+        capture_result=True,
+    )
+    lc_creator.start()
+    return lc_creator
+
+
+def _finish_launch_config(journal, lc_creator):
+    """
+    Waits for the image server started by _start_image_server (if needed),
+    creates the AMI and launch config from it, and returns the name of the
+    launch config, recording both in the journal.
+    """
+    name = journal.get("launch_config")
+    if name:
+        print("Using launch config %s from the previous run." % name)
+        return name
+    instance_id = journal.get("image_server")
+    if instance_id is None:
+        print("Waiting for launch config creation to complete...")
+        # wait for the launch config to finish creating if needed
+        lc_creator.join()
+        if lc_creator.exitcode != 0:
+            abort("Image server creation failed. Inspect the appropriate log file.")
+        instance_id = lc_creator.result()
+        journal.set("image_server", instance_id)
+    # reload the environment once more, after we know the background image
+    # creation is finished
+    _setup_env(env.deployment_tag, env.environment)
+    server = _get_servers(
+        env.deployment_tag, env.environment, "web", instance_ids=[instance_id]
+    )[0]
+    # shutdown the server and create the AMI & Launch config
+    lc = _create_launch_config(server=server)
+    journal.set("launch_config", lc.name)
+    # clean up the leftover server in EC2
+    server.terminate()
+    return lc.name
+
+
 @task
 def new(deployment, environment, role, avail_zone=None, count=1):
     _new(deployment, environment, role, avail_zone, count)
@@ -782,8 +1292,15 @@ def update_local_fabsecrets():
 def clone_repo():
     """clone a new copy of the code repository"""
 
-    with cd(env.root):
-        vcs("clone", [env.repo, env.code_root])
+    vcs_dir = ".git" if env.vcs_cmd.endswith("git") else ".hg"
+    if exists(os.path.join(env.code_root, vcs_dir)):
+        # e.g., when bootstrap is retried after a later step failed
+        print("%s was already cloned; pulling instead." % env.code_root)
+        with cd(env.code_root):
+            vcs("pull")
+    else:
+        with cd(env.root):
+            vcs("clone", [env.repo, env.code_root])
     with cd(env.code_root):
         vcs("update", [env.branch])
 
@@ -1110,21 +1627,232 @@ def bootstrap(purge=False):
 # CODE DEPLOYMENT
 
 
+# Name of the file in each release tarball that records the changeset it holds
+RELEASE_FILE = ".fabulaws-release"
+
+
+def _git_changeset(changeset=None):
+    """
+    Returns the git revision to deploy: the given changeset (assumed to be a
+    commit hash, not a branch name) or the remote branch for this environment.
+    """
+    if changeset is None:
+        changeset = env.branch
+        if not changeset.startswith("origin/"):
+            changeset = "origin/%s" % changeset
+    return changeset
+
+
+@timed
+def _build_release(changeset=None):
+    """
+    Builds a release tarball of the given changeset (or the latest code on the
+    configured branch) on the worker, with bytecode precompiled by the
+    worker's virtualenv Python. The tarball is only built once per changeset.
+    Returns a (worker, remote path) tuple, or None if there's no worker.
+    """
+    if not env.vcs_cmd.endswith("git"):
+        abort("update_source_mode 'artifact' is only supported with git.")
+    if not env.servers["worker"]:
+        print("No worker found to build a release on; using a git checkout instead.")
+        return None
+    worker = env.servers["worker"][0]
+    with settings(host_string=worker.hostname), cd(env.code_root):
+        sudo("mkdir -p %s" % env.releases_dir, user=env.deploy_user)
+        # serialize fetches in case parallel tasks build releases themselves
+        sshagent_run(
+            "flock %s/.fetch-lock %s fetch" % (env.releases_dir, env.vcs_cmd),
+            user=env.deploy_user,
+        )
+        sha = sudo(
+            "git rev-parse %s" % _git_changeset(changeset), user=env.deploy_user
+        ).strip()
+        release = os.path.join(env.releases_dir, "%s.tar.gz" % sha)
+        build_dir = os.path.join(env.releases_dir, "build-%s" % sha)
+        build = " && ".join(
+            [
+                "rm -rf {build_dir}",
+                "mkdir -p {build_dir}",
+                "git archive {sha} | tar -x -C {build_dir}",
+                "echo {sha} > {build_dir}/{release_file}",
+                "({python} -m compileall -q {build_dir} || true)",
+                "tar -czf {release}.tmp -C {build_dir} .",
+                "mv {release}.tmp {release}",
+                "rm -rf {build_dir}",
+            ]
+        ).format(
+            build_dir=build_dir,
+            sha=sha,
+            release=release,
+            release_file=RELEASE_FILE,
+            python=os.path.join(env.virtualenv_root, "bin", "python"),
+        )
+        # parallel deploys may all ask for the same release at once
+        sudo(
+            "flock {releases_dir}/.lock sh -c 'test -f {release} || ({build})'".format(
+                releases_dir=env.releases_dir, release=release, build=build
+            ),
+            user=env.deploy_user,
+        )
+        with settings(warn_only=True):
+            # keep only the 5 most recent releases
+            sudo(
+                "ls -1t %s/*.tar.gz | tail -n +6 | xargs -r rm -f" % env.releases_dir,
+                user=env.deploy_user,
+            )
+    return worker, release
+
+
+def _cache_release(worker, release):
+    """
+    Downloads the release tarball from the worker to the local cache
+    directory, if it's not there already, and returns its local path.
+    """
+    cache_dir = os.path.abspath(env.release_cache_dir)
+    local_path = os.path.join(cache_dir, os.path.basename(release))
+    if not os.path.exists(local_path):
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        # download to a process-specific file since parallel tasks may also be
+        # downloading the same release
+        tmp_path = "%s.%s" % (local_path, os.getpid())
+        with settings(host_string=worker.hostname):
+            get(release, tmp_path)
+        os.rename(tmp_path, local_path)
+    return local_path
+
+
+def _prepare_release(changeset=None):
+    """
+    Builds the release tarball of the given changeset for ``update_source``
+    (and downloads it to the local cache, unless ``artifact_relay`` is set)
+    once per run. Parallel tasks run in forked processes, so call this before
+    executing them to have every host install the same release without each
+    fetching and building it on the worker. Returns a (worker, remote path)
+    tuple, or None if not in 'artifact' mode or there's no worker.
+    """
+    if env.update_source_mode != "artifact":
+        return None
+    built_releases = env.setdefault("built_releases", {})
+    if changeset not in built_releases:
+        built = _build_release(changeset)
+        if built and env.artifact_relay:
+            _relay_known_hosts(built[0])
+        elif built:
+            _cache_release(*built)
+        built_releases[changeset] = built
+    return built_releases[changeset]
+
+
+@task
+@runs_once
+def build_release(changeset=None):
+    """
+    Builds the release tarball for update_source_mode 'artifact' once, for
+    the tasks that follow, e.g.::
+
+        fab <environment> build_release deploy_web
+    """
+    require("environment", provided_by=env.environments)
+    _prepare_release(changeset)
+
+
+def _relay_known_hosts(worker):
+    """
+    Returns known_hosts lines for the worker's private IP address, with the
+    SSH host keys read from the worker over the deployer's own connection, so
+    that ``artifact_relay`` copies can verify the worker. They're read once
+    per run; call this before executing parallel tasks (as
+    ``_prepare_release`` does).
+    """
+    known_hosts = env.setdefault("relay_known_hosts", {})
+    if worker.hostname not in known_hosts:
+        with settings(host_string=worker.hostname), hide("stdout"):
+            keys = sudo("cat /etc/ssh/ssh_host_*_key.pub")
+        known_hosts[worker.hostname] = "".join(
+            "%s %s\n" % (worker.internal_ip, " ".join(line.split()[:2]))
+            for line in keys.splitlines()
+            if line.strip()
+        )
+    return known_hosts[worker.hostname]
+
+
+def _fetch_release(worker, release):
+    """
+    Copies the release tarball from the worker to the same path on the current
+    host, either directly over the private network (if ``artifact_relay`` is
+    set) or via a local cache on the deployer's machine.
+    """
+    if env.host_string == worker.hostname:
+        return
+    sudo("mkdir -p %s" % env.releases_dir, user=env.deploy_user)
+    if env.artifact_relay:
+        known_hosts = "%s.known_hosts" % release
+        put(
+            BytesIO(_relay_known_hosts(worker).encode("utf-8")),
+            known_hosts,
+            use_sudo=True,
+            mode=0o644,
+        )
+        opts = "-o StrictHostKeyChecking=yes -o UserKnownHostsFile=%s" % known_hosts
+        try:
+            sshagent_run(
+                "scp %s %s@%s:%s %s"
+                % (opts, env.deploy_user, worker.internal_ip, release, release),
+                user=env.deploy_user,
+            )
+        finally:
+            sudo("rm -f %s" % known_hosts)
+        return
+    local_path = _cache_release(worker, release)
+    put(local_path, release, use_sudo=True)
+    sudo("chown %s %s" % (env.deploy_user, release))
+
+
+def _install_release(worker, release):
+    """
+    Unpacks the release tarball built by ``_build_release`` into the code root
+    on the current host, preserving the git metadata, local settings, and the
+    ``release_keep_paths``. Everything else not in the release, such as
+    untracked files generated or copied into the code root, is deleted.
+    """
+    _fetch_release(worker, release)
+    unpack_dir = release[: -len(".tar.gz")]
+    sudo("rm -rf %s" % unpack_dir, user=env.deploy_user)
+    sudo("mkdir -p %s" % unpack_dir, user=env.deploy_user)
+    sudo("tar -xzf %s -C %s" % (release, unpack_dir), user=env.deploy_user)
+    keep = [".git", os.path.relpath(env.local_settings_py, env.code_root)]
+    keep += env.release_keep_paths
+    # run as root, since processes may have left root- or webserver-owned
+    # bytecode behind that needs to be deleted
+    sudo(
+        "rsync -a --delete %s %s/ %s/"
+        % (
+            " ".join("--exclude=/%s" % path.strip("/") for path in keep),
+            unpack_dir,
+            env.code_root,
+        )
+    )
+    sudo("rm -rf %s" % unpack_dir, user=env.deploy_user)
+    if env.host_string != worker.hostname:
+        sudo("rm -f %s" % release, user=env.deploy_user)
+
+
 @task
 @roles("web", "worker")
 def update_source(changeset=None):
     """Checkout the latest code from repo."""
     require("environment", provided_by=env.environments)
+    if env.update_source_mode == "artifact":
+        built = _prepare_release(changeset)
+        if built:
+            _install_release(*built)
+            return
     with cd(env.code_root):
         sudo('find . -name "*.pyc" -delete')
         if env.vcs_cmd.endswith("git"):
             vcs("fetch")
-            # Assumption: if changeset is provided, it's a commit hash, not a branch name
-            if changeset is None:
-                changeset = env.branch
-                if not changeset.startswith("origin/"):
-                    changeset = "origin/%s" % changeset
-            vcs("reset", ["--hard", changeset])
+            vcs("reset", ["--hard", _git_changeset(changeset)])
         else:
             if changeset is None:
                 changeset = env.branch
@@ -1138,6 +1866,9 @@ def current_changeset():
     """Checkout the latest code from repo."""
 
     require("environment", provided_by=env.environments)
+    release_file = os.path.join(env.code_root, RELEASE_FILE)
+    if env.update_source_mode == "artifact" and exists(release_file):
+        return sudo("cat %s" % release_file, user=env.deploy_user).strip()
     with cd(env.code_root):
         return sudo(env.latest_changeset_cmd, user=env.deploy_user).strip()
 
@@ -1149,13 +1880,94 @@ def _call_managepy(cmd, pty=False):
         env.managepy_cmd += " --settings=%s" % env.settings_managepy
     with cd(env.code_root):
         # cd to project_root to ensure local_settings is on the path
-        sudo(
+        return sudo(
             "%(virtualenv_root)s/bin/python " "manage.py %(managepy_cmd)s" % env,
             user=env.webserver_user,
             pty=pty,
         )
 
 
+def _static_manifest(mode="inputs"):
+    """
+    Returns a dictionary describing the static files on the current host, as
+    computed by the static_manifest.py script run through ``manage.py shell``.
+    See that script for the supported modes.
+    """
+    put(
+        os.path.join(env.templates_dir, "static_manifest.py"),
+        env.static_manifest_script,
+        use_sudo=True,
+        mode=0o644,
+    )
+    with hide("stdout"), shell_env(STATIC_MANIFEST_MODE=mode):
+        output = _call_managepy("shell < %s" % env.static_manifest_script)
+    return json.loads(output.splitlines()[-1])
+
+
+def _read_remote_json(path):
+    """Returns the parsed contents of the given JSON file, or None if it's missing."""
+    if not exists(path):
+        return None
+    with hide("stdout"):
+        output = sudo("cat %s" % path)
+    try:
+        return json.loads(output)
+    except ValueError:
+        print("Ignoring invalid JSON in %s" % path)
+        return None
+
+
+def _write_remote_json(path, data):
+    """Saves the given data as JSON to the given path, owned by the deploy user."""
+    put(BytesIO(json.dumps(data).encode("utf-8")), path, use_sudo=True)
+    sudo("chown %(user)s:%(user)s %(path)s" % {"user": env.deploy_user, "path": path})
+
+
+def _static_inputs():
+    """
+    Returns the hash of the static inputs of the code on the current host (see
+    ``_update_static``), or None if they can't be hashed. It's computed once
+    per changeset, normally on the worker, which is deployed before the web
+    servers; their (forked) deploys inherit it rather than each running
+    ``manage.py shell`` to compute it again.
+    """
+    changeset = current_changeset()
+    known = env.setdefault("static_inputs", {})
+    if changeset not in known:
+        known[changeset] = _static_manifest()["inputs"]
+        if known[changeset] is None:
+            print(
+                "Static source files aren't on the local filesystem; not "
+                "skipping collectstatic and compress."
+            )
+    return known[changeset]
+
+
+def _update_static():
+    """
+    Runs collectstatic and compress. If ``skip_unchanged_static`` is enabled,
+    both are skipped when the static inputs (static source files, the
+    templates scanned by ``compress --offline``, and the related settings) are
+    unchanged since the last successful run on this host.
+    """
+    inputs = None
+    if env.skip_unchanged_static:
+        inputs = _static_inputs()
+        previous = _read_remote_json(env.static_inputs_file) or {}
+        if inputs and previous.get("inputs") == inputs:
+            print(
+                "Static inputs unchanged since the last deploy (%s); skipping "
+                "collectstatic and compress." % inputs[:12]
+            )
+            return
+    collectstatic()
+    with settings(warn_only=True):
+        result = _call_managepy("compress")
+    # only record the inputs once both commands have succeeded
+    if inputs and result.succeeded:
+        _write_remote_json(env.static_inputs_file, {"inputs": inputs})
+
+
 @task
 @roles("worker")
 def managepy(cmd):
@@ -1179,22 +1991,128 @@ def migrate():
 @task
 @roles("worker", "web")
 def collectstatic():
-    """Collect static files."""
+    """Collect static files.
+
+    The CloudFront distribution (if any) is only invalidated from the worker,
+    so that the invalidation isn't repeated for every web server.
+    """
 
     require("environment", provided_by=env.environments)
-    _call_managepy("collectstatic --noinput")
     distribution_id = (
         getattr(env, "cloudfront_distribution_ids", {})
         .get(env.deployment_tag, {})
         .get(env.environment, "")
     )
-    if distribution_id:
-        conn = CloudFrontConnection()
+    _call_managepy("collectstatic --noinput")
+    if distribution_id and "worker" in _current_roles():
+        previous = _read_remote_json(env.static_files_file)
+        current = _static_manifest("files")
+        _invalidate_cloudfront(
+            distribution_id, _changed_static_paths(previous, current)
+        )
+        _write_remote_json(env.static_files_file, current)
+
+
+def _changed_static_paths(previous, current):
+    """
+    Returns the sorted URL paths of the static files that were added, changed,
+    or removed between the two ``_static_manifest("files")`` results, or None
+    if there's no usable previous result to compare against.
+    """
+    if not previous or previous.get("prefix") != current["prefix"]:
+        return None
+    if previous.get("files") is None or current["files"] is None:
+        return None
+    old_files, new_files = previous["files"], current["files"]
+    return sorted(
+        current["prefix"] + name
+        for name in set(old_files) | set(new_files)
+        if old_files.get(name) != new_files.get(name)
+    )
+
+
+# CloudFront allows at most this many paths (not counting wildcard paths) in
+# the invalidations in progress for a distribution
+CLOUDFRONT_MAX_PATHS_IN_PROGRESS = 3000
+
+
+def _cloudfront_paths_in_progress(conn, distribution_id):
+    """
+    Returns the number of paths, not counting wildcard paths, in the
+    distribution's invalidations that are still in progress.
+    """
+    count = 0
+    for summary in conn.get_invalidation_requests(distribution_id):
+        if summary.status == "Completed":
+            continue
+        batch = conn.invalidation_request_status(distribution_id, summary.id)
+        count += len([path for path in batch.paths if "*" not in path])
+    return count
+
+
+@timed
+def _invalidate_cloudfront(distribution_id, paths):
+    """
+    Invalidates the given paths in the CloudFront distribution, in batches of
+    ``cloudfront_invalidation_batch_size`` paths. Falls back to invalidating
+    everything if ``paths`` is None, or longer than
+    ``cloudfront_invalidation_max_paths`` or the number of paths CloudFront
+    still allows in progress. If ``cloudfront_invalidation_wait`` is set,
+    waits up to ``cloudfront_invalidation_timeout`` seconds for the
+    invalidation to complete.
+    """
+    conn = CloudFrontConnection()
+    if paths is None:
+        print("No comparable static files manifest found; invalidating all paths.")
+        paths = ["/*"]
+    elif not paths:
+        print("No static files changed; skipping CloudFront invalidation.")
+        return
+    else:
+        in_progress = _cloudfront_paths_in_progress(conn, distribution_id)
+        max_paths = min(
+            int(env.cloudfront_invalidation_max_paths),
+            CLOUDFRONT_MAX_PATHS_IN_PROGRESS - in_progress,
+        )
+        if len(paths) > max_paths:
+            print(
+                "%s static paths changed (more than %s, with %s paths already "
+                "being invalidated); invalidating all paths."
+                % (len(paths), max_paths, in_progress)
+            )
+            paths = ["/*"]
+    batch_size = int(env.cloudfront_invalidation_batch_size)
+    request_ids = []
+    for i in range(0, len(paths), batch_size):
+        batch = paths[i : i + batch_size]
+        print(
+            "Creating invalidation request for %s path(s) on CloudFront "
+            "Distribution %s" % (len(batch), distribution_id)
+        )
+        request_ids.append(conn.create_invalidation_request(distribution_id, batch).id)
+    if not env.cloudfront_invalidation_wait:
+        return
+    max_wait = int(env.cloudfront_invalidation_timeout)
+    start = time.time()
+    while request_ids:
+        if time.time() - start > max_wait:
+            abort(
+                "CloudFront invalidation(s) %s of distribution %s still not "
+                "completed after %s seconds; they'll continue in the background."
+                % (", ".join(request_ids), distribution_id, max_wait)
+            )
         print(
-            "Creating invalidation request for CloudFront Distribution %s"
-            % distribution_id
+            "Waiting for %s CloudFront invalidation(s) to complete..."
+            % len(request_ids)
         )
-        conn.create_invalidation_request(distribution_id, ["/*"])
+        time.sleep(10)
+        request_ids = [
+            request_id
+            for request_id in request_ids
+            if conn.invalidation_request_status(distribution_id, request_id).status
+            != "Completed"
+        ]
+    print("CloudFront invalidation completed in %d seconds." % (time.time() - start))
 
 
 @task
@@ -1360,21 +2278,171 @@ def flag_deployment():
 @parallel
 @roles("web")
 def deploy_web(changeset=None):
-    """Deploy to a given environment."""
+    """Deploy to a given environment.
+
+    With ``graceful_reload`` enabled, gunicorn is reloaded (rather than stopped
+    and started) if it's running and the requirements and service
+    configuration haven't changed.
+    """
 
     require("environment", provided_by=env.environments)
-    supervisor("stop", "web")
-    supervisor("stop", "pgbouncer")
+    master_pid = _gunicorn_pid() if env.graceful_reload else None
+    requirements_path = os.path.join(env.code_root, env.requirements_file)
+    config_paths = [
+        os.path.join(env.services, service, "*")
+        for service in ("supervisor", "pgbouncer", "stunnel")
+    ]
+    if master_pid:
+        requirements = _file_checksums(requirements_path)
+        configs = _file_checksums(*config_paths)
+    else:
+        _stop_web()
     update_source(changeset=changeset)
+    if master_pid and _file_checksums(requirements_path) != requirements:
+        print("Requirements changed; restarting gunicorn instead of reloading it.")
+        master_pid = None
+        _stop_web()
     update_requirements()
     update_local_settings()
-    upload_supervisor_conf()
+    upload_supervisor_conf(run_update=not master_pid)
+    if master_pid and _file_checksums(*config_paths) != configs:
+        print("Services changed; restarting gunicorn instead of reloading it.")
+        master_pid = None
+        _stop_web()
+        sudo("supervisorctl update")
     if getattr(env, "static_hosting", "remote") == "local":
-        collectstatic()
-        with settings(warn_only=True):
-            _call_managepy("compress")
-    supervisor("start", "pgbouncer")
-    supervisor("start", "web")
+        _update_static()
+    if master_pid:
+        _reload_gunicorn(master_pid)
+    else:
+        supervisor("start", "pgbouncer")
+        supervisor("start", "web")
+
+
+def _stop_web():
+    """Stops gunicorn and pgbouncer on the current host."""
+    supervisor("stop", "web")
+    supervisor("stop", "pgbouncer")
+
+
+def _gunicorn_pid():
+    """Returns the PID of the gunicorn master process, if it's running."""
+    with settings(warn_only=True), hide("running", "stdout"):
+        pid = sudo("supervisorctl pid %(environment)s-web:%(environment)s-server" % env)
+    pid = pid.strip()
+    if pid.isdigit() and int(pid) > 0:
+        return int(pid)
+    return None
+
+
+def _gunicorn_workers(master_pid):
+    """Returns the set of PIDs of the given gunicorn master's workers."""
+    with settings(warn_only=True), hide("running", "stdout"):
+        return set(sudo("pgrep -P %s" % master_pid).split())
+
+
+def _file_checksums(*paths):
+    """Returns the checksums of the given files (or globs) on the current host."""
+    with settings(warn_only=True), hide("running", "stdout"):
+        return sudo("sha1sum %s" % " ".join(paths))
+
+
+def _web_healthy(attempts=10, port=None):
+    """
+    Returns whether Django answers the healthcheck on the current host, going
+    directly to gunicorn (on ``port``, by default the server port) to bypass
+    any healthcheck override in Nginx.
+    """
+    cmd = (
+        "curl -s -o /dev/null -w '%%{http_code}' -H 'Host: %s' "
+        "-H 'X-Forwarded-Proto: https' http://127.0.0.1:%s/healthcheck.html"
+        % (_current_server().instance.private_ip_address, port or env.server_port)
+    )
+    for attempt in range(attempts):
+        with settings(warn_only=True), hide("running", "stdout"):
+            if run(cmd).strip() == "200":
+                return True
+        time.sleep(3)
+    return False
+
+
+def _check_new_workers():
+    """
+    Starts a separate gunicorn with a single worker running the new code on
+    ``graceful_reload_check_port`` (by default, the server port plus 1000),
+    and returns whether it answers the healthcheck. It's stopped again
+    afterwards either way.
+    """
+    port = env.graceful_reload_check_port or env.server_port + 1000
+    pid_file = "/tmp/gunicorn-%s-check.pid" % env.environment
+    log_file = "/tmp/gunicorn-%s-check.log" % env.environment
+    settings_env = ""
+    if env.settings_managepy:
+        settings_env = "DJANGO_SETTINGS_MODULE=%s " % env.settings_managepy
+    # gunicorn is killed by timeout in case we don't get to stop it below
+    sudo(
+        "cd %s && %snohup timeout 300 %s --bind=127.0.0.1:%s --workers=1 "
+        "--pid=%s %s > %s 2>&1 &"
+        % (
+            env.code_root,
+            settings_env,
+            os.path.join(env.virtualenv_root, "bin", "gunicorn"),
+            port,
+            pid_file,
+            env.wsgi_app,
+            log_file,
+        ),
+        user=env.webserver_user,
+        pty=False,
+    )
+    try:
+        return _web_healthy(attempts=20, port=port)
+    finally:
+        with settings(warn_only=True), hide("running", "stdout"):
+            sudo("kill $(cat %s) && rm -f %s" % (pid_file, pid_file))
+
+
+def _reload_gunicorn(master_pid):
+    """
+    Reloads gunicorn with HUP, so that new workers start with the new code
+    while the old ones finish their requests, once a separate gunicorn
+    running the new code has answered the healthcheck (see
+    ``_check_new_workers``). Falls back to a restart if the new workers
+    don't answer the healthcheck after the reload.
+    """
+    with settings(warn_only=True):
+        check = _call_managepy("check")
+    if check.failed:
+        abort("manage.py check failed; leaving the old gunicorn workers running.")
+    if not _check_new_workers():
+        abort(
+            "The new code failed the healthcheck (see /tmp/gunicorn-%s-check.log); "
+            "leaving the old gunicorn workers running." % env.environment
+        )
+    old_workers = _gunicorn_workers(master_pid)
+    sudo("kill -HUP %s" % master_pid)
+    max_wait = int(getattr(env, "gunicorn_timeout", 30)) + 60
+    waited = 0
+    while waited < max_wait:
+        time.sleep(2)
+        waited += 2
+        if _gunicorn_pid() != master_pid:
+            break  # the master exited, e.g., if the new workers failed to boot
+        workers = _gunicorn_workers(master_pid)
+        if workers and not workers & old_workers:
+            print("Replaced gunicorn workers in {0} seconds.".format(waited))
+            break
+    else:
+        print(
+            "WARNING: Old gunicorn workers still running after {0} "
+            "seconds.".format(max_wait)
+        )
+    if _web_healthy():
+        return
+    print("New gunicorn workers failed the healthcheck; restarting gunicorn.")
+    supervisor("restart", "web")
+    if not _web_healthy():
+        abort("gunicorn failed the healthcheck after restarting.")
 
 
 @task
@@ -1386,6 +2454,12 @@ def deploy_worker(changeset=None):
     """
 
     require("environment", provided_by=env.environments)
+    _update_worker(changeset)
+    _finish_worker()
+
+
+def _update_worker(changeset=None):
+    """Stops celery and updates the code and configuration on the worker."""
     supervisor("stop", "celery")
     supervisor("stop", "pgbouncer")
     update_source(changeset=changeset)
@@ -1393,14 +2467,92 @@ def deploy_worker(changeset=None):
     update_local_settings()
     upload_supervisor_conf()
     supervisor("start", "pgbouncer")
+
+
+def _finish_worker():
+    """Migrates, updates the static media, and restarts celery on the worker."""
     migrate()
-    collectstatic()
-    with settings(warn_only=True):
-        _call_managepy("compress")
+    _update_static()
     supervisor("start", "celery")
     flag_deployment()
 
 
+def _pending_migrations():
+    """Returns the names of the migrations that haven't been applied yet."""
+    with hide("stdout"):
+        output = _call_managepy("showmigrations --plan")
+    return [
+        line.split("]", 1)[1].strip()
+        for line in output.splitlines()
+        if line.strip().startswith("[ ]")
+    ]
+
+
+@task
+@roles("worker")
+@runs_once
+def prepare_worker(changeset=None):
+    """
+    Update the code on the celery worker (leaving celery stopped), and return
+    the migrations that haven't been applied yet.
+    """
+    require("environment", provided_by=env.environments)
+    _update_worker(changeset)
+    return _pending_migrations()
+
+
+@task
+@roles("worker")
+@runs_once
+def finish_worker():
+    """Finish a deploy_worker started with prepare_worker."""
+    require("environment", provided_by=env.environments)
+    _finish_worker()
+
+
+@task
+@roles("web")
+@parallel
+def warm_up():
+    """
+    Sends the ``warmup_urls`` to gunicorn on the web servers, from
+    ``warmup_concurrency`` threads for ``warmup_duration`` seconds, and
+    reports the request times.
+    """
+    require("environment", provided_by=env.environments)
+    if not env.warmup_urls:
+        return
+    put(
+        os.path.join(env.templates_dir, "warmup.py"),
+        env.warmup_script,
+        use_sudo=True,
+        mode=0o644,
+    )
+    with hide("running", "stdout"):
+        # Django is served at the private IP (see ALLOWED_HOSTS)
+        host = run("hostname -I").split()[0]
+        output = run(
+            "%s/bin/python %s %s %s %s %s %s"
+            % (
+                env.virtualenv_root,
+                env.warmup_script,
+                env.server_port,
+                host,
+                env.warmup_concurrency,
+                env.warmup_duration,
+                " ".join("'%s'" % url for url in env.warmup_urls),
+            )
+        )
+    stats = json.loads(output.splitlines()[-1])
+    print(
+        "Warmed up with {requests} requests ({errors} errors): p50 {p50:.3f}s, "
+        "p95 {p95:.3f}s, max {max:.3f}s".format(**stats)
+    )
+    if stats["errors"]:
+        print("WARNING: {0} warm-up requests failed.".format(stats["errors"]))
+    return stats
+
+
 @task
 @roles("web")
 @runs_once
@@ -1424,6 +2576,7 @@ def add_to_elb():
             begin_upgrade(stay_healthy=False)
             deploy_web()
             end_upgrade()
+            warm_up()
         for elb_name in env.elb_names:
             print("Adding instance %s to ELB %s" % (server.instance.id, elb_name))
             server.add_to_elb(elb_name)
@@ -1434,11 +2587,23 @@ def add_to_elb():
 @task
 @roles("web")
 @runs_once
-def add_all_to_elb():
-    """Adds all web servers for the given environment to the appropriate load balancer(s)."""
+def add_all_to_elb(warm="yes"):
+    """
+    Adds all web servers for the given environment to the appropriate load
+    balancer(s), warming up those that aren't in service yet (unless ``warm``
+    is "no").
+    """
 
     require("environment", provided_by=env.environments)
     servers = env.servers["web"]
+    if env.warmup_urls and str(warm).lower() not in ("false", "no", "0"):
+        cold = [
+            server.hostname
+            for server in servers
+            if any(server.elb_state(name) != "InService" for name in env.elb_names)
+        ]
+        if cold:
+            executel("warm_up", hosts=cold)
 
     for elb_name in env.elb_names:
         for server in servers:
@@ -1541,8 +2706,22 @@ def promote_replica(index=0, override_servers=None):
 
     require("environment", provided_by=env.environments)
     replica = env.servers["db-replica"][int(index)]
-    replica.pg_promote()
-    for server in env.servers["db-primary"]:
+    _promote_replica(replica, env.servers["db-primary"], override_servers)
+
+
+def _promote_replica(replica, old_primaries, override_servers=None):
+    """
+    Promotes the given replica to the db-primary role and decommissions the
+    given old primaries. Steps that were already done are skipped or safe to
+    repeat, so a partial promotion can be run again.
+    """
+    if replica.pg_in_recovery():
+        replica.pg_promote()
+    else:
+        print("%s is already promoted; not promoting it again." % replica.hostname)
+    for server in old_primaries:
+        if server.instance.id == replica.instance.id:
+            continue
         _change_role(server, "db-primary-OLD")
         with server:
             with settings(warn_only=True):
@@ -1584,10 +2763,7 @@ def update_sysadmin_users():
 def upgrade_packages():
     """update packages on the servers"""
 
-    with settings(warn_only=True):
-        sudo(
-            "export DEBIAN_FRONTEND=noninteractive ; apt-get -qq update || apt-get -qq update"
-        )
+    apt_update()
     if "web" in _current_roles() or "worker" in _current_roles():
         packages = env.app_server_packages
         sudo(
@@ -1628,6 +2804,7 @@ def mount_encrypted(drive_letter="f"):
     crypt_dev = "/dev/mapper/{0}".format(crypt)
     if exists(crypt_dev):
         print("{0} already exists on {1}, exiting".format(crypt_dev, env.host_string))
+        sudo("touch %s" % env.ready_marker)
         return
     _load_passwords(["luks_passphrase"])
     # stop redis and nginx (postgres will have failed to start without
@@ -1693,6 +2870,106 @@ def mount_encrypted(drive_letter="f"):
         sudo("service rsyslog restart")
     if env.awslogs_access_key_id:
         sudo("service awslogs restart")
+    sudo("touch %s" % env.ready_marker)
+
+
+@timed
+def _wait_for_ready(servers, max_wait=None):
+    """
+    Waits for each of the given servers to write ``env.ready_marker``, which
+    happens at the end of rc.local on web servers and of ``mount_encrypted``
+    on all servers.
+    """
+    if max_wait is None:
+        max_wait = int(env.ready_timeout)
+    start = time.time()
+    for server in servers:
+        while True:
+            waited = time.time() - start
+            try:
+                with settings(host_string=server.hostname), hide("running", "stdout"):
+                    if exists(env.ready_marker):
+                        print(
+                            "{0} ready after {1:.0f} seconds.".format(
+                                server.instance.id, waited
+                            )
+                        )
+                        break
+            except NetworkError:
+                pass  # SSH may not be up yet
+            if waited > max_wait:
+                print(
+                    "WARNING: {0} still not ready after {1} seconds; "
+                    "continuing anyway.".format(server.instance.id, max_wait)
+                )
+                break
+            time.sleep(5)
+
+
+@timed
+def _wait_for_ssh(server, max_wait=None):
+    """
+    Waits for SSH access to the given (newly launched) server as the current
+    user, e.g., for servers launched from an image on which the default user
+    has been disabled.
+    """
+    if max_wait is None:
+        max_wait = int(env.ready_timeout)
+    start = time.time()
+    while True:
+        try:
+            with settings(host_string=server.hostname), hide("running", "stdout"):
+                run("true")
+            return
+        except NetworkError:
+            pass
+        if time.time() - start > max_wait:
+            abort(
+                "Unable to connect to {0} after {1} seconds.".format(
+                    server.instance.id, max_wait
+                )
+            )
+        time.sleep(5)
+
+
+@timed
+def _wait_for_drain(server, max_wait):
+    """
+    Waits up to ``max_wait`` seconds for Nginx on the given server to have no
+    active connections (other than our own status request), according to
+    its stub_status page.
+    """
+    waited = 0
+    while True:
+        with settings(host_string=server.hostname, warn_only=True), hide(
+            "running", "stdout"
+        ):
+            status = run("curl -sk https://127.0.0.1/nginx_stub_status")
+        match = re.search(r"Active connections:\s*(\d+)", status)
+        if not match:
+            print(
+                "Could not read Nginx status on %s; waiting %s seconds for "
+                "requests to finish processing..."
+                % (server.hostname, max_wait - waited)
+            )
+            time.sleep(max(max_wait - waited, 0))
+            return
+        active = int(match.group(1)) - 1  # don't count our own request
+        if active <= 0:
+            print(
+                "All requests drained from %s after %s seconds."
+                % (server.hostname, waited)
+            )
+            return
+        if waited >= max_wait:
+            print(
+                "WARNING: %s still has %s active connections after %s seconds; "
+                "continuing anyway." % (server.hostname, active, max_wait)
+            )
+            return
+        print("Waiting for %s active connections to finish..." % active)
+        time.sleep(2)
+        waited += 2
 
 
 @task
@@ -1708,10 +2985,7 @@ def install_newrelic_infrastructure_agent():
         f'printf "deb https://download.newrelic.com/infrastructure_agent/linux/apt/ {release} main" | tee /etc/apt/sources.list.d/newrelic-infra.list',
         shell=True,
     )
-    with settings(warn_only=True):
-        sudo(
-            "export DEBIAN_FRONTEND=noninteractive; apt-get -qq update || apt-get -qq update"
-        )
+    apt_update()
     sudo("export DEBIAN_FRONTEND=noninteractive; apt-get install newrelic-infra -y")
     upload_newrelic_infrastructure_conf()
 
@@ -1754,20 +3028,36 @@ def executel(cmd, *args, **kwargs):
         name = str(cmd).upper()
     arguments = [str(v) for v in args] + ["%s=%s" % (k, v) for k, v in kwargs.items()]
     logger.info("\n\n **** %s (%s) ****\n\n" % (name, ", ".join(arguments)))
-    execute(cmd, *args, **kwargs)
+    hosts = kwargs.get("hosts") or kwargs.get("host")
+    if isinstance(hosts, (list, tuple)):
+        hosts = ",".join(hosts)
+    roles = kwargs.get("roles") or kwargs.get("role") or env.roles
+    if isinstance(roles, (list, tuple)):
+        roles = ",".join(roles)
+    with span(name.lower(), host=hosts, role=roles or None):
+        return execute(cmd, *args, **kwargs)
 
 
 @task
 @runs_once
-def create_environment(deployment_tag, environment, num_web=2):
-    """Sets up all servers for the given environment for the first time."""
+@recorded
+def create_environment(deployment_tag, environment, num_web=2, resume=None):
+    """Sets up all servers for the given environment for the first time.
+
+    Completed steps (and the servers, image, and launch config they created)
+    are recorded in a local journal. If the task fails, run it again with
+    ``resume=yes`` to continue where it left off.
+    """
 
     _setup_env(deployment_tag, environment)
-    print("Starting AMI and launch config creation in the background")
-    # make sure we don't pass open SSH connections down to the child procs
-    disconnect_all()
-    lc_creator = BackgroundCommand(_create_server_for_image, capture_result=True)
-    lc_creator.start()
+    journal = Journal(
+        "create_environment",
+        deployment_tag,
+        environment,
+        resume=str(resume).lower() in ("true", "yes", "1"),
+    )
+    _original_servers(journal)
+    lc_creator = _start_image_server(journal)
     az_1 = env.avail_zones[0]
     az_2 = env.avail_zones[1]
     servers = [
@@ -1776,31 +3066,23 @@ def create_environment(deployment_tag, environment, num_web=2):
         (deployment_tag, environment, "cache", az_2),
         (deployment_tag, environment, "worker", az_1),
     ]
-    _create_many(servers)
+    _create_missing(journal, "create_servers", servers)
     env.roles = []
     executel(environment, deployment_tag)
-    # if we create all servers at once, the replica won't be sync'ed yet
-    executel("reset_slaves")
-
-    print("Waiting for launch config creation to complete...")
-    # wait for the launch config to finish creating if needed
-    lc_creator.join()
-    instance_id = lc_creator.result()
-    # reload the environment once more, after we know the background image
-    # creation is finished
-    _setup_env(deployment_tag, environment)
-    server = _get_servers(
-        deployment_tag, environment, "web", instance_ids=[instance_id]
-    )[0]
-    # shutdown the server and create the AMI & Launch config
-    lc = _create_launch_config(server=server)
-    # clean up the leftover server in EC2
-    server.terminate()
-    print("Running deploy_full...")
-    # run the initial deployment with the new AMI containing the latest code
-    deploy_full(
-        deployment_tag, environment, launch_config_name=lc.name, num_web=num_web
-    )
+    if not journal.done("reset_slaves"):
+        # if we create all servers at once, the replica won't be sync'ed yet
+        executel("reset_slaves")
+        journal.complete("reset_slaves")
+
+    lc_name = _finish_launch_config(journal, lc_creator)
+    if not journal.done("deploy_full"):
+        print("Running deploy_full...")
+        # run the initial deployment with the new AMI containing the latest code
+        deploy_full(
+            deployment_tag, environment, launch_config_name=lc_name, num_web=num_web
+        )
+        journal.complete("deploy_full")
+    journal.finish()
 
     print(
         "The non-web servers have been created and the autoscaling group has been updated "
@@ -1874,6 +3156,15 @@ def describe(deployment_tag, environment):
                 print("     Hostname: {0}".format(server.hostname))
                 print("  Internal IP: {0}".format(server.internal_ip))
                 print("    Placement: {0}".format(server._placement))
+                info = server.instance_type_info
+                print(
+                    "         Type: {0} ({1} vCPUs, {2} MiB, {3} network)".format(
+                        server.instance.instance_type,
+                        info["vcpus"],
+                        info["memory"],
+                        info["network"],
+                    )
+                )
                 if role == "web":
                     elb_names = _find(
                         env.load_balancers, env.deployment_tag, env.environment
@@ -1890,10 +3181,12 @@ def describe(deployment_tag, environment):
 
 @task
 @runs_once
+@recorded
 def deploy_full_without_autoscaling(deployment_tag, environment):
     """Runs a full deploy in parallel on the given deployment and environment."""
     _check_local_deps()
     executel(environment, deployment_tag)
+    _prepare_release()
     executel("begin_upgrade")
     executel("deploy_worker")
     executel("deploy_web")
@@ -1902,8 +3195,13 @@ def deploy_full_without_autoscaling(deployment_tag, environment):
 
 @task
 @runs_once
+@recorded
 def deploy_serial_without_autoscaling(deployment_tag, environment, wait=30):
-    """Safely deploy to a given environment with no downtime."""
+    """
+    Safely deploy to a given environment with no downtime. Waits up to ``wait``
+    seconds for each server to finish processing outstanding requests after
+    it's removed from the load balancer(s).
+    """
 
     _check_local_deps()
     executel(environment, deployment_tag)
@@ -1930,8 +3228,8 @@ def deploy_serial_without_autoscaling(deployment_tag, environment, wait=30):
                 server.remove_from_elb(elb_name)
             state = server.wait_for_elb_state(elb_name, "OutOfService")
             print("Instance %s now in state %s" % (server.instance.id, state))
-        print("Waiting %s seconds for requests to finish processing..." % wait)
-        time.sleep(wait)  # wait for instance to process outstanding requests
+        # wait for instance to process outstanding requests
+        _wait_for_drain(server, wait)
         # be honest to the load balancer(s) about our status (not healthy)
         executel("begin_upgrade", stay_healthy=False, hosts=[server.hostname])
         executel("deploy_web", hosts=[server.hostname])
@@ -1944,79 +3242,292 @@ def deploy_serial_without_autoscaling(deployment_tag, environment, wait=30):
 
 @task
 @runs_once
-def recreate_servers(deployment_tag, environment, wait=30):
-    """Recreate all the servers in a given environment, and decommission the old ones."""
+@recorded
+def recreate_servers(deployment_tag, environment, wait=30, resume=None):
+    """Recreate all the servers in a given environment, and decommission the old ones.
+
+    Completed steps (and the servers, image, and launch config they created)
+    are recorded in a local journal. If the task fails, run it again with
+    ``resume=yes`` to continue where it left off.
+    """
 
     _setup_env(deployment_tag, environment)
-    config = {}
-    orig_servers = dict(env.servers.items())
-    for role, servers in orig_servers.items():
-        config[role] = [s._placement[-1] for s in servers]
-    print("Starting AMI and launch config creation in the background")
-    # make sure we don't pass open SSH connections down to the child procs
-    disconnect_all()
-    lc_creator = BackgroundCommand(_create_server_for_image, capture_result=True)
-    lc_creator.start()
+    journal = Journal(
+        "recreate_servers",
+        deployment_tag,
+        environment,
+        resume=str(resume).lower() in ("true", "yes", "1"),
+    )
+    orig_servers = _original_servers(journal)
+    config = journal.get("zones")
+    lc_creator = _start_image_server(journal)
     print("Recreating servers for: %s" % config)
     # first, create a new replica & cache to replace the current primary & cache servers
     servers = [(deployment_tag, environment, "db-replica", config["db-primary"][0])]
     servers += [(deployment_tag, environment, "cache", z) for z in config["cache"]]
-    _create_many(servers)
-    start_time = datetime.datetime.now()
-    executel("begin_upgrade")
-    _stop_all()
-    print("Decommisioning old servers...")
-    # rename the original replica server(s)
-    for replica in orig_servers["db-replica"]:
-        _change_role(replica, "db-replica-OLD")
-    for cache in orig_servers["cache"]:
-        _change_role(cache, "cache-OLD")
+    _create_missing(journal, "create_primary_and_cache", servers)
     # reload the environment with the new replica (soon to be primary),
     # but ensure the web server being created in the background is
     # not added
     override = {"web": orig_servers["web"]}
-    _setup_env(deployment_tag, environment, override_servers=override)
-    # promote that replica to the primary role
-    executel("promote_replica", override_servers=override)
-    # update local_settings.py with new, single primary
-    executel("update_local_settings")
-    _start_all()
-    executel("end_upgrade")
-    end_time = datetime.datetime.now()
-    downtime = end_time - start_time
-    print("downtime complete; total = %s secs" % downtime.total_seconds())
+    if not journal.done("promote_replica"):
+        if journal.get("downtime_start") is None:
+            journal.set("downtime_start", time.time())
+        executel("begin_upgrade")
+        _stop_all()
+        print("Decommisioning old servers...")
+        # rename the original replica server(s)
+        for replica in orig_servers["db-replica"]:
+            _change_role(replica, "db-replica-OLD")
+        for cache in orig_servers["cache"]:
+            _change_role(cache, "cache-OLD")
+        _setup_env(deployment_tag, environment, override_servers=override)
+        # record the new primary before changing its role, so that a partial
+        # promotion can be completed when resuming
+        if journal.get("new_primary") is None:
+            journal.set("new_primary", env.servers["db-replica"][0].instance.id)
+        new_primary = _get_servers(
+            deployment_tag,
+            environment,
+            "db-replica",
+            instance_ids=[journal.get("new_primary")],
+            any_role=True,
+        )[0]
+        # promote that replica to the primary role
+        with span("promote_replica", host=new_primary.hostname, role="db-replica"):
+            _promote_replica(
+                new_primary, orig_servers["db-primary"], override_servers=override
+            )
+        journal.complete("promote_replica")
+    if not journal.done("restart_services"):
+        _setup_env(deployment_tag, environment, override_servers=override)
+        # update local_settings.py with new, single primary
+        executel("update_local_settings")
+        _start_all()
+        executel("end_upgrade")
+        journal.complete("restart_services", downtime_end=time.time())
+    downtime = journal.get("downtime_end") - journal.get("downtime_start")
+    print("downtime complete; total = %s secs" % downtime)
 
     # next, create the new replica, worker, and web servers
     servers = [
         (deployment_tag, environment, "db-replica", z) for z in config["db-replica"]
     ]
     servers += [(deployment_tag, environment, "worker", config["worker"][0])]
-    _create_many(servers)
-    for worker in orig_servers["worker"]:
-        executel("supervisor", "stop", "celery", hosts=[worker.hostname])
-        _change_role(worker, "worker-OLD")
-
-    # wait for the launch config to finish creating if needed
-    print("waiting for launch config to finish creating")
-    lc_creator.join()
-    instance_id = lc_creator.result()
-    # reload the environment once more, after we know the background image
-    # creation is finished
+    _create_missing(journal, "create_replicas_and_worker", servers)
+    if not journal.done("retire_worker"):
+        for worker in orig_servers["worker"]:
+            executel("supervisor", "stop", "celery", hosts=[worker.hostname])
+            _change_role(worker, "worker-OLD")
+        journal.complete("retire_worker")
+
+    lc_name = _finish_launch_config(journal, lc_creator)
+    if not journal.done("deploy_serial"):
+        # make sure all the web servers get re-created using auto-scaling
+        deploy_serial(
+            deployment_tag, environment, launch_config_name=lc_name, answer="y"
+        )
+        journal.complete("deploy_serial")
+    journal.finish()
+
+    print("recreate_servers complete; total downtime was %s secs" % downtime)
+
+
+# roles that can be replaced from a pool of stopped, pre-provisioned servers
+WARM_POOL_ROLES = ("db-replica", "cache", "worker")
+
+
+def _warm_role(role):
+    """Returns the role tag for the given role's warm pool."""
+    return "%s-WARM" % role
+
+
+def _warm_pool(role):
+    """
+    Returns the (generic EC2Instance) instances, running or stopped, in the
+    warm pool for the given role.
+    """
+    if role not in WARM_POOL_ROLES:
+        abort(
+            "Choose a role that supports a warm pool: %s" % ", ".join(WARM_POOL_ROLES)
+        )
+    return ec2_instances(
+        filters={
+            "tag:environment": env.environment,
+            "tag:deployment": env.deployment_tag,
+            "tag:role": _warm_role(role),
+            "instance-state-name": ["running", "stopped"],
+        }
+    )
+
+
+@task
+@runs_once
+def fill_warm_pool(deployment_tag, environment, role=None, count=None):
+    """
+    Creates fully set up servers and stops them, until the warm pool for each
+    role in the ``warm_pool`` setting (or only the given role, with ``count``
+    servers) is full.
+    """
     _setup_env(deployment_tag, environment)
+    if role is None:
+        sizes = env.warm_pool
+    else:
+        sizes = {role: count or env.warm_pool.get(role, 1)}
+    if not sizes:
+        abort("Set warm_pool to the number of servers to keep for each role.")
+    for role, size in sorted(sizes.items()):
+        _setup_env(deployment_tag, environment)
+        missing = int(size) - len(_warm_pool(role))
+        if missing <= 0:
+            print("The warm pool for %s is full." % role)
+            continue
+        print("Creating %s server(s) for the %s warm pool..." % (missing, role))
+        servers = _retry_new(
+            deployment_tag, environment, role, count=missing, warm=True
+        )
+        for server in servers:
+            server.stop()
+        print("Added %s server(s) to the %s warm pool." % (len(servers), role))
+
+
+def _prepare_warm_server(warm, role):
+    """
+    Starts the given server from the warm pool for the given role, if needed,
+    and runs the host-specific setup steps on it. Returns the server.
+    """
+    if warm.instance.state != "running":
+        warm.start()
     server = _get_servers(
-        deployment_tag, environment, "web", instance_ids=[instance_id]
+        env.deployment_tag,
+        env.environment,
+        role,
+        instance_ids=[warm.instance.id],
+        any_role=True,
     )[0]
-    # shutdown the server and create the AMI & Launch config
-    lc = _create_launch_config(server=server)
-    # clean up the leftover server in EC2
-    server.terminate()
-    # make sure all the web servers get re-created using auto-scaling
-    deploy_serial(deployment_tag, environment, launch_config_name=lc.name, answer="y")
+    _wait_for_ssh(server)
+    password_names = list(env.password_names)
+    if env.instance_settings["fs_encrypt"]:
+        password_names.append("luks_passphrase")
+    _load_passwords(password_names)
+    hosts = [server.hostname]
+    changeset = None
+    if role == "worker" and env.roledefs["web"]:
+        # deploy the same code as the web servers
+        changeset = executel("current_changeset", hosts=env.roledefs["web"][:1])
+        changeset = list(changeset.values())[0]
+    # the methods below should only be run on the claimed server, so
+    # replace that role definition accordingly
+    saved_roledefs = env.roledefs[role]
+    saved_servers = env.servers[role]
+    try:
+        env.roledefs[role] = hosts
+        env.servers[role] = [server]
+        if env.instance_settings["fs_encrypt"]:
+            # also starts the services on the encrypted drive
+            executel("mount_encrypted", hosts=hosts)
+        executel("update_server_passwords", hosts=hosts)
+        if role == "db-replica":
+            executel("reset_slaves", hosts=hosts)
+        elif role == "worker":
+            executel("prepare_worker", changeset, hosts=hosts)
+            executel("supervisor", "start", "celery", hosts=hosts)
+    finally:
+        env.roledefs[role] = saved_roledefs
+        env.servers[role] = saved_servers
+    return server
 
+
+@task
+@runs_once
+@recorded
+def claim_warm_server(deployment_tag, environment, role):
+    """
+    Starts a server from the warm pool for the given role (see
+    ``fill_warm_pool``), runs the host-specific setup steps, and puts it in
+    service in that role.
+    """
+    start = time.time()
+    _setup_env(deployment_tag, environment)
+    pool = _warm_pool(role)
+    if not pool:
+        abort(
+            "There are no servers in the %s warm pool; create some with "
+            "fill_warm_pool." % role
+        )
+    warm = pool[0]
+    # so no one else claims it in the meantime
+    _change_role(warm, role + "-PENDING")
+    try:
+        server = _prepare_warm_server(warm, role)
+    except:  # noqa: E722
+        # put it back in the pool, stopped, so it's claimed from a clean boot
+        # next time
+        logger.exception("claiming %s failed.", warm.instance.id)
+        print(
+            "Claiming %s failed; stopping it and returning it to the warm pool. "
+            "Terminate it if it's broken." % warm.instance.id
+        )
+        warm.stop()
+        _change_role(warm, _warm_role(role))
+        raise
+    _change_role(server, role)
     print(
-        "recreate_servers complete; total downtime was %s secs"
-        % downtime.total_seconds()
+        "Claimed %s from the %s warm pool in %d seconds. Run fill_warm_pool to "
+        "replace it." % (server.instance.id, role, time.time() - start)
+    )
+
+
+@task
+@runs_once
+def install_package_cache():
+    """
+    Installs an APT caching proxy (apt-cacher-ng) and an HTTP artifact cache
+    (Nginx) on the first server in the ``package_cache_role``, for new servers
+    to download packages and other artifacts through.
+    """
+    require("environment", provided_by=env.environments)
+    server = env.package_cache_server
+    if not server:
+        abort(
+            "Set package_cache_role to a role with a running server to install "
+            "the package cache."
+        )
+    context = dict(env)
+    context["artifact_hosts_pattern"] = "|".join(
+        re.escape(host) for host in env.package_cache_artifact_hosts
     )
+    # tunnel (without caching) only CONNECT requests for the HTTPS repositories
+    pass_through = "^(%s):443$" % "|".join(
+        re.escape(host) for host in env.package_cache_https_repos
+    )
+    with settings(host_string=server.hostname):
+        apt_update()
+        sudo(
+            "export DEBIAN_FRONTEND=noninteractive ; apt-get -qq -y install apt-cacher-ng nginx"
+        )
+        sudo("sed -i '/^PassThroughPattern:/d' /etc/apt-cacher-ng/acng.conf")
+        append(
+            "/etc/apt-cacher-ng/acng.conf",
+            [
+                "Port: %s" % env.package_cache_apt_port,
+                "PassThroughPattern: %s" % pass_through,
+            ],
+            use_sudo=True,
+        )
+        sudo("mkdir -p /var/cache/nginx/artifacts")
+        sudo("chown www-data:www-data /var/cache/nginx/artifacts")
+        _upload_template(
+            "package-cache-nginx.conf",
+            "/etc/nginx/conf.d/fabulaws-package-cache.conf",
+            user="root",
+            context=context,
+            use_jinja=True,
+            template_dir=env.templates_dir,
+        )
+        sudo("service apt-cacher-ng restart")
+        sudo("service nginx reload || service nginx start")
+    print("Package cache installed on %s; new servers will use it." % server.hostname)
 
 
 @task
@@ -2060,10 +3571,7 @@ def install_rsyslog():
         sudo(
             "export DEBIAN_FRONTEND=noninteractive ; add-apt-repository --yes ppa:adiscon/v8-stable"
         )
-        with settings(warn_only=True):
-            sudo(
-                "export DEBIAN_FRONTEND=noninteractive ; apt-get -qq update || apt-get -qq update"
-            )
+        apt_update()
         # The extra Options and --force-yes were added in support of a custom /etc/rsyslog.conf in pre_install_syslog
         # This should be okay as a universal change, but if it causes issues, we can remove it once the underlying
         # need for a custom rsyslog.conf is resolved.
@@ -2103,10 +3611,10 @@ def install_logstash():
             sudo(
                 "export DEBIAN_FRONTEND=noninteractive ; apt-get -qq -y install default-jre"
             )
-            sudo(
-                "wget https://download.elasticsearch.org/logstash/logstash/logstash-1.1.7-monolithic.jar -O logstash.jar",
-                user=env.deploy_user,
+            jar_url = _artifact_url(
+                "https://download.elasticsearch.org/logstash/logstash/logstash-1.1.7-monolithic.jar"
             )
+            sudo("wget %s -O logstash.jar" % jar_url, user=env.deploy_user)
             print("Ignore any useradd or chgrp warnings below.")
             with settings(warn_only=True):
                 sudo("useradd --system --groups adm logstash")
@@ -2143,8 +3651,11 @@ def install_awslogs():
     _upload_template(template, destination, user="root", context=context)
     with (cd("/tmp")):
         # FIXME: Switch to new (.deb based) CloudWatch agent (ensuring that it picks up all the same log files!)
+        setup_url = _artifact_url(
+            "https://s3.amazonaws.com/aws-cloudwatch/downloads/latest/awslogs-agent-setup.py"
+        )
         sudo(
-            "curl https://s3.amazonaws.com/aws-cloudwatch/downloads/latest/awslogs-agent-setup.py -O",
+            "curl %s -o awslogs-agent-setup.py" % setup_url,
             user=env.deploy_user,
         )
         # This script only supports Python 2.6 - 3.5, so make sure Python 2.7 is installed (any Python 3 version is likely too new)
@@ -2217,6 +3728,7 @@ def resume_autoscaling_processes(deployment_tag, environment, *processes):
 
 @task
 @runs_once
+@recorded
 def create_launch_config_for_deployment(deployment_tag, environment):
     """Create a launch configuration for the deployment code.
 
@@ -2234,15 +3746,120 @@ def create_launch_config_for_deployment(deployment_tag, environment):
 
 
 @task
-def deploy_full(deployment_tag, environment, launch_config_name=None, num_web=2):
+@runs_once
+@recorded
+def create_base_image(deployment_tag, environment):
+    """Create a base image for web servers, for use with ``layered_images``.
+
+    The base image has the operating system, packages, tools, and a
+    bootstrapped virtualenv installed, so that the server created for each
+    deploy's image only needs the code, requirements, and configuration
+    updated. Re-run this periodically to pick up package updates; older base
+    images are deregistered.
+    """
+    executel(environment, deployment_tag)
+    conn = EC2Connection()
+    old_images = conn.get_all_images(
+        owners=["self"],
+        filters={
+            "tag:deployment": env.deployment_tag,
+            "tag:environment": env.environment,
+            "tag:image_type": "base",
+        },
+    )
+    now = datetime.datetime.utcnow().strftime("%Y.%m.%d-%H.%M.%S")
+    server = _retry_new(
+        env.deployment_tag, env.environment, "web", avail_zone=env.avail_zones[0]
+    )[0]
+    try:
+        image = server.create_image(name=_instance_name("web-base", now))
+        image.remove_tag("Name")
+        image.add_tags({"image_type": "base", "base_ami": server.instance.image_id})
+    finally:
+        server.terminate()
+    for old_image in old_images:
+        print("Deregistering old base image {0}.".format(old_image.id))
+        old_image.deregister()
+    print("Created a new base image with id {0}.".format(image.id))
+
+
+def _preflight_worker(changeset):
+    """
+    Updates the worker to the given changeset (see prepare_worker), and shows
+    the upgrade message if there are any migrations to run (or if
+    ``check_migrations`` is disabled) before running them. Returns whether the
+    upgrade message was shown.
+    """
+    if not env.check_migrations:
+        executel("begin_upgrade")
+        executel("deploy_worker", changeset=changeset)
+        return True
+    results = executel("prepare_worker", changeset=changeset) or {}
+    pending = [name for names in results.values() for name in names or []]
+    if pending:
+        print("Migrations to run: {0}".format(", ".join(pending)))
+        executel("begin_upgrade")
+    else:
+        print("No migrations to run; deploying without the upgrade message.")
+    executel("finish_worker")
+    return bool(pending)
+
+
+@contextmanager
+def _upgrade_window(needs_upgrade):
+    """
+    Ends the upgrade message (if it was shown) after the block, and reports
+    how long users saw it, or how much downtime was avoided if it wasn't
+    needed.
+    """
+    start = time.time()
+    with span("upgrade_message" if needs_upgrade else "upgrade_message_avoided"):
+        yield
+        if needs_upgrade:
+            executel("end_upgrade")
+    seconds = time.time() - start
+    if needs_upgrade:
+        print("Users saw the upgrade message for {0:.0f} seconds.".format(seconds))
+    else:
+        print(
+            "Avoided {0:.0f} seconds of downtime, since there were no migrations "
+            "to run.".format(seconds)
+        )
+
+
+@task
+@recorded
+def deploy_full(
+    deployment_tag,
+    environment,
+    launch_config_name=None,
+    num_web=2,
+    blue_green=None,
+    drop_scaling_policies=None,
+):
     """Autoscaling replacement for deploy_full_without_autoscaling.
 
     Performs a full deployment of new code. Users who visit the site during
-    the critical parts of the upgrade will be shown a 503 error message.
+    the critical parts of the upgrade will be shown a 503 error message, unless
+    there are no migrations to run, in which case the new instances replace
+    the old ones without it.
+
+    With ``blue_green`` (or the setting of the same name), the new instances
+    are created in a second autoscaling group, which replaces the current
+    group in the load balancer(s) after the migrations. The current group is
+    kept (suspended) for ``rollback_blue_green``. Scaling policies can't be
+    copied to the new group, so a current group with any is refused unless
+    ``drop_scaling_policies`` is true.
     """
     _check_local_deps()
     executel(environment, deployment_tag)
 
+    if blue_green is None:
+        blue_green = env.blue_green
+    blue_green = str(blue_green).lower() in ("true", "yes", "1")
+    if blue_green:
+        _check_scaling_policies(drop_scaling_policies)
+
     if _is_production(env.environment):
         answer = prompt(
             "Are you sure you want to run a deploy_full in production? "
@@ -2256,6 +3873,10 @@ def deploy_full(deployment_tag, environment, launch_config_name=None, num_web=2)
         launch_config = _create_launch_config()
     else:
         launch_config = _get_launch_config(launch_config_name)
+
+    if blue_green:
+        return _deploy_full_blue_green(launch_config, num_web)
+
     group = _get_autoscaling_group()
 
     # Prevent the group from creating new instances before we're ready.
@@ -2316,105 +3937,754 @@ def deploy_full(deployment_tag, environment, launch_config_name=None, num_web=2)
                 "more.".format(waited, count, curr_minimum - count)
             )
 
-    # Wait to make sure that the encrypted drive is mounted.
-    print(
-        "Waiting 120 seconds for nodes to launch and to ensure that the "
-        "encrypted drive is mounted on all new instances."
-    )
-    time.sleep(120)
-
     # Reload the environment to add the new web servers.
     executel(environment, deployment_tag)
 
-    # Show the upgrade message on all servers, new and old, so that no user
-    # will be able to access the site.
-    executel("begin_upgrade")
+    # Wait to make sure that the new instances have finished booting and that
+    # the encrypted drive is mounted.
+    new_ids = [i.instance_id for i in new_instances]
+    print("Waiting for all new instances to finish launching.")
+    _wait_for_ready([s for s in env.servers["web"] if s.instance.id in new_ids])
 
     # make sure we deploy the same changeset as was used in the launch config
     changeset = launch_config.name.split("_")[-1]
-    executel("deploy_worker", changeset=changeset)
+    set_changeset(changeset)
 
-    # It's safe to add to the load balancer now, since all servers have the
-    # upgrade message.
-    group.resume_processes(["AddToLoadBalancer"])
-    print("Resumed 'AddToLoadBalancer' autoscaling process.")
+    # Show the upgrade message on all servers, new and old, so that no user
+    # will be able to access the site, if there are any migrations to run.
+    needs_upgrade = _preflight_worker(changeset)
+
+    # Remove the upgrade message (if any) at the end of the block so that the
+    # users can access the site again.
+    with _upgrade_window(needs_upgrade):
+        # Warm up the new servers (directly through gunicorn, in case Nginx is
+        # showing the upgrade message) before they get any traffic.
+        if env.warmup_urls:
+            executel(
+                "warm_up",
+                hosts=[
+                    s.hostname for s in env.servers["web"] if s.instance.id in new_ids
+                ],
+            )
 
-    # Even though AddToLoadBalancer has resumed, we must manually add
-    # the just-created instances to the load balancer(s) and wait for them to
-    # be healthy in the load balancer(s).
-    print("Waiting for new instances to be InService with the load balancer(s).")
-    add_all_to_elb()
+        # It's safe to add to the load balancer now, since all servers have the
+        # upgrade message (or there are no migrations for the old code to miss).
+        group.resume_processes(["AddToLoadBalancer"])
+        print("Resumed 'AddToLoadBalancer' autoscaling process.")
 
-    old_instances = [
-        i for i in group.instances if i.launch_config_name != group.launch_config_name
-    ]
+        # Even though AddToLoadBalancer has resumed, we must manually add
+        # the just-created instances to the load balancer(s) and wait for them to
+        # be healthy in the load balancer(s).
+        print("Waiting for new instances to be InService with the load balancer(s).")
+        add_all_to_elb(warm="no")
 
-    # Ensure that the group will kill the oldest servers (in this case, the
-    # servers using the previous launch configuration) first.
-    curr_policies = group.termination_policies
-    group.termination_policies = ["OldestInstance"]
-    group.update()
-    print("Updated the termination policy to 'OldestInstance'.")
+        old_instances = [
+            i
+            for i in group.instances
+            if i.launch_config_name != group.launch_config_name
+        ]
+
+        # Ensure that the group will kill the oldest servers (in this case, the
+        # servers using the previous launch configuration) first.
+        curr_policies = group.termination_policies
+        group.termination_policies = ["OldestInstance"]
+        group.update()
+        print("Updated the termination policy to 'OldestInstance'.")
+
+        # Reset the group's minimum and desired number of servers.
+        group.min_size = curr_minimum
+        group.desired_capacity = curr_desired
+        group.update()
+        print("Reset minimum and desired number of servers.")
+
+        # Wait for the old instances to be killed.
+        for elb_name in env.elb_names:
+            for old_instance in old_instances:
+                print(
+                    "Waiting for {0} to be OutOfService with the load "
+                    "balancer {1}.".format(old_instance.instance_id, elb_name)
+                )
+                _wait_for_elb_state(elb_name, old_instance.instance_id, "OutOfService")
+
+        # Reset the group's termination policies.
+        group.termination_policies = curr_policies
+        group.update()
+        print("Reset the termination policies.")
+
+        # Reload the environment to remove the old web servers.
+        executel(environment, deployment_tag)
+
+
+@timed
+def _wait_for_group_capacity(group_name, count, max_wait=None):
+    """
+    Waits up to ``max_wait`` seconds (by default, ``ready_timeout``) for the
+    given autoscaling group to have at least ``count`` instances in service,
+    and returns the refreshed group.
+    """
+    if max_wait is None:
+        max_wait = int(env.ready_timeout)
+    waited = 0
+    while True:
+        time.sleep(5)
+        waited += 5
+        group = _get_autoscaling_group(group_name)
+        in_service = [i for i in group.instances if i.lifecycle_state == "InService"]
+        if len(in_service) >= count:
+            print("Created {0} new servers in {1} seconds.".format(count, waited))
+            return group
+        if waited >= max_wait:
+            abort(
+                "Autoscaling group {0} has only {1} of {2} instances in service "
+                "after {3} seconds. Check its activity history, and run "
+                "delete_inactive_groups to remove it.".format(
+                    group_name, len(in_service), count, max_wait
+                )
+            )
+        print(
+            "{0} seconds: Have {1} instances and need at least {2} "
+            "more.".format(waited, len(in_service), count - len(in_service))
+        )
 
-    # Reset the group's minimum and desired number of servers.
-    group.min_size = curr_minimum
-    group.desired_capacity = curr_desired
-    group.update()
-    print("Reset minimum and desired number of servers.")
 
-    # Wait for the old instances to be killed.
+@timed
+def _switch_groups(old_group, new_group):
+    """
+    Puts the instances of ``new_group`` in service with the load balancer(s)
+    and takes those of ``old_group`` out of service. ``old_group`` is left
+    running, with all of its processes suspended, so it can be switched back to.
+    """
+    conn = AutoScaleConnection()
+    elb = ELBConnection()
+    old_ids = [i.instance_id for i in old_group.instances]
+    new_ids = [i.instance_id for i in new_group.instances]
     for elb_name in env.elb_names:
-        for old_instance in old_instances:
-            print(
-                "Waiting for {0} to be OutOfService with the load "
-                "balancer {1}.".format(old_instance.instance_id, elb_name)
+        print("Registering {0} with {1}.".format(", ".join(new_ids), elb_name))
+        elb.register_instances(elb_name, new_ids)
+    for elb_name in env.elb_names:
+        for instance_id in new_ids:
+            _wait_for_elb_state(elb_name, instance_id, "InService")
+    # Keep the old group from replacing, rebalancing, or re-registering its
+    # instances while it's out of service.
+    old_group.suspend_processes()
+    if old_ids:
+        for elb_name in env.elb_names:
+            print("Deregistering {0} from {1}.".format(", ".join(old_ids), elb_name))
+            elb.deregister_instances(elb_name, old_ids)
+    new_group.resume_processes()
+    conn.create_or_update_tags(
+        [
+            Tag(
+                key=ACTIVE_GROUP_TAG,
+                value=value,
+                propagate_at_launch=False,
+                resource_id=group.name,
             )
-            _wait_for_elb_state(elb_name, old_instance.instance_id, "OutOfService")
+            for group, value in ((new_group, "true"), (old_group, "false"))
+        ]
+    )
+    # Keep the old group's instances out of the web role, so later deploys
+    # skip them.
+    ec2 = EC2Connection()
+    if old_ids:
+        ec2.create_tags(
+            old_ids, {"role": "web-INACTIVE", "Name": _instance_name("web-INACTIVE")}
+        )
+    ec2.create_tags(new_ids, {"role": "web", "Name": _instance_name("web")})
+    env.active_ag_name = new_group.name
+    print(
+        "Autoscaling group {0} is now in service, replacing {1}.".format(
+            new_group.name, old_group.name
+        )
+    )
+
+
+def _check_scaling_policies(drop_scaling_policies=None):
+    """
+    Aborts if the active autoscaling group has scaling policies, which a
+    blue/green deploy would leave behind, unless ``drop_scaling_policies``
+    is true.
+    """
+    group_name = _active_ag_name()
+    policies = AutoScaleConnection().get_all_policies(as_group=group_name)
+    if not policies:
+        return
+    names = ", ".join(policy.name for policy in policies)
+    if str(drop_scaling_policies).lower() in ("true", "yes", "1"):
+        print(
+            "WARNING: The scaling policies of {0} ({1}) are not copied to the "
+            "new group.".format(group_name, names)
+        )
+        return
+    # boto can't create target tracking policies (like the one in the
+    # CloudFormation stack), nor point the alarms of simple ones at a copy.
+    abort(
+        "Autoscaling group {0} has scaling policies ({1}) that can't be copied "
+        "to a new group. Pass drop_scaling_policies=true to deploy without "
+        "them.".format(group_name, names)
+    )
 
-    # Reset the group's termination policies.
-    group.termination_policies = curr_policies
-    group.update()
-    print("Reset the termination policies.")
+
+def _deploy_full_blue_green(launch_config, num_web):
+    """
+    Performs a full deployment by creating a new autoscaling group with the
+    given launch config, waiting for its instances to boot, and running the
+    migrations before switching the load balancer(s) to the new group.
+    """
+    conn = AutoScaleConnection()
+    old_group = _get_autoscaling_group()
+    desired = old_group.desired_capacity or int(num_web)
+    now = datetime.datetime.utcnow().strftime("%Y.%m.%d-%H.%M.%S")
+    group = AutoScalingGroup(
+        name="%s-%s" % (env.ag_name, now),
+        launch_config=launch_config.name,
+        availability_zones=old_group.availability_zones,
+        vpc_zone_identifier=old_group.vpc_zone_identifier,
+        load_balancers=old_group.load_balancers,
+        default_cooldown=old_group.default_cooldown,
+        health_check_type=old_group.health_check_type,
+        health_check_period=old_group.health_check_period,
+        termination_policies=old_group.termination_policies,
+        min_size=0,
+        max_size=max(old_group.max_size, desired),
+        desired_capacity=0,
+    )
+    conn.create_auto_scaling_group(group)
+    print("Created autoscaling group {0}.".format(group.name))
+    _tag_autoscaling_group(group.name)
+
+    # Launch the new instances, but don't add them to the load balancer(s)
+    # until we switch over.
+    new_group = _get_autoscaling_group(group.name)
+    new_group.suspend_processes(["AddToLoadBalancer"])
+    new_group.min_size = min(old_group.min_size, desired)
+    new_group.desired_capacity = desired
+    new_group.update()
+    print("Waiting for {0} new instances to be in service.".format(desired))
+    new_group = _wait_for_group_capacity(new_group.name, desired)
+
+    # Reload the environment to add the new web servers, and wait for them to
+    # finish booting.
+    executel(env.environment, env.deployment_tag)
+    new_ids = [i.instance_id for i in new_group.instances]
+    _wait_for_ready([s for s in env.servers["web"] if s.instance.id in new_ids])
+
+    # Only the migrations run while users see the upgrade message (if there
+    # are any to run).
+    changeset = launch_config.name.split("_")[-1]
+    set_changeset(changeset)
+    needs_upgrade = _preflight_worker(changeset)
+    # Remove the upgrade message from all servers, including the old ones, so
+    # they're ready to be switched back to.
+    with _upgrade_window(needs_upgrade):
+        if env.warmup_urls:
+            executel(
+                "warm_up",
+                hosts=[
+                    s.hostname for s in env.servers["web"] if s.instance.id in new_ids
+                ],
+            )
+        _switch_groups(_get_autoscaling_group(old_group.name), new_group)
 
     # Reload the environment to remove the old web servers.
+    executel(env.environment, env.deployment_tag)
+    print(
+        "Completed blue/green deployment. Run rollback_blue_green to switch "
+        "back to {0}, or delete_inactive_groups to remove it.".format(old_group.name)
+    )
+
+
+@task
+@runs_once
+@recorded
+def rollback_blue_green(deployment_tag, environment):
+    """Switch the load balancer(s) back to the previous autoscaling group.
+
+    Reverses the last blue/green ``deploy_full``. Note that the old code will
+    run against the database as migrated by that deploy.
+    """
+    executel(environment, deployment_tag)
+    current = _get_autoscaling_group()
+    previous = [
+        group
+        for group in _autoscaling_groups()
+        if group.name != current.name and group.instances
+    ]
+    if not previous:
+        abort("No previous autoscaling group with running instances found.")
+    # group names created by blue/green deploys end in a timestamp
+    previous = sorted(previous, key=lambda group: group.name)[-1]
+    _switch_groups(current, previous)
     executel(environment, deployment_tag)
 
-    # Remove the upgrade message so that the users can access the site again.
-    executel("end_upgrade")
+
+@task
+@runs_once
+def delete_inactive_groups(deployment_tag, environment):
+    """Delete the autoscaling groups replaced by blue/green deploys.
+
+    Terminates their instances, after which they can no longer be switched
+    back to with ``rollback_blue_green``. The configured group (``ag_name``)
+    belongs to the CloudFormation stack, so it is only scaled down to zero
+    instances, and left suspended, instead.
+    """
+    executel(environment, deployment_tag)
+    active_name = _active_ag_name()
+    groups = [group for group in _autoscaling_groups() if group.name != active_name]
+    if not groups:
+        print("No inactive autoscaling groups found.")
+        return
+    names = ", ".join(group.name for group in groups)
+    answer = prompt(
+        "Delete {0} and terminate their instances (y/N)? ".format(names), default="n"
+    )
+    if not answer.lower().startswith("y"):
+        abort("Not deleting autoscaling groups.")
+    conn = AutoScaleConnection()
+    for group in groups:
+        if group.name == env.ag_name:
+            # Keep the old group from launching replacements (or re-registering
+            # them) while it's scaled down.
+            group.suspend_processes()
+            group.min_size = 0
+            group.desired_capacity = 0
+            group.update()
+            instance_ids = [i.instance_id for i in group.instances]
+            if instance_ids:
+                EC2Connection().terminate_instances(instance_ids)
+            print(
+                "Scaled autoscaling group {0} down to 0 instances.".format(group.name)
+            )
+            continue
+        conn.delete_auto_scaling_group(group.name, force_delete=True)
+        print("Deleted autoscaling group {0}.".format(group.name))
 
 
 @task
 @runs_once
-def deploy_serial(deployment_tag, environment, launch_config_name=None, answer=None):
+@recorded
+def deploy_serial(
+    deployment_tag,
+    environment,
+    launch_config_name=None,
+    answer=None,
+    max_unavailable=None,
+    min_healthy=None,
+    canary_window=None,
+):
     """Autoscaling replacement for deploy_serial_without_autoscaling.
 
     Safely deploy to the specified environment with no downtime, by updating
     the existing autoscaling group to use a new launch configuration, killing
-    off old instances one by one, and allowing the autoscaling group to bring
+    off old instances in waves, and allowing the autoscaling group to bring
     up new instances as needed.
+
+    Each wave retires up to ``max_unavailable`` old instances (a count, or a
+    percentage of the group's desired capacity such as ``25%``), as long as
+    at least ``min_healthy`` instances (also a count or percentage) stay in
+    service. They default to the ``rolling_max_unavailable`` and
+    ``rolling_min_healthy`` settings, i.e., one instance at a time.
+
+    If ``canary_window`` (or the setting of the same name) is a number of
+    seconds, a single new instance first serves traffic for that long, and
+    the deploy is rolled back if its latency or error rate is worse than the
+    old instances'.
     """
     _check_local_deps()
     executel(environment, deployment_tag, answer=answer)
 
-    if not launch_config_name:
-        launch_config = _create_launch_config()
+    # pin the changeset up front, so that the image can be created while the
+    # worker is deployed
+    changeset = None if launch_config_name else _resolve_changeset()
+    if changeset:
+        set_changeset(changeset)
+        launch_config = _deploy_worker_during_bake(changeset)
     else:
-        launch_config = _get_launch_config(launch_config_name)
-
-    # make sure we deploy the same changeset as was used in the launch config
-    changeset = launch_config.name.split("_")[-1]
-    executel("deploy_worker", changeset=changeset)
+        if not launch_config_name:
+            launch_config = _create_launch_config()
+        else:
+            launch_config = _get_launch_config(launch_config_name)
+        # make sure we deploy the same changeset as was used in the launch config
+        changeset = launch_config.name.split("_")[-1]
+        set_changeset(changeset)
+        executel("deploy_worker", changeset=changeset)
 
     # Update the existing autoscaling group to use the new launch config.
+    previous_launch_config_name = _get_autoscaling_group().launch_config_name
     autoscaling_group = _update_autoscaling_group(launch_config)
 
-    # Bring down each old instance in turn and allow the autoscaling group to
-    # recreate it (if needed) using the new launch config.
-    _refresh_instances(autoscaling_group)
+    # With warm-up URLs, new instances are warmed up and added to the load
+    # balancer(s) by _wait_for_replacements instead of the autoscaling group.
+    if env.warmup_urls:
+        autoscaling_group.suspend_processes(["AddToLoadBalancer"])
+        print("Suspended 'AddToLoadBalancer' autoscaling process.")
+    try:
+        if canary_window is None:
+            canary_window = env.canary_window
+        if int(canary_window):
+            autoscaling_group = _run_canary(
+                autoscaling_group, previous_launch_config_name, int(canary_window)
+            )
+
+        # Bring down the old instances in waves and allow the autoscaling group
+        # to recreate them (if needed) using the new launch config.
+        if max_unavailable is None:
+            max_unavailable = env.rolling_max_unavailable
+        if min_healthy is None:
+            min_healthy = env.rolling_min_healthy
+        _refresh_instances(autoscaling_group, max_unavailable, min_healthy)
+    finally:
+        if env.warmup_urls:
+            autoscaling_group = _get_autoscaling_group()
+            autoscaling_group.resume_processes(["AddToLoadBalancer"])
+            print("Resumed 'AddToLoadBalancer' autoscaling process.")
+            # Resuming the process doesn't add the instances launched while
+            # it was suspended (if the deploy stopped before warming them up).
+            _register_group_instances(autoscaling_group)
 
     print("Completed deployment with autoscaling.")
 
 
+@task
+@runs_once
+def deploy_report(deployment_tag, environment, run_id=None, compare=5):
+    """Show the timeline of the latest (or given) deploy run.
+
+    Prints a Gantt-style timeline of the recorded steps, the critical path,
+    and how long each step took compared to the last ``compare`` successful
+    runs of the same task in this environment.
+    """
+    timeline_report(deployment_tag, environment, run_id=run_id, compare=compare)
+
+
+def _plan_changes():
+    """
+    Returns the deployed changeset, the changeset that would be deployed, and
+    the files that differ between them, as seen from the worker (or Nones if
+    there's no worker or the repo isn't git).
+    """
+    new = _resolve_changeset()
+    if new is None:
+        return None, None, None
+    with settings(host_string=env.servers["worker"][0].hostname):
+        current = current_changeset()
+        with cd(env.code_root), hide("stdout"):
+            files = sudo(
+                "git diff --name-only %s %s" % (current, new), user=env.deploy_user
+            ).split()
+    return current, new, files
+
+
+def _plan_image(launch_config_name, changeset):
+    """
+    Returns a description of where the launch config will come from, and
+    whether a new image would be baked for it.
+    """
+    if launch_config_name:
+        return "Use the existing launch config %s." % launch_config_name, False
+    if env.reuse_images:
+        key = _image_cache_key(changeset)
+        image = _find_cached_image(key) if key else None
+        if image is not None:
+            return "Reuse the existing image %s for this code." % image.id, False
+    if env.layered_images and _find_base_image() is not None:
+        return "Bake a new image and launch config from the base image.", True
+    return "Bake a new image and launch config from scratch.", True
+
+
+def _plan_deploy_serial(
+    changeset,
+    files,
+    launch_config_name=None,
+    max_unavailable=None,
+    min_healthy=None,
+    canary_window=None,
+    **kwargs,
+):
+    """Returns the notes and steps of a deploy_serial plan."""
+    group = _get_autoscaling_group()
+    description, bake = _plan_image(launch_config_name, changeset)
+    notes = [description]
+    steps = []
+    if bake:
+        steps.append(
+            (
+                description,
+                [("create_image_from_server", None), ("new_launch_config", None)],
+                False,
+            )
+        )
+    steps.append(
+        (
+            "Deploy the worker (and run any migrations)",
+            [("deploy_worker", None)],
+            bake and changeset is not None,
+        )
+    )
+    if canary_window is None:
+        canary_window = env.canary_window
+    if int(canary_window):
+        steps.append(
+            (
+                "Run a canary instance for %s seconds" % canary_window,
+                [("run_canary", None)],
+                False,
+            )
+        )
+    capacity = group.desired_capacity or len(group.instances)
+    if max_unavailable is None:
+        max_unavailable = env.rolling_max_unavailable
+    if min_healthy is None:
+        min_healthy = env.rolling_min_healthy
+    wave_size = max(1, _instance_count(max_unavailable, capacity))
+    count = len(group.instances)
+    waves = -(-count // wave_size)
+    notes.append(
+        "Cycle all {0} instances of {1}, in {2} waves of up to {3}, keeping at "
+        "least {4} healthy.".format(
+            count, group.name, waves, wave_size, _instance_count(min_healthy, capacity)
+        )
+    )
+    steps.append(
+        (
+            "Replace %s instances in %s waves" % (count, waves),
+            [
+                ("wait_for_elb_state", count),
+                ("wait_for_ag_termination", waves),
+                ("wait_for_replacements", waves),
+            ],
+            False,
+        )
+    )
+    return notes, steps
+
+
+def _plan_deploy_full(
+    changeset,
+    files,
+    launch_config_name=None,
+    num_web=2,
+    blue_green=None,
+    drop_scaling_policies=None,
+    **kwargs,
+):
+    """Returns the notes and steps of a deploy_full plan."""
+    group = _get_autoscaling_group()
+    description, bake = _plan_image(launch_config_name, changeset)
+    notes = [description]
+    steps = []
+    if bake:
+        steps.append(
+            (
+                description,
+                [("create_image_from_server", None), ("new_launch_config", None)],
+                False,
+            )
+        )
+    if blue_green is None:
+        blue_green = env.blue_green
+    blue_green = str(blue_green).lower() in ("true", "yes", "1")
+    if blue_green and AutoScaleConnection().get_all_policies(as_group=group.name):
+        if str(drop_scaling_policies).lower() in ("true", "yes", "1"):
+            notes.append(
+                "The new group won't have the scaling policies of {0}.".format(
+                    group.name
+                )
+            )
+        else:
+            notes.append(
+                "{0} has scaling policies, so the deploy will stop (pass "
+                "drop_scaling_policies=true to deploy without them).".format(group.name)
+            )
+    count = group.desired_capacity or int(num_web)
+    steps.append(
+        (
+            "Launch %s new instances%s"
+            % (count, " in a new autoscaling group" if blue_green else ""),
+            [("wait_for_group_capacity", None), ("wait_for_ready", None)],
+            False,
+        )
+    )
+    if files is not None:
+        migrations = [f for f in files if "/migrations/" in "/" + f]
+        if migrations:
+            notes.append(
+                "Users will see the upgrade message while the migrations run "
+                "({0} migration files changed).".format(len(migrations))
+            )
+        elif env.check_migrations:
+            notes.append(
+                "No migration files changed, so the upgrade message should be "
+                "skipped."
+            )
+    steps.append(
+        (
+            "Deploy the worker (and run any migrations)",
+            [
+                ("deploy_worker", None),
+                ("prepare_worker", None),
+                ("finish_worker", None),
+            ],
+            False,
+        )
+    )
+    if blue_green:
+        steps.append(
+            (
+                "Switch the load balancer(s) to the new group",
+                [("switch_groups", None)],
+                False,
+            )
+        )
+    else:
+        notes.append(
+            "Retire all {0} current instances of {1}.".format(
+                len(group.instances), group.name
+            )
+        )
+        steps.append(
+            (
+                "Put the new instances in service and retire %s old ones"
+                % len(group.instances),
+                [("wait_for_elb_state", len(group.instances))],
+                False,
+            )
+        )
+    return notes, steps
+
+
+def _plan_recreate_servers(changeset, files, **kwargs):
+    """Returns the notes and steps of a recreate_servers plan."""
+    counts = dict((role, len(servers)) for role, servers in env.servers.items())
+    notes = [
+        "Replace the servers: %s."
+        % ", ".join("%s %s" % (count, role) for role, count in sorted(counts.items()))
+    ]
+    return notes, [
+        ("Create the web image server", [("retry_new", 1)], False),
+        (
+            "Create the new primary and %s cache server(s)" % counts.get("cache", 0),
+            [("retry_new", 1)],
+            True,
+        ),
+        (
+            "Promote the new primary (with the upgrade message)",
+            [
+                ("begin_upgrade", None),
+                ("promote_replica", None),
+                ("update_local_settings", None),
+                ("end_upgrade", None),
+            ],
+            False,
+        ),
+        (
+            "Create %s replica(s) and the worker" % counts.get("db-replica", 0),
+            [("retry_new", 1)],
+            False,
+        ),
+        (
+            "Create the image and launch config",
+            [("create_image_from_server", None), ("new_launch_config", None)],
+            False,
+        ),
+        (
+            "Replace %s web servers with deploy_serial" % counts.get("web", 0),
+            [("deploy_serial", None)],
+            False,
+        ),
+    ]
+
+
+def _format_duration(seconds):
+    if seconds < 120:
+        return "%.0fs" % seconds
+    return "%.0fm" % (seconds / 60)
+
+
+def _print_plan(command, notes, steps):
+    """
+    Prints the given plan, estimating each step from the median durations of
+    the spans it covers in previous runs of the command in this environment.
+    Steps may overlap the previous step (i.e., run at the same time).
+    """
+    estimates = timeline_estimates(command, env.deployment_tag, env.environment)
+    print("")
+    print(
+        "Plan for {0} on {1}/{2} (nothing has been changed):".format(
+            command, env.deployment_tag, env.environment
+        )
+    )
+    for note in notes:
+        print("  * %s" % note)
+    print("")
+    total = 0
+    previous = 0
+    for number, (description, names, overlaps) in enumerate(steps, 1):
+        seconds = None
+        for name, count in names:
+            if name in estimates:
+                per_run, per_call = estimates[name]
+                seconds = (seconds or 0) + (per_call * count if count else per_run)
+        if seconds is None:
+            estimate = "unknown"
+        else:
+            estimate = _format_duration(seconds)
+            total += max(seconds - previous, 0) if overlaps else seconds
+            previous = seconds
+        suffix = " (at the same time)" if overlaps else ""
+        print("  {0}. {1:<65} {2:>8}".format(number, description + suffix, estimate))
+    print("")
+    if command in estimates:
+        print(
+            "Estimated total: {0} (median of previous runs; {1} for the steps "
+            "above).".format(
+                _format_duration(estimates[command][0]), _format_duration(total)
+            )
+        )
+    elif total:
+        print("Estimated total: at least {0}.".format(_format_duration(total)))
+    else:
+        print(
+            "No previous runs of {0} were recorded for this environment, so there "
+            "are no estimates.".format(command)
+        )
+
+
+@task
+@runs_once
+def plan(command, deployment_tag, environment, **kwargs):
+    """Show what deploy_serial, deploy_full, or recreate_servers would do.
+
+    Lists the steps the given command would take with the given arguments
+    (e.g., ``plan:deploy_serial,myproject,production,max_unavailable=2``),
+    based on the current servers and autoscaling group, with estimates from
+    the previous runs recorded for this environment. Nothing is changed.
+    """
+    planners = {
+        "deploy_serial": _plan_deploy_serial,
+        "deploy_full": _plan_deploy_full,
+        "recreate_servers": _plan_recreate_servers,
+    }
+    if command not in planners:
+        abort("Choose a command to plan: %s" % ", ".join(sorted(planners)))
+    _setup_env(deployment_tag, environment)
+    current, new, files = _plan_changes()
+    if files is None:
+        general = ["Unable to compare the new code with the deployed code."]
+    else:
+        static = [f for f in files if "/static/" in "/" + f]
+        general = [
+            "Deploy {0} (currently {1}): {2} files changed.".format(
+                new[:12], current[:12], len(files)
+            ),
+            "Requirements changed: %s."
+            % ("yes" if env.requirements_file in files else "no"),
+            "Static files changed: %s." % (len(static) if static else "no"),
+        ]
+    notes, steps = planners[command](new, files, **kwargs)
+    _print_plan(command, general + notes, steps)
+
+
 def _ag_instances(autoscaling_group, current=True):
     """
     Returns a list of instances in the specified autoscaling group. If
@@ -2445,82 +4715,425 @@ def _ag_inst_states(autoscaling_group):
     return instances
 
 
-def _refresh_instances(autoscaling_group):
+def _instance_count(value, total):
+    """
+    Converts ``value``, either a number of instances or a percentage of
+    ``total`` (e.g., ``"25%"``), to a number of instances.
+    """
+    value = str(value).strip()
+    if value.endswith("%"):
+        return int(total * float(value[:-1]) / 100)
+    return int(value)
+
+
+def _ag_healthy_count(autoscaling_group):
+    """
+    Returns the number of instances in the autoscaling group (old or current)
+    that are in service with every load balancer.
+    """
+    return len(
+        [
+            inst
+            for inst in autoscaling_group.instances
+            if all(
+                _elb_state(elb_name, inst.instance_id) == "InService"
+                for elb_name in env.elb_names
+            )
+        ]
+    )
+
+
+@timed
+def _wait_for_replacements(expected):
+    """
+    Waits for the autoscaling group to have at least ``expected`` instances
+    using the current launch config, and for all of them to be in service with
+    the load balancer(s). Returns the refreshed autoscaling group.
+    """
+    max_inst_create_time = 180  # seconds
+    check_period = 5  # seconds
+    for i in range(int(max_inst_create_time / check_period)):
+        time.sleep(check_period)
+        autoscaling_group = _get_autoscaling_group()  # Refresh instances list.
+        # (If we had more-than-the minimum instances before the upgrade, then
+        # the autoscaling group might not bring up replacements immediately.)
+        count = len(_ag_instances(autoscaling_group, current=True))
+        print(
+            "Checking for new instances: have {0}, expecting {1}.".format(
+                count, expected
+            )
+        )
+        if count >= expected:
+            break
+    else:
+        print(
+            "WARNING: only %s of %s new instances detected after %s seconds"
+            % (count, expected, max_inst_create_time)
+        )
+    if env.warmup_urls:
+        # AddToLoadBalancer is suspended (see deploy_serial), so warm up the
+        # new instances and add them to the load balancer(s) ourselves.
+        autoscaling_group = _warm_up_replacements(autoscaling_group)
+    # Wait for all instances currently known to the auto scaling group to be in
+    # service with each load balancer. We may get 400 Bad Request / Could not find
+    # instance responses while this is in process.
+    inst_states = _ag_inst_states(autoscaling_group)
+    while not all([(s == "InService") for s in inst_states.values()]):
+        print("Waiting for the following instances to be in service:")
+        for k, v in inst_states.items():
+            if v != "InService":
+                print("    %s: %s" % k)  # k is tuple of (elb_name, instance_id)
+        time.sleep(10)
+        # refresh instance states
+        autoscaling_group = _get_autoscaling_group()  # Refresh instances list.
+        inst_states = _ag_inst_states(autoscaling_group)
+    return autoscaling_group
+
+
+def _warm_up_replacements(autoscaling_group, max_wait=None):
+    """
+    Waits up to ``max_wait`` seconds (by default, ``ready_timeout``) for the
+    instances using the current launch config to launch, warms up those that
+    aren't in service with the load balancer(s) yet, and adds them to the
+    load balancer(s). Returns the refreshed autoscaling group.
+    """
+    if max_wait is None:
+        max_wait = int(env.ready_timeout)
+    waited = 0
+    while True:
+        launching = [
+            i.instance_id
+            for i in _ag_instances(autoscaling_group, current=True)
+            if i.lifecycle_state != "InService"
+        ]
+        if not launching:
+            break
+        if waited >= max_wait:
+            abort(
+                "Instance(s) %s still not in service after %s seconds; check the "
+                "autoscaling group's activity history."
+                % (", ".join(sorted(launching)), max_wait)
+            )
+        time.sleep(5)
+        waited += 5
+        autoscaling_group = _get_autoscaling_group()
+    cold_ids = sorted(
+        set(
+            inst_id
+            for (elb_name, inst_id), state in _ag_inst_states(autoscaling_group).items()
+            if state != "InService"
+        )
+    )
+    if not cold_ids:
+        return autoscaling_group
+    servers = _get_servers(
+        env.deployment_tag, env.environment, "web", instance_ids=cold_ids
+    )
+    _wait_for_ready(servers)
+    executel("warm_up", hosts=[s.hostname for s in servers])
+    elb_conn = ELBConnection()
+    for elb_name in env.elb_names:
+        elb_conn.register_instances(elb_name, cold_ids)
+        print("Added {0} to ELB {1}.".format(", ".join(cold_ids), elb_name))
+    return autoscaling_group
+
+
+def _register_group_instances(autoscaling_group):
+    """
+    Registers the autoscaling group's in-service instances that are missing
+    from the load balancer(s).
+    """
+    instance_ids = set(
+        i.instance_id
+        for i in autoscaling_group.instances
+        if i.lifecycle_state == "InService"
+    )
+    if not instance_ids:
+        return
+    elb_conn = ELBConnection()
+    for elb_name in env.elb_names:
+        registered = set(
+            state.instance_id for state in elb_conn.describe_instance_health(elb_name)
+        )
+        missing = sorted(instance_ids - registered)
+        if missing:
+            elb_conn.register_instances(elb_name, missing)
+            print("Added {0} to ELB {1}.".format(", ".join(missing), elb_name))
+
+
+@timed
+def _wait_for_ag_termination(group_name, instance_ids, max_wait=300):
+    """
+    Waits for the autoscaling group's activity history to show that it has
+    started terminating (and hence replacing) each of the given instances.
+    """
+    conn = AutoScaleConnection()
+    pending = set(instance_ids)
+    waited = 0
+    while True:
+        for activity in conn.get_all_activities(group_name, max_records=50):
+            if activity.description.startswith("Terminating"):
+                pending = set(i for i in pending if i not in activity.description)
+        if not pending:
+            print(
+                "Autoscaling group is replacing the instances after %s seconds."
+                % waited
+            )
+            return
+        if waited >= max_wait:
+            print(
+                "WARNING: autoscaling group hasn't started terminating %s after %s "
+                "seconds" % (", ".join(sorted(pending)), max_wait)
+            )
+            return
+        time.sleep(5)
+        waited += 5
+
+
+def _refresh_instances(autoscaling_group, max_unavailable=1, min_healthy=0):
     """
-    Brings down each non-current instance in turn and allows the autoscaling
-    group to recreate it (if needed) using the current configuration.
+    Brings down the non-current instances in waves of up to ``max_unavailable``
+    instances, keeping at least ``min_healthy`` instances in service, and
+    allows the autoscaling group to recreate them (if needed) using the current
+    configuration. Both limits may be counts or percentages of the group's
+    desired capacity.
     """
     conn = AutoScaleConnection()
 
     # NOTE: It takes longer for the load balancer(s) to finish bringing down/up
-    # instances than it does for the autoscaling group, so for each server we
+    # instances than it does for the autoscaling group, so for each wave we
     # check the status according to the load balancer(s) before moving on to the
     # next.
-    max_inst_create_time = 180  # seconds
-    check_period = 5  # seconds
+    capacity = autoscaling_group.desired_capacity or len(autoscaling_group.instances)
+    wave_size = max(1, _instance_count(max_unavailable, capacity))
+    min_healthy = _instance_count(min_healthy, capacity)
     old_instances = _ag_instances(autoscaling_group, current=False)
-    print("Found {0} old instances.".format(len(old_instances)))
-    for old_instance in old_instances:
+    print(
+        "Found {0} old instances; retiring up to {1} at a time while keeping at "
+        "least {2} healthy.".format(len(old_instances), wave_size, min_healthy)
+    )
+    retired = 0
+    while old_instances:
+        size = min(wave_size, len(old_instances))
+        if min_healthy:
+            # with no minimum, don't require any instances to be in service
+            # (e.g., when they're all failing)
+            healthy = _ag_healthy_count(autoscaling_group)
+            size = min(size, healthy - min_healthy)
+        if size < 1:
+            abort(
+                "Cannot retire any more instances without going below {0} healthy "
+                "instances (currently {1}).".format(min_healthy, healthy)
+            )
+        wave, old_instances = old_instances[:size], old_instances[size:]
+        wave_ids = [old_instance.instance_id for old_instance in wave]
+        print("Starting to bring down old instances: {0}.".format(", ".join(wave_ids)))
+        for instance_id in wave_ids:
+            conn.set_instance_health(instance_id, "Unhealthy")
+        for instance_id in wave_ids:
+            for elb_name in env.elb_names:
+                print(
+                    "Waiting for {0} to be out of service with load balancer {1}. "
+                    "Note: ignore any 'InvalidInstance' errors.".format(
+                        instance_id, elb_name
+                    )
+                )
+                _wait_for_elb_state(elb_name, instance_id, "OutOfService")
         print(
-            "Starting to bring down old instance with id {0}.".format(
-                old_instance.instance_id
+            "{0} now out of service. Waiting for autoscaling group...".format(
+                ", ".join(wave_ids)
             )
         )
-        conn.set_instance_health(old_instance.instance_id, "Unhealthy")
-        for elb_name in env.elb_names:
-            print(
-                "Waiting for {0} to be out of service with load balancer {1}. "
-                "Note: ignore any 'InvalidInstance' errors.".format(
-                    old_instance.instance_id, elb_name
+        # Wait for the autoscaling group to catch up.
+        _wait_for_ag_termination(autoscaling_group.name, wave_ids)
+        retired += size
+        autoscaling_group = _wait_for_replacements(min(retired, capacity))
+        print("Finished bringing down old instances: {0}.".format(", ".join(wave_ids)))
+    print("All old instances have been terminated.")
+
+
+# logstash_fmt (see nginx.conf), from the status onward
+TIMING_LOG_RE = re.compile(
+    r'^\S+ \S+ \S+ \[[^\]]*\] "(?P<request>[^"]*)" (?P<status>\d{3}) \S+ "[^"]*" '
+    r'"[^"]*" \S+ (?P<request_time>[\d.]+)$'
+)
+
+
+def _timing_log_size(server):
+    """
+    Returns the current size of the timing log on the given server, or None
+    if the server doesn't write one.
+    """
+    with settings(host_string=server.hostname, warn_only=True), hide(
+        "running", "stdout"
+    ):
+        size = sudo("stat -c %%s %s" % env.timing_log)
+    if size.failed:
+        return None
+    return int(size.strip())
+
+
+def _timing_log_stats(servers, offsets):
+    """
+    Returns the number of requests, the p50/p95/p99 request times, and the 5xx
+    rate logged by the given servers since the given timing log offsets,
+    excluding load balancer health checks.
+    """
+    times = []
+    errors = 0
+    for server in servers:
+        with settings(host_string=server.hostname), hide("running", "stdout"):
+            output = sudo(
+                "tail -c +%d %s" % (offsets[server.instance.id] + 1, env.timing_log)
+            )
+        for line in output.splitlines():
+            match = TIMING_LOG_RE.match(line.strip())
+            if not match or "/healthcheck.html" in match.group("request"):
+                continue
+            times.append(float(match.group("request_time")))
+            if match.group("status").startswith("5"):
+                errors += 1
+    times.sort()
+    stats = {"requests": len(times), "error_rate": 0.0}
+    for percentile in (50, 95, 99):
+        stats["p%s" % percentile] = 0.0
+        if times:
+            index = int(round(percentile / 100.0 * len(times))) - 1
+            stats["p%s" % percentile] = times[max(index, 0)]
+    if times:
+        stats["error_rate"] = errors / float(len(times))
+    return stats
+
+
+def _canary_failures(canary, baseline):
+    """
+    Returns a list of reasons the canary's stats are unacceptable compared to
+    the baseline (old instances') stats.
+    """
+    failures = []
+    max_increase = 1 + float(env.canary_max_latency_increase)
+    for name in ("p50", "p95", "p99"):
+        if canary[name] > baseline[name] * max_increase:
+            failures.append(
+                "{0} request time of {1:.3f}s vs {2:.3f}s".format(
+                    name, canary[name], baseline[name]
                 )
             )
-            _wait_for_elb_state(elb_name, old_instance.instance_id, "OutOfService")
+    max_error_rate = baseline["error_rate"] + float(env.canary_max_error_rate_increase)
+    if canary["error_rate"] > max_error_rate:
+        failures.append(
+            "5xx rate of {0:.2%} vs {1:.2%}".format(
+                canary["error_rate"], baseline["error_rate"]
+            )
+        )
+    return failures
+
+
+@timed
+def _run_canary(autoscaling_group, previous_launch_config_name, window):
+    """
+    Adds a single instance using the group's (new) launch config, lets it serve
+    traffic for ``window`` seconds, and compares its request times and error
+    rate with the old instances'. If it's worse, rolls the group back to the
+    previous launch config and aborts; otherwise, retires one old instance to
+    make room for it. Returns the refreshed autoscaling group.
+    """
+    conn = AutoScaleConnection()
+    old_ids = [i.instance_id for i in _ag_instances(autoscaling_group, current=False)]
+    if not old_ids:
+        print("No old instances to compare a canary with; skipping the canary.")
+        return autoscaling_group
+    old_servers = _get_servers(
+        env.deployment_tag, env.environment, "web", instance_ids=old_ids
+    )
+    old_offsets = dict((s.instance.id, _timing_log_size(s)) for s in old_servers)
+    if None in old_offsets.values():
         print(
-            "{0} is now out of service. Waiting for autoscaling group...".format(
-                old_instance.instance_id
-            )
-        )
-        time.sleep(45)  # Wait for the autoscaling group to catch up.
-        # This time amount is just a guess - it seems to take
-        # that long for the group to decide whether or not to
-        # make a new instance, and the load balancer(s) to see it.
-        # Effective 5/21/15, this was changed from 30 to 45 because
-        # 30 didn't seem to be long enough.
-        # If this is the first instance we're adding, make sure at least one new
-        # one comes up before continuing.
-        for i in range(int(max_inst_create_time / check_period)):
-            time.sleep(check_period)
-            autoscaling_group = _get_autoscaling_group()  # Refresh instances list.
-            # Wait for a new instance, if any, to be fully brought up.
-            # (If we had more-than-the minimum instances before the upgrade, then
-            # the autoscaling group might not bring up another immediately.)
-            print("Checking for any new instances to be in service...")
-            if _ag_instances(autoscaling_group, current=True):
-                break
-        else:
+            "WARNING: The old instances don't have a timing log (which is enabled "
+            "by the canary_window setting); skipping the canary."
+        )
+        return autoscaling_group
+
+    # Keep scaling policies from changing the group while the canary runs.
+    processes = ["AlarmNotification", "ScheduledActions"]
+    autoscaling_group.suspend_processes(processes)
+    curr_desired = autoscaling_group.desired_capacity
+    curr_maximum = autoscaling_group.max_size
+    try:
+        autoscaling_group.desired_capacity = curr_desired + 1
+        autoscaling_group.max_size = max(curr_maximum, curr_desired + 1)
+        autoscaling_group.update()
+        print("Launching a canary instance with the new launch config.")
+        autoscaling_group = _wait_for_replacements(1)
+        canary_id = _ag_instances(autoscaling_group, current=True)[0].instance_id
+        canary = _get_servers(
+            env.deployment_tag, env.environment, "web", instance_ids=[canary_id]
+        )[0]
+        # only compare requests served while the canary is in service
+        offsets = dict((s.instance.id, _timing_log_size(s)) for s in old_servers)
+        offsets[canary_id] = _timing_log_size(canary) or 0
+        print(
+            "Canary {0} is in service; comparing it with the old instances for "
+            "{1} seconds...".format(canary_id, window)
+        )
+        time.sleep(window)
+        canary_stats = _timing_log_stats([canary], offsets)
+        baseline_stats = _timing_log_stats(old_servers, offsets)
+        for label, stats in (("Canary", canary_stats), ("Old", baseline_stats)):
+            print(
+                "{0} instances: {1} requests, p50 {2:.3f}s, p95 {3:.3f}s, "
+                "p99 {4:.3f}s, 5xx rate {5:.2%}".format(
+                    label,
+                    stats["requests"],
+                    stats["p50"],
+                    stats["p95"],
+                    stats["p99"],
+                    stats["error_rate"],
+                )
+            )
+        failures = []
+        if min(canary_stats["requests"], baseline_stats["requests"]) < int(
+            env.canary_min_requests
+        ):
             print(
-                "WARNING: no new instances detected after %s seconds"
-                % max_inst_create_time
+                "WARNING: Too few requests to judge the canary (fewer than {0}); "
+                "continuing the deploy.".format(env.canary_min_requests)
             )
-        # Wait for all instances currently known to the auto scaling group to be in
-        # service with each load balancer. We may get 400 Bad Request / Could not find
-        # instance responses while this is in process.
-        inst_states = _ag_inst_states(autoscaling_group)
-        while not all([(s == "InService") for s in inst_states.values()]):
-            print("Waiting for the following instances to be in service:")
-            for k, v in inst_states.items():
-                if v != "InService":
-                    print("    %s: %s" % k)  # k is tuple of (elb_name, instance_id)
-            time.sleep(10)
-            # refresh instance states
-            autoscaling_group = _get_autoscaling_group()  # Refresh instances list.
-            inst_states = _ag_inst_states(autoscaling_group)
-        print(
-            "Finished bringing down old instance with id {0}.".format(
-                old_instance.instance_id
+        else:
+            failures = _canary_failures(canary_stats, baseline_stats)
+        if failures:
+            print(
+                "Canary failed; rolling back to {0}.".format(
+                    previous_launch_config_name
+                )
             )
+            _update_autoscaling_group(_get_launch_config(previous_launch_config_name))
+            conn.terminate_instance(canary_id, decrement_capacity=True)
+            for elb_name in env.elb_names:
+                _wait_for_elb_state(elb_name, canary_id, "OutOfService")
+            abort("Canary {0} regressed: {1}.".format(canary_id, "; ".join(failures)))
+        # Make room for the canary by retiring an old instance, preferably in
+        # the canary's availability zone to keep the group balanced.
+        canary_zone = [
+            i.availability_zone
+            for i in autoscaling_group.instances
+            if i.instance_id == canary_id
+        ][0]
+        old_instances = _ag_instances(autoscaling_group, current=False)
+        old_instances.sort(key=lambda i: i.availability_zone != canary_zone)
+        old_id = old_instances[0].instance_id
+        print("Canary passed; retiring old instance {0}.".format(old_id))
+        conn.terminate_instance(old_id, decrement_capacity=True)
+        for elb_name in env.elb_names:
+            _wait_for_elb_state(elb_name, old_id, "OutOfService")
+    finally:
+        autoscaling_group = _get_autoscaling_group()
+        autoscaling_group.max_size = max(
+            curr_maximum, autoscaling_group.desired_capacity
         )
-    print("All old instances have been terminated.")
+        autoscaling_group.update()
+        autoscaling_group.resume_processes(processes)
+    return autoscaling_group
 
 
 def _elb_state(elb_name, instance_id):
@@ -2534,6 +5147,7 @@ def _elb_state(elb_name, instance_id):
         return "OutOfService"
 
 
+@timed
 def _wait_for_elb_state(elb_name, instance_id, state):
     """
     Waits for the instance to enter the a certain state in the load balancer.
@@ -2551,29 +5165,291 @@ def _wait_for_elb_state(elb_name, instance_id, state):
         waited += 5
 
 
-def _create_server_for_image():
-    """Creates a new web server for use in creating an AMI for auto scaling."""
-    server = _retry_new(
-        env.deployment_tag, env.environment, "web", avail_zone=env.avail_zones[0]
-    )[0]
+def _create_server_for_image(extra_tags=None):
+    """
+    Creates a new web server for use in creating an AMI for auto scaling,
+    with any ``extra_tags``.
+    """
+    base_image = _find_base_image() if env.layered_images else None
+    if base_image is not None:
+        print("Using base image {0}.".format(base_image.id))
+        _check_base_image_age(base_image)
+        server = _new_from_base_image(base_image, extra_tags=extra_tags)
+    else:
+        if env.layered_images:
+            print("No base image found; creating the image server from scratch.")
+        server = _retry_new(
+            env.deployment_tag,
+            env.environment,
+            "web",
+            avail_zone=env.avail_zones[0],
+            extra_tags=extra_tags,
+        )[0]
     # return string rather than server itself since we might get run
     # in another UNIX process
     return server.instance.id
 
 
-def _create_image_from_server(server):
+def _find_base_image():
+    """
+    Returns the most recent web server base image for this deployment and
+    environment that was built from the configured AMI, if any.
+    """
+    images = EC2Connection().get_all_images(
+        owners=["self"],
+        filters={
+            "tag:deployment": env.deployment_tag,
+            "tag:environment": env.environment,
+            "tag:image_type": "base",
+            "tag:base_ami": env.instance_settings["ami"],
+            "state": "available",
+        },
+    )
+    if not images:
+        return None
+    # image names end in the creation timestamp
+    return sorted(images, key=lambda image: image.name)[-1]
+
+
+def _check_base_image_age(image):
+    """Warns if the given base image is older than ``base_image_max_age`` days."""
+    created = datetime.datetime.strptime(image.name.split("_")[-1], "%Y.%m.%d-%H.%M.%S")
+    age = datetime.datetime.utcnow() - created
+    if env.base_image_max_age and age.days >= int(env.base_image_max_age):
+        print(
+            "WARNING: Base image {0} is {1} days old; consider running "
+            "create_base_image to pick up package updates.".format(image.id, age.days)
+        )
+
+
+@timed
+def _new_from_base_image(image, extra_tags=None):
+    """
+    Launches a web server from the given base image, which already has the
+    packages and tools installed, and brings its passwords and service
+    configuration up to date. The code, virtualenv, and remaining
+    configuration are updated by ``deploy_web`` when the image is created.
+    """
+    tags = {
+        "environment": env.environment,
+        "deployment": env.deployment_tag,
+        "role": "web-PENDING",
+        "Name": _instance_name("web-PENDING"),
+    }
+    tags.update(extra_tags or {})
+    placement = "".join([env.region, env.avail_zones[0]])
+    server = _new_server("web", placement, tags, ami=image.id)
+    server.instance = server._create_instances(wait_ssh=False)[0]
+    # the default user is disabled in the image, so connect as ourselves
+    server.user = env.user
+    saved_roledefs = env.roledefs["web"]
+    saved_servers = env.servers["web"]
+    try:
+        env.roledefs["web"] = [server.hostname]
+        env.servers["web"] = [server]
+        _wait_for_ssh(server)
+        if env.instance_settings["fs_encrypt"]:
+            executel("mount_encrypted", hosts=env.roledefs["web"])
+        executel("update_server_passwords", hosts=env.roledefs["web"])
+        executel("update_services", hosts=env.roledefs["web"])
+    except:  # noqa: E722
+        logger.exception("setup from base image %s failed.", image.id)
+        server.terminate()
+        raise
+    finally:
+        env.roledefs["web"] = saved_roledefs
+        env.servers["web"] = saved_servers
+    _change_role(server, "web")
+    return server
+
+
+def _base_ami():
+    """
+    Returns the ID of the AMI from which web server images are built, i.e.,
+    the base image in layered mode (if one exists) or the configured AMI.
+    """
+    base_image = _find_base_image() if env.layered_images else None
+    if base_image is not None:
+        return base_image.id
+    return env.instance_settings["ami"]
+
+
+def _servers_hash():
+    """
+    Returns a hash of the database and cache servers' addresses, which the
+    local settings baked into web server images depend on.
+    """
+    addrs = sorted(
+        server.internal_ip
+        for role in ("db-primary", "db-replica", "cache")
+        for server in env.servers[role]
+    )
+    return hashlib.sha1(" ".join(addrs).encode("utf-8")).hexdigest()
+
+
+def _config_hash():
+    """
+    Returns a hash of the rest of what's baked into web server images: the
+    templates for the local settings, service configuration, and static HTML
+    pages, the FabulAWS config file, and the passwords (from the local secrets
+    file, if there is one).
+    """
+    paths = [os.path.abspath(config_file), env.localsettings_template]
+    for path in [env.templates_dir] + sorted(env.static_html.values()):
+        if os.path.isfile(path):
+            paths.append(path)
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = sorted(d for d in dirnames if d != "__pycache__")
+            paths.extend(os.path.join(dirpath, f) for f in sorted(filenames))
+    config_hash = hashlib.sha1()
+    for path in paths:
+        if os.path.isfile(path):
+            config_hash.update(path.encode("utf-8"))
+            with open(path, "rb") as f:
+                config_hash.update(f.read())
+    secrets = _read_local_secrets() or {}
+    for name in sorted(env.password_names):
+        config_hash.update(("%s=%s" % (name, secrets.get(name, ""))).encode("utf-8"))
+    return config_hash.hexdigest()
+
+
+def _resolve_changeset(changeset=None):
+    """
+    Returns the full commit hash of the given changeset (or the latest code
+    on the configured branch), as fetched on the worker, or None if there's
+    no worker or the repo isn't git. A full commit hash is returned as is,
+    without fetching again.
+    """
+    if not env.vcs_cmd.endswith("git") or not env.servers["worker"]:
+        return None
+    if changeset and re.match(r"^[0-9a-f]{40}$", changeset):
+        return changeset
+    worker = env.servers["worker"][0]
+    with settings(host_string=worker.hostname), cd(env.code_root):
+        vcs("fetch")
+        return sudo(
+            "git rev-parse %s" % _git_changeset(changeset), user=env.deploy_user
+        ).strip()
+
+
+def _image_cache_key(changeset=None):
+    """
+    Returns the tags that identify a web server image for the given changeset
+    (or the latest code on the configured branch): the commit hash, a hash of
+    the requirements file, the base AMI, a hash of the database and cache
+    servers' addresses, and a hash of the configuration and secrets (see
+    ``_config_hash``). Returns None if the key can't be computed without
+    creating a server (i.e., there's no worker or the repo isn't git).
+    """
+    sha = _resolve_changeset(changeset)
+    if sha is None:
+        return None
+    worker = env.servers["worker"][0]
+    with settings(host_string=worker.hostname), cd(env.code_root):
+        requirements_hash = sudo(
+            "git show %s:%s | sha1sum" % (sha, env.requirements_file),
+            user=env.deploy_user,
+        ).split()[0]
+    return {
+        "changeset": sha,
+        "requirements_hash": requirements_hash,
+        "base_ami": _base_ami(),
+        "servers_hash": _servers_hash(),
+        "config_hash": _config_hash(),
+    }
+
+
+def _find_cached_image(key):
+    """
+    Returns the most recent available image for this deployment and
+    environment tagged with the given cache key, if any.
+    """
+    filters = dict(("tag:%s" % k, v) for k, v in key.items())
+    filters.update(
+        {
+            "tag:deployment": env.deployment_tag,
+            "tag:environment": env.environment,
+            "state": "available",
+        }
+    )
+    images = EC2Connection().get_all_images(owners=["self"], filters=filters)
+    if not images:
+        return None
+    # image names end in the creation timestamp and changeset
+    return sorted(images, key=lambda image: image.name)[-1]
+
+
+def _find_launch_config(image_id):
+    """Returns a launch configuration for this environment using the given image, if any."""
+    conn = AutoScaleConnection()
+    prefix = _instance_name("lc")
+    next_token = None
+    while True:
+        configs = conn.get_all_launch_configurations(next_token=next_token)
+        for config in configs:
+            if config.name.startswith(prefix) and config.image_id == image_id:
+                return config
+        next_token = configs.next_token
+        if not next_token:
+            return None
+
+
+def _cached_launch_config(changeset=None):
+    """
+    Returns a launch configuration for an existing image of the code to be
+    deployed, creating the launch configuration if needed, or None if there's
+    no such image.
+    """
+    key = _image_cache_key(changeset)
+    if key is None:
+        print("Unable to compute an image cache key; creating a new image.")
+        return None
+    image = _find_cached_image(key)
+    if image is None:
+        print("No existing image found for changeset %s." % key["changeset"])
+        return None
+    print("Reusing image %s for changeset %s." % (image.id, key["changeset"]))
+    lc = _find_launch_config(image.id)
+    if lc is not None:
+        print("Reusing launch config with name {0}.".format(lc.name))
+        return lc
+    # copy the security groups from the current launch configuration, since
+    # there's no server to derive them from
+    group = _get_autoscaling_group()
+    if group.launch_config_name:
+        security_groups = _get_launch_config(group.launch_config_name).security_groups
+    else:
+        security_groups = _find(env.security_groups, env.environment, "web")
+    return _new_launch_config(image, security_groups)
+
+
+@timed
+def _create_image_from_server(server, changeset=None):
     """Creates an AMI of a existing FabulAWS server."""
     now = datetime.datetime.utcnow().strftime("%Y.%m.%d-%H.%M.%S")
     try:
         with server:
-            deploy_web()
+            deploy_web(changeset=changeset)
             changeset = current_changeset()
+            requirements_hash = sudo(
+                "sha1sum %s" % os.path.join(env.code_root, env.requirements_file)
+            ).split()[0]
         name = _instance_name("web", now, changeset)
         image = server.create_image(name=name)
 
         # The Name tag is set with the "-PENDING" server name, which at
         # this point is out-of-date. Removing it for clarity.
         image.remove_tag("Name")
+        # tag the image so later deploys of the same code can reuse it
+        image.add_tags(
+            {
+                "changeset": changeset,
+                "requirements_hash": requirements_hash,
+                "base_ami": server.instance.image_id,
+                "servers_hash": _servers_hash(),
+                "config_hash": _config_hash(),
+            }
+        )
     finally:
         server.cleanup()
     # reload the environment WITHOUT the new server
@@ -2582,8 +5458,34 @@ def _create_image_from_server(server):
     return image
 
 
-def _create_launch_config(server=None):
-    """Returns a new launch configuration for the specified image."""
+@timed
+def _new_launch_config(image, security_groups):
+    """Creates and returns a new launch configuration for the given image."""
+    timestamp, changeset = image.name.split("_")[-2:]
+    lc = LaunchConfiguration(
+        name=_instance_name("lc", timestamp, changeset),
+        image_id=image.id,
+        security_groups=security_groups,
+        instance_type=_find(env.instance_types, env.environment, "web"),
+        # Enable detailed monitoring for more responsive autoscaling; see:
+        # https://docs.aws.amazon.com/autoscaling/ec2/userguide/as-instance-monitoring.html#enable-as-instance-metrics
+        instance_monitoring=True,
+    )
+    AutoScaleConnection().create_launch_configuration(lc)
+    print("Created a new launch config with name {0}.".format(lc.name))
+    return lc
+
+
+def _create_launch_config(server=None, changeset=None):
+    """
+    Returns a new launch configuration for the specified image. If no server is
+    given and ``reuse_images`` is enabled, an existing image of the same code
+    is reused when available, rather than creating a new one.
+    """
+    if server is None and env.reuse_images:
+        lc = _cached_launch_config(changeset)
+        if lc is not None:
+            return lc
     # Create an AMI using the deploy code, and create a new launch config.
     created = server is None
     if server is None:
@@ -2594,27 +5496,54 @@ def _create_launch_config(server=None):
             env.deployment_tag, env.environment, "web", instance_ids=[instance_id]
         )[0]
     try:
-        image = _create_image_from_server(server)
-        timestamp, changeset = image.name.split("_")[-2:]
-
-        lc = LaunchConfiguration(
-            name=_instance_name("lc", timestamp, changeset),
-            image_id=image.id,
-            security_groups=server.get_security_groups_for_launch_configuration(),
-            instance_type=_find(env.instance_types, env.environment, "web"),
-            # Enable detailed monitoring for more responsive autoscaling; see:
-            # https://docs.aws.amazon.com/autoscaling/ec2/userguide/as-instance-monitoring.html#enable-as-instance-metrics
-            instance_monitoring=True,
-        )
-        AutoScaleConnection().create_launch_configuration(lc)
-        print("Created a new launch config with name {0}.".format(lc.name))
-        return lc
+        image = _create_image_from_server(server, changeset)
+        return _new_launch_config(
+            image, server.get_security_groups_for_launch_configuration()
+        )
     finally:
         # if we created the server, clean it up here
         if created:
             server.terminate()
 
 
+def _create_launch_config_name(changeset):
+    """
+    Creates a launch configuration for the given changeset and returns its
+    name, for use in a BackgroundCommand.
+    """
+    return _create_launch_config(changeset=changeset).name
+
+
+def _deploy_worker_during_bake(changeset):
+    """
+    Creates a launch configuration for the given changeset in the background
+    while deploying the same changeset to the worker, and returns the launch
+    configuration once both have finished.
+
+    The changeset must already be resolved (see ``_resolve_changeset``), and
+    in 'artifact' mode the release is built before the image creation starts,
+    so that only the worker deploy runs git in the worker's checkout.
+    """
+    _prepare_release(changeset)
+    print("Starting AMI and launch config creation in the background")
+    # make sure we don't pass open SSH connections down to the child proc
+    disconnect_all()
+    lc_creator = BackgroundCommand(
+        _create_launch_config_name, args=[changeset], capture_result=True
+    )
+    lc_creator.start()
+    try:
+        executel("deploy_worker", changeset=changeset)
+    finally:
+        # even if the worker deploy failed, let the image creation finish (so
+        # we don't leave a half-created server running)
+        print("Waiting for launch config creation to complete...")
+        lc_creator.join()
+    if lc_creator.exitcode != 0:
+        abort("Launch config creation failed. Inspect the appropriate log file.")
+    return _get_launch_config(lc_creator.result())
+
+
 def _get_launch_config(name):
     """Retrieves the launch configuration with the given name."""
     configs = AutoScaleConnection().get_all_launch_configurations(names=[name])
@@ -2633,12 +5562,61 @@ def _get_launch_config(name):
     return config
 
 
+# Tag marking the autoscaling group in service for a blue/green environment
+ACTIVE_GROUP_TAG = "fabulaws-active"
+
+
+def _autoscaling_groups():
+    """
+    Returns this environment's autoscaling groups: the configured group plus
+    any groups created by blue/green deploys.
+    """
+    conn = AutoScaleConnection()
+    # group names created by blue/green deploys end in a timestamp
+    pattern = re.compile(
+        r"^%s-\d{4}\.\d\d\.\d\d-\d\d\.\d\d\.\d\d$" % re.escape(env.ag_name)
+    )
+    groups = []
+    next_token = None
+    while True:
+        page = conn.get_all_groups(next_token=next_token)
+        groups.extend(
+            group
+            for group in page
+            if group.name == env.ag_name or pattern.match(group.name)
+        )
+        next_token = page.next_token
+        if not next_token:
+            return groups
+
+
+def _is_active_group(group):
+    """Returns whether the given group is tagged as in service."""
+    return any(
+        tag.key == ACTIVE_GROUP_TAG and tag.value == "true" for tag in group.tags or []
+    )
+
+
+def _active_ag_name():
+    """
+    Returns the name of the autoscaling group currently in service for this
+    environment, which is the configured group unless a blue/green deploy
+    has replaced it.
+    """
+    if env.get("active_ag_name"):
+        return env.active_ag_name
+    active = [group.name for group in _autoscaling_groups() if _is_active_group(group)]
+    # group names created by blue/green deploys end in a timestamp
+    env.active_ag_name = sorted(active)[-1] if active else env.ag_name
+    return env.active_ag_name
+
+
 def _get_autoscaling_group(name=None):
     """Retrieves the autoscaling group for this environment.
 
     Assumes it already exists, and that there is only one.
     """
-    name = name or env.ag_name
+    name = name or _active_ag_name()
     groups = AutoScaleConnection().get_all_groups(names=[name])
     if not groups:
         raise Exception(
@@ -2655,6 +5633,7 @@ def _get_autoscaling_group(name=None):
     return groups[0]
 
 
+@timed
 def _update_autoscaling_group(launch_config):
     """Updates the existing autoscaling group to use a new launch_config."""
     group = _get_autoscaling_group()
@@ -2663,36 +5642,7 @@ def _update_autoscaling_group(launch_config):
     group.launch_config_name = launch_config.name
     group.update()
 
-    # Make sure that the appropriate tags exist, and that they are set
-    # to propagate when a new server is created.
-    AutoScaleConnection().create_or_update_tags(
-        [
-            Tag(
-                key="Name",
-                value=_instance_name("web"),
-                propagate_at_launch=True,
-                resource_id=group.name,
-            ),
-            Tag(
-                key="environment",
-                value=env.environment,
-                propagate_at_launch=True,
-                resource_id=group.name,
-            ),
-            Tag(
-                key="deployment",
-                value=env.deployment_tag,
-                propagate_at_launch=True,
-                resource_id=group.name,
-            ),
-            Tag(
-                key="role",
-                value="web",
-                propagate_at_launch=True,
-                resource_id=group.name,
-            ),
-        ]
-    )
+    _tag_autoscaling_group(group.name)
 
     print(
         "Autoscaling group {0} has been updated to use launch config "
@@ -2700,3 +5650,26 @@ def _update_autoscaling_group(launch_config):
     )
 
     return group
+
+
+def _tag_autoscaling_group(group_name):
+    """
+    Makes sure that the appropriate tags exist on the given autoscaling group,
+    and that they are set to propagate when a new server is created.
+    """
+    AutoScaleConnection().create_or_update_tags(
+        [
+            Tag(
+                key=key,
+                value=value,
+                propagate_at_launch=True,
+                resource_id=group_name,
+            )
+            for key, value in (
+                ("Name", _instance_name("web")),
+                ("environment", env.environment),
+                ("deployment", env.deployment_tag),
+                ("role", "web"),
+            )
+        ]
+    )
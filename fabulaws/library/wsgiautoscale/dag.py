@@ -0,0 +1,169 @@
+import logging
+import multiprocessing
+import time
+
+from fabric.api import abort
+from fabric.network import disconnect_all
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+__all__ = ["Step", "run_steps"]
+
+
+class Step(object):
+    """
+    A step in a deployment: a function to call (in a separate process) once
+    all of the steps it depends on have finished.
+
+    ``hosts`` are the hosts the step operates on, and ``locks`` are resources
+    on those hosts (such as ``"apt"``) that only one step may use at a time.
+    A failed step is retried up to ``retries`` times.
+    """
+
+    def __init__(
+        self,
+        name,
+        func,
+        args=None,
+        kwargs=None,
+        deps=None,
+        hosts=None,
+        locks=None,
+        retries=0,
+    ):
+        self.name = name
+        self.func = func
+        self.args = args or []
+        self.kwargs = kwargs or {}
+        self.deps = list(deps or [])
+        self.hosts = list(hosts or [])
+        self.locks = list(locks or [])
+        self.retries = int(retries)
+        self.attempts = 0
+        self.start = None
+        self.end = None
+        self.proc = None
+
+    def __repr__(self):
+        return "<Step: %s>" % self.name
+
+    @property
+    def lock_keys(self):
+        """The (resource, host) pairs this step holds while it's running."""
+        return set((lock, host) for lock in self.locks for host in self.hosts or [None])
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def start_proc(self):
+        self.attempts += 1
+        if self.start is None:
+            self.start = time.time()
+        self.proc = multiprocessing.Process(
+            target=self.func, args=self.args, kwargs=self.kwargs
+        )
+        self.proc.start()
+
+
+def _check_steps(steps):
+    """Aborts if any step has an unknown dependency or there's a cycle."""
+    names = set(step.name for step in steps)
+    if len(names) != len(steps):
+        abort("Step names must be unique: %s" % [step.name for step in steps])
+    for step in steps:
+        unknown = set(step.deps) - names
+        if unknown:
+            abort("Step %s depends on unknown steps: %s" % (step.name, list(unknown)))
+    done = set()
+    remaining = list(steps)
+    while remaining:
+        ready = [step for step in remaining if set(step.deps) <= done]
+        if not ready:
+            abort("Circular dependency between steps: %s" % remaining)
+        for step in ready:
+            done.add(step.name)
+            remaining.remove(step)
+
+
+def critical_path(steps):
+    """
+    Returns the chain of finished steps that determined the total run time,
+    following each step back to the dependency that finished last.
+    """
+    by_name = dict((step.name, step) for step in steps)
+    step = max(steps, key=lambda step: step.end)
+    path = [step]
+    while step.deps:
+        step = max((by_name[name] for name in step.deps), key=lambda dep: dep.end)
+        path.insert(0, step)
+    return path
+
+
+def run_steps(steps, max_parallel=4, retry_delay=10):
+    """
+    Runs the given steps, each as soon as its dependencies have finished and
+    its locks are free, with at most ``max_parallel`` steps at once. Aborts
+    once the running steps have finished if any step failed (after its
+    retries), and prints the critical path of the run otherwise.
+    """
+    _check_steps(steps)
+    max_parallel = int(max_parallel)
+    pending = list(steps)
+    running = []
+    done = set()
+    failed = []
+    # steps waiting for a retry, and when they may be restarted
+    retry_at = {}
+    start = time.time()
+    while pending or running:
+        for step in list(running):
+            if step.proc.is_alive():
+                continue
+            step.proc.join()
+            running.remove(step)
+            if step.proc.exitcode == 0:
+                step.end = time.time()
+                done.add(step.name)
+                print("Step %s finished in %.0f seconds." % (step.name, step.duration))
+            elif step.attempts <= step.retries:
+                delay = retry_delay * step.attempts
+                print(
+                    "Step %s failed (attempt %s of %s); retrying in %s seconds..."
+                    % (step.name, step.attempts, step.retries + 1, delay)
+                )
+                retry_at[step.name] = time.time() + delay
+                pending.insert(0, step)
+            else:
+                step.end = time.time()
+                failed.append(step)
+                logger.error(
+                    "Step %s failed after %s attempts.", step.name, step.attempts
+                )
+        if not failed:
+            held = set()
+            for step in running:
+                held |= step.lock_keys
+            for step in list(pending):
+                if len(running) >= max_parallel:
+                    break
+                if not set(step.deps) <= done:
+                    continue
+                if step.lock_keys & held or retry_at.get(step.name, 0) > time.time():
+                    continue
+                print("Starting step %s..." % step.name)
+                # make sure we don't pass open SSH connections down to the child procs
+                disconnect_all()
+                step.start_proc()
+                held |= step.lock_keys
+                pending.remove(step)
+                running.append(step)
+        elif not running:
+            break
+        time.sleep(1)
+    if failed:
+        abort("Steps failed: %s" % ", ".join(step.name for step in failed))
+    print("All steps finished in %.0f seconds. Critical path:" % (time.time() - start))
+    for step in critical_path(steps):
+        print("  %s: %.0f seconds" % (step.name, step.duration))
@@ -0,0 +1,86 @@
+import json
+import os
+import time
+
+from fabric.api import abort, env
+
+__all__ = ["Journal"]
+
+DEFAULT_DIR = "fabulaws-journals"
+
+
+class Journal(object):
+    """
+    A record of the completed steps of a long-running orchestration task, and
+    of the resources (instances, images, launch configs) they created, saved
+    locally after each step so that a failed run can be resumed where it left
+    off instead of starting over.
+    """
+
+    def __init__(self, command, deployment, environment, resume=False):
+        directory = env.get("journal_dir") or DEFAULT_DIR
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = os.path.join(
+            directory, "%s-%s-%s.json" % (command, deployment, environment)
+        )
+        self.resuming = os.path.exists(self.path)
+        if self.resuming and not resume:
+            abort(
+                "A previous %s for %s/%s didn't finish (see %s). Pass resume=yes "
+                "to continue it, or delete the file to start over."
+                % (command, deployment, environment, self.path)
+            )
+        if self.resuming:
+            with open(self.path) as f:
+                self.data = json.load(f)
+            print(
+                "Resuming %s; completed steps: %s"
+                % (command, ", ".join(self.data["steps"]) or "none")
+            )
+        else:
+            if resume:
+                print("No unfinished %s found; starting from scratch." % command)
+            self.data = {
+                "command": command,
+                "deployment": deployment,
+                "environment": environment,
+                "started": time.time(),
+                "steps": {},
+                "resources": {},
+            }
+            self.save()
+
+    def save(self):
+        # write to a temporary file first, so an interrupted save doesn't
+        # leave a truncated journal behind
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.data, f, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def done(self, step):
+        """Returns whether the given step was completed (by this or an earlier run)."""
+        if step in self.data["steps"]:
+            print("Skipping %s (already completed)." % step)
+            return True
+        return False
+
+    def complete(self, step, **resources):
+        """Marks the given step complete, recording any resources it created."""
+        self.data["steps"][step] = time.time()
+        self.data["resources"].update(resources)
+        self.save()
+
+    def get(self, name, default=None):
+        """Returns the recorded resource with the given name."""
+        return self.data["resources"].get(name, default)
+
+    def set(self, name, value):
+        """Records a resource (e.g., an instance ID) as soon as it exists."""
+        self.data["resources"][name] = value
+        self.save()
+
+    def finish(self):
+        """Removes the journal once the task has finished successfully."""
+        os.remove(self.path)
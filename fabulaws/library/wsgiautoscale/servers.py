@@ -1,5 +1,6 @@
 import logging
 import os
+import re
 
 from fabric.api import env, settings, sudo
 from fabric.contrib import files
@@ -51,6 +52,11 @@ class BaseInstance(FirewallMixin, UbuntuInstance):
             "volume_type",
             "security_groups",
             "ebs_encrypt",
+            "cloud_init",
+            "apt_proxy",
+            "artifact_cache",
+            "artifact_cache_hosts",
+            "setup_step_retries",
         ]:
             setattr(self, key, kwargs.pop(key, ""))
         if "terminate" not in kwargs:
@@ -75,20 +81,21 @@ class BaseInstance(FirewallMixin, UbuntuInstance):
         ]  # skip files ending in '.gecos'
         return users
 
-    def _add_swap(self, path):
+    def _add_swap(self, path, options="sw"):
         sudo("mkswap -f {0}".format(path))
         with settings(warn_only=True):
             # sometimes mkswap seems to 'mount' the swap partition
             # automatically, so this command will fail
             sudo("swapon {0}".format(path))
-        files.append("/etc/fstab", "{0} none swap sw 0 0".format(path), use_sudo=True)
+        files.append(
+            "/etc/fstab", "{0} none swap {1} 0 0".format(path, options), use_sudo=True
+        )
 
     @uses_fabric
     def setup_swap(self):
         """Sets up swap partition"""
         swap_mb = self.server_memory * self.swap_multiplier
-        devs = ["/dev/xvdb", "/dev/xvdc"]
-        for dev in devs:
+        for dev in self.instance_store_devices():
             print("attempting swap creation on {0}...".format(dev))
             if swap_mb <= 0:
                 print("no additional swap needed; skipping")
@@ -113,13 +120,21 @@ class BaseInstance(FirewallMixin, UbuntuInstance):
                 print("crypt device {0} already exists; skipping".format(crypt_name))
                 continue
             sudo("cryptsetup -d /dev/urandom create {0} {1}".format(crypt_name, dev))
+            # instance store volumes are replaced by new, empty ones when the
+            # instance is stopped and started, so don't wait for them at boot
             files.append(
                 "/etc/crypttab",
-                "{0} {1} /dev/urandom swap".format(crypt_name, dev),
+                "{0} {1} /dev/urandom swap,nofail".format(crypt_name, dev),
                 use_sudo=True,
             )
             files.comment("/etc/fstab", dev, use_sudo=True)
-            self._add_swap("/dev/mapper/{0}".format(crypt_name))
+            real_dev = sudo("readlink -f {0}".format(dev))
+            if real_dev != dev:
+                # e.g., the instance store mounted on /mnt by cloud-init
+                files.comment(
+                    "/etc/fstab", r"^{0}\s".format(re.escape(real_dev)), use_sudo=True
+                )
+            self._add_swap("/dev/mapper/{0}".format(crypt_name), "sw,nofail")
         if swap_mb > 0:
             if not files.exists(self.default_swap_file):
                 sudo("fallocate -l {0}M {1}".format(swap_mb, self.default_swap_file))
@@ -170,8 +185,13 @@ class BaseInstance(FirewallMixin, UbuntuInstance):
         Creates a deployment user with a directory for Apache configurations.
         """
         user = self.deploy_user
-        sudo("useradd -d {0} -m -s /bin/bash {1}".format(self.deploy_user_home, user))
-        sudo("mkdir {0}/.ssh".format(self.deploy_user_home), user=user)
+        with settings(warn_only=True):
+            exists = sudo("id -u {0}".format(user)).succeeded
+        if not exists:
+            sudo(
+                "useradd -d {0} -m -s /bin/bash {1}".format(self.deploy_user_home, user)
+            )
+        sudo("mkdir -p {0}/.ssh".format(self.deploy_user_home), user=user)
 
     @uses_fabric
     def update_deployer_keys(self):
@@ -186,6 +206,46 @@ class BaseInstance(FirewallMixin, UbuntuInstance):
         for _, key_file in self._get_users():
             files.append(file_, open(key_file).read().strip(), use_sudo=True)
 
+    def cloud_config(self):
+        """
+        Creates the sysadmin users and sudoers file, and upgrades packages,
+        while booting.
+        """
+        config = super(BaseInstance, self).cloud_config()
+        config["package_upgrade"] = True
+        config.setdefault("packages", []).append("ntp")  # keep date current
+        # see create_users() for why the home directory permissions are reverted
+        runcmd = config.setdefault("runcmd", [])
+        runcmd.append("dpkg-reconfigure -f noninteractive adduser")
+        runcmd.append(r"sed -i 's/^\(HOME_MODE\s\+0750\)/#\1/' /etc/login.defs")
+        users = ["default"]
+        for name, keyfile in self._get_users():
+            with open(keyfile) as f:
+                keys = [line.strip() for line in f if line.strip()]
+            user = {"name": name, "shell": "/bin/bash", "ssh_authorized_keys": keys}
+            if self.admin_groups:
+                user["groups"] = ",".join(self.admin_groups)
+            gecos_file = keyfile + ".gecos"
+            if os.path.exists(gecos_file):
+                with open(gecos_file, "r") as gecos_fd:
+                    user["gecos"] = gecos_fd.readline().strip()
+            users.append(user)
+            # users are created before runcmd, with the stricter permissions
+            runcmd.append("passwd -d {0}".format(name))
+            runcmd.append("chmod 755 /home/{0}".format(name))
+        config["users"] = users
+        sudoers_file = os.path.join(self.deployment_dir, "templates", "sudoers")
+        with open(sudoers_file) as f:
+            config.setdefault("write_files", []).append(
+                {
+                    "path": "/etc/sudoers",
+                    "content": f.read(),
+                    "owner": "root:root",
+                    "permissions": "0440",
+                }
+            )
+        return config
+
     def setup(self):
         """
         Creates sysadmin users and secures the required directories.
@@ -194,16 +254,19 @@ class BaseInstance(FirewallMixin, UbuntuInstance):
         self.instance.modify_attribute(
             "blockDeviceMapping", ["%s=true" % v[0] for v in self.volume_info]
         )
-        self.create_users(self._get_users())
-        self.setup_sudoers()
+        if not self.cloud_init:
+            self.setup_step(self.create_users, self._get_users())
+            self.setup_step(self.setup_sudoers)
         # needed for SSH agent forwarding during replication setup:
         self.reset_authentication()
-        self.create_deployer()
-        self.update_deployer_keys()
-        self.bind_app_directories(self.app_dirs, self.app_root)
-        self.setup_swap()  # after app (potentially secure) partition is created
-        self.upgrade_packages()
-        self.install_packages(["ntp"])  # keep date current
+        self.setup_step(self.create_deployer)
+        self.setup_step(self.update_deployer_keys)
+        self.setup_step(self.bind_app_directories, self.app_dirs, self.app_root)
+        # after app (potentially secure) partition is created
+        self.setup_step(self.setup_swap)
+        if not self.cloud_init:
+            self.setup_step(self.upgrade_packages)
+            self.setup_step(self.install_packages, ["ntp"])  # keep date current
 
 
 class SessionMixin(RedisMixin):
@@ -289,8 +352,11 @@ class DbReplicaMixin(DbMixin):
         super(DbReplicaMixin, self).setup()
         if len(env.servers["db-primary"]) > 0:
             primary = env.servers["db-primary"][0]
-            self.pg_copy_master(
-                primary, "%s_repl" % env.database_user, env.database_password
+            self.setup_step(
+                self.pg_copy_master,
+                primary,
+                "%s_repl" % env.database_user,
+                env.database_password,
             )
 
 
@@ -309,7 +375,10 @@ class AppMixin(PythonMixin):
         """
 
         node_version = getattr(env, "node_version", "6.x")
-        sudo("curl -sL https://deb.nodesource.com/setup_%s | bash -" % node_version)
+        setup_url = self.artifact_url(
+            "https://deb.nodesource.com/setup_%s" % node_version
+        )
+        sudo("curl -sL %s | bash -" % setup_url)
         sudo("export DEBIAN_FRONTEND=noninteractive ; apt-get -qq -y install nodejs")
         less_version = getattr(env, "less_version", "1.3.3")
         sudo("npm install -g less@%s" % less_version)
@@ -333,7 +402,10 @@ class AppMixin(PythonMixin):
         """Create a user for gunicorn, celery, etc."""
 
         if env.webserver_user != env.deploy_user:  # deploy_user already exists
-            sudo("useradd --system %(webserver_user)s" % env)
+            with settings(warn_only=True):
+                exists = sudo("id -u %(webserver_user)s" % env).succeeded
+            if not exists:
+                sudo("useradd --system %(webserver_user)s" % env)
 
     def setup(self):
         """
@@ -342,9 +414,9 @@ class AppMixin(PythonMixin):
         """
 
         super(AppMixin, self).setup()
-        self.install_less_and_yuglify()
-        self.install_system_packages()
-        self.create_webserver_user()
+        self.setup_step(self.install_less_and_yuglify)
+        self.setup_step(self.install_system_packages)
+        self.setup_step(self.create_webserver_user)
 
 
 class WorkerMixin(AppMixin):
@@ -368,7 +440,7 @@ class WebMixin(AppMixin):
         """Installs nginx."""
 
         super(WebMixin, self).setup()
-        self.install_packages(["nginx"])
+        self.setup_step(self.install_packages, ["nginx"])
 
 
 class CacheInstance(QueueMixin, CacheMixin, SessionMixin, BaseInstance):
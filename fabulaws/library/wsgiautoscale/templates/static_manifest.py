@@ -0,0 +1,137 @@
+# Describes the static files of the current Django project as JSON.
+#
+# This script is fed to ``manage.py shell`` on standard input by the
+# wsgiautoscale deploy tasks; the last line of output is the JSON result.
+# The STATIC_MANIFEST_MODE environment variable selects the output:
+#
+# inputs: a single hash of the static source files, the templates scanned by
+#   ``compress --offline`` (if enabled), and the related settings, or null if
+#   the source files aren't on the local filesystem.
+# files: a {collected name: digest} mapping for the collected files, where the
+#   digest is the hashed name for manifest storages (null if neither they nor
+#   the source files can be read locally), plus the URL path prefix under which
+#   the files are served.
+#
+# Everything lives inside main() because older versions of ``shell`` exec
+# standard input with separate globals and locals.
+
+
+def main():
+    import hashlib
+    import json
+    import os
+
+    from django.conf import settings
+    from django.contrib.staticfiles import finders
+    from django.contrib.staticfiles.storage import staticfiles_storage
+
+    try:
+        from urllib.parse import urlparse
+    except ImportError:  # Python 2
+        from urlparse import urlparse
+
+    ignore_patterns = ["CVS", ".*", "*~"]
+
+    def file_digest(path):
+        sha = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def source_files():
+        """
+        Returns a {collected name: source path} dict, as collectstatic sees it,
+        or None if a storage doesn't support local paths.
+        """
+        found = {}
+        for finder in finders.get_finders():
+            for path, storage in finder.list(ignore_patterns):
+                name = path
+                prefix = getattr(storage, "prefix", None)
+                if prefix:
+                    name = os.path.join(prefix, path)
+                if name in found:
+                    # the first finder to find a file wins
+                    continue
+                try:
+                    found[name] = storage.path(path)
+                except NotImplementedError:
+                    return None
+        return found
+
+    def template_files():
+        """Returns the template files scanned by ``compress --offline``."""
+        from django.template.utils import get_app_template_dirs
+
+        dirs = list(get_app_template_dirs("templates"))
+        for engine in getattr(settings, "TEMPLATES", []):
+            dirs.extend(engine.get("DIRS", []))
+        found = []
+        for template_dir in dirs:
+            for root, _, filenames in os.walk(str(template_dir)):
+                found.extend(os.path.join(root, f) for f in filenames)
+        return sorted(set(found))
+
+    def collected_files():
+        """Returns a {collected name: digest} dict for the static storage."""
+        if hasattr(staticfiles_storage, "load_manifest"):
+            manifest = staticfiles_storage.load_manifest()
+            # Django 4.2+ also returns the hash of the manifest
+            if isinstance(manifest, tuple):
+                manifest = manifest[0]
+            return dict(manifest)
+        sources = source_files()
+        if sources is None:
+            return None
+        return dict((name, file_digest(path)) for name, path in sources.items())
+
+    if os.environ.get("STATIC_MANIFEST_MODE") == "files":
+        result = {
+            "prefix": urlparse(settings.STATIC_URL).path,
+            "files": collected_files(),
+        }
+        print(json.dumps(result))
+        return
+
+    names = [
+        "STATIC_URL",
+        "STATIC_ROOT",
+        "STATICFILES_DIRS",
+        "STATICFILES_FINDERS",
+        "STATICFILES_STORAGE",
+        "STORAGES",
+    ]
+    names += [name for name in dir(settings) if name.startswith("COMPRESS_")]
+    relevant_settings = dict((name, getattr(settings, name, None)) for name in names)
+
+    def stable(value):
+        """Returns a representation of ``value`` that's the same in every process."""
+        if isinstance(value, (set, frozenset)):
+            return sorted(value, key=str)
+        if hasattr(value, "__fspath__"):
+            return str(value)
+        if not hasattr(value, "__name__"):
+            # an instance, e.g. of a finder or storage class
+            value = type(value)
+        return "%s.%s" % (
+            value.__module__,
+            getattr(value, "__qualname__", value.__name__),
+        )
+
+    sources = source_files()
+    if sources is None:
+        print(json.dumps({"inputs": None}))
+        return
+
+    sha = hashlib.sha1()
+    sha.update(json.dumps(relevant_settings, sort_keys=True, default=stable).encode())
+    for name, path in sorted(sources.items()):
+        sha.update(("%s %s\n" % (name, file_digest(path))).encode())
+    if getattr(settings, "COMPRESS_OFFLINE", False):
+        for path in template_files():
+            sha.update(("%s %s\n" % (path, file_digest(path))).encode())
+    print(json.dumps({"inputs": sha.hexdigest()}))
+
+
+main()
@@ -0,0 +1,82 @@
+# Sends warm-up requests to the local gunicorn server.
+#
+# This script is run by the wsgiautoscale deploy tasks on new web servers,
+# before they're put in service with the load balancer(s):
+#
+#   warmup.py <port> <host header> <concurrency> <duration> <path> [<path> ...]
+#
+# Each of <concurrency> threads requests the paths in turn until <duration>
+# seconds have passed (and it has requested each path at least once). The
+# last line of output is a JSON summary of the request times.
+
+import json
+import sys
+import threading
+import time
+
+try:
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+except ImportError:  # Python 2
+    from urllib2 import HTTPError, Request, urlopen
+
+
+def main():
+    port, host, concurrency, duration = sys.argv[1:5]
+    paths = sys.argv[5:]
+    deadline = time.time() + float(duration)
+    times = []
+    errors = []
+    lock = threading.Lock()
+
+    def fetch(path):
+        request = Request(
+            "http://127.0.0.1:%s%s" % (port, path),
+            headers={"Host": host, "X-Forwarded-Proto": "https"},
+        )
+        start = time.time()
+        try:
+            response = urlopen(request, timeout=60)
+            response.read()
+            status = response.getcode()
+        except HTTPError as e:
+            status = e.code
+        except Exception:
+            status = None
+        with lock:
+            times.append(time.time() - start)
+            if status is None or status >= 500:
+                errors.append(path)
+
+    def worker():
+        count = 0
+        while count < len(paths) or time.time() < deadline:
+            fetch(paths[count % len(paths)])
+            count += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(int(concurrency))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    times.sort()
+
+    def percentile(p):
+        return times[max(int(round(p / 100.0 * len(times))) - 1, 0)]
+
+    print(
+        json.dumps(
+            {
+                "requests": len(times),
+                "errors": len(errors),
+                "p50": percentile(50),
+                "p95": percentile(95),
+                "max": times[-1],
+            }
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+import datetime
+import logging
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from fabric.api import env
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+__all__ = ["recorded", "set_changeset", "span", "timed"]
+
+DEFAULT_DB = "fabulaws-timeline.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    command TEXT NOT NULL,
+    deployment TEXT,
+    environment TEXT,
+    changeset TEXT,
+    status TEXT,
+    start_time REAL NOT NULL,
+    end_time REAL
+);
+CREATE TABLE IF NOT EXISTS spans (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    parent_id INTEGER REFERENCES spans (id),
+    name TEXT NOT NULL,
+    host TEXT,
+    role TEXT,
+    changeset TEXT,
+    pid INTEGER,
+    status TEXT,
+    start_time REAL NOT NULL,
+    end_time REAL
+);
+"""
+
+
+def _enabled():
+    return env.get("record_timeline", True)
+
+
+def connect(path=None):
+    """Returns a connection to the timeline database, creating it if needed."""
+    conn = sqlite3.connect(path or env.get("timeline_db") or DEFAULT_DB, timeout=60)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _execute(sql, params):
+    """Runs a single write query and returns the last row ID."""
+    conn = connect()
+    try:
+        with conn:
+            return conn.execute(sql, params).lastrowid
+    finally:
+        conn.close()
+
+
+def set_changeset(changeset):
+    """Records the changeset being deployed by the current run."""
+    env.timeline_changeset = changeset
+
+
+@contextmanager
+def span(name, host=None, role=None):
+    """
+    Records the time spent in the block as a span of the current run (if
+    any). Spans in child processes are recorded in the parent's run.
+    """
+    run_id = env.get("timeline_run")
+    if not run_id or not _enabled():
+        yield
+        return
+    stack = env.setdefault("timeline_stack", [])
+    try:
+        span_id = _execute(
+            "INSERT INTO spans (run_id, parent_id, name, host, role, changeset, "
+            "pid, start_time) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                run_id,
+                stack[-1] if stack else None,
+                name,
+                host,
+                role,
+                env.get("timeline_changeset"),
+                os.getpid(),
+                time.time(),
+            ),
+        )
+    except sqlite3.Error:
+        logger.exception("Unable to record span %s.", name)
+        span_id = None
+    stack.append(span_id)
+    status = "failed"
+    try:
+        yield
+        status = "ok"
+    finally:
+        stack.pop()
+        if span_id is not None:
+            try:
+                _execute(
+                    "UPDATE spans SET end_time = ?, status = ?, changeset = ? "
+                    "WHERE id = ?",
+                    (time.time(), status, env.get("timeline_changeset"), span_id),
+                )
+            except sqlite3.Error:
+                logger.exception("Unable to record span %s.", name)
+
+
+def timed(func):
+    """Decorator that records each call of the function as a span."""
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(func.__name__.lstrip("_")):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def recorded(func):
+    """
+    Decorator for orchestration tasks that records each call as a new run,
+    unless it's called from within another recorded task.
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if env.get("timeline_run") or not _enabled():
+            with span(func.__name__):
+                return func(*args, **kwargs)
+        try:
+            run_id = _execute(
+                "INSERT INTO runs (command, start_time) VALUES (?, ?)",
+                (func.__name__, time.time()),
+            )
+        except sqlite3.Error:
+            logger.exception("Unable to record the timeline of %s.", func.__name__)
+            return func(*args, **kwargs)
+        env.timeline_run = run_id
+        env.timeline_stack = []
+        env.timeline_changeset = None
+        status = "failed"
+        try:
+            with span(func.__name__):
+                result = func(*args, **kwargs)
+            status = "ok"
+            return result
+        finally:
+            env.timeline_run = None
+            try:
+                _execute(
+                    "UPDATE runs SET end_time = ?, status = ?, deployment = ?, "
+                    "environment = ?, changeset = ? WHERE id = ?",
+                    (
+                        time.time(),
+                        status,
+                        env.get("deployment_tag"),
+                        env.get("environment"),
+                        env.get("timeline_changeset"),
+                        run_id,
+                    ),
+                )
+            except sqlite3.Error:
+                logger.exception("Unable to record the timeline of %s.", func.__name__)
+            else:
+                print(
+                    "Recorded the timeline of run {0}; see deploy_report for "
+                    "details.".format(run_id)
+                )
+
+    return wrapper
+
+
+def _leaf_spans(spans):
+    """Returns the spans that don't contain any other spans."""
+    parents = set(s["parent_id"] for s in spans)
+    return [s for s in spans if s["id"] not in parents]
+
+
+def critical_path(spans):
+    """
+    Returns the chain of (leaf) spans that determined the run's duration,
+    by following the last span to finish back to the span that finished
+    last before it started, and so on.
+    """
+    leaves = [s for s in _leaf_spans(spans) if s["end_time"] is not None]
+    if not leaves:
+        return []
+    current = max(leaves, key=lambda s: s["end_time"])
+    path = [current]
+    while True:
+        earlier = [s for s in leaves if s["end_time"] <= current["start_time"]]
+        if not earlier:
+            return path
+        current = max(earlier, key=lambda s: s["end_time"])
+        path.insert(0, current)
+
+
+def _label(s):
+    label = s["name"]
+    if s["host"] or s["role"]:
+        label += " (%s)" % (s["host"] or s["role"])
+    return label
+
+
+def _depth(s, by_id):
+    depth = 0
+    while s["parent_id"] in by_id:
+        s = by_id[s["parent_id"]]
+        depth += 1
+    return depth
+
+
+def _totals(conn, run_id):
+    """Returns a {span name: total seconds} dict for the given run."""
+    rows = conn.execute(
+        "SELECT name, SUM(end_time - start_time) AS seconds FROM spans "
+        "WHERE run_id = ? AND end_time IS NOT NULL GROUP BY name",
+        (run_id,),
+    )
+    return dict((row["name"], row["seconds"]) for row in rows)
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def estimates(command, deployment, environment, compare=5, path=None):
+    """
+    Returns a {span name: (seconds per run, seconds per call)} dict of the
+    median time spent in each step by the last ``compare`` successful runs of
+    the given command in the given environment.
+    """
+    if not os.path.exists(path or env.get("timeline_db") or DEFAULT_DB):
+        return {}
+    conn = connect(path)
+    try:
+        runs = conn.execute(
+            "SELECT id FROM runs WHERE command = ? AND deployment = ? AND "
+            "environment = ? AND status = 'ok' ORDER BY start_time DESC LIMIT ?",
+            (command, deployment, environment, int(compare)),
+        ).fetchall()
+        per_run = {}
+        per_call = {}
+        for run in runs:
+            rows = conn.execute(
+                "SELECT name, SUM(end_time - start_time) AS seconds, COUNT(*) AS "
+                "calls FROM spans WHERE run_id = ? AND end_time IS NOT NULL "
+                "GROUP BY name",
+                (run["id"],),
+            )
+            for row in rows:
+                per_run.setdefault(row["name"], []).append(row["seconds"])
+                per_call.setdefault(row["name"], []).append(
+                    row["seconds"] / row["calls"]
+                )
+    finally:
+        conn.close()
+    return dict(
+        (name, (_median(per_run[name]), _median(per_call[name]))) for name in per_run
+    )
+
+
+def report(deployment, environment, run_id=None, compare=5, width=60, path=None):
+    """
+    Prints a Gantt-style timeline and the critical path of the given run (or
+    the latest run in the given environment) and compares the time spent in
+    each step with the last ``compare`` successful runs of the same command.
+    """
+    conn = connect(path)
+    try:
+        if run_id:
+            run = conn.execute("SELECT * FROM runs WHERE id = ?", (run_id,)).fetchone()
+        else:
+            run = conn.execute(
+                "SELECT * FROM runs WHERE deployment = ? AND environment = ? "
+                "ORDER BY start_time DESC LIMIT 1",
+                (deployment, environment),
+            ).fetchone()
+        if run is None:
+            print("No recorded runs found.")
+            return
+        spans = conn.execute(
+            "SELECT * FROM spans WHERE run_id = ? ORDER BY start_time, id", (run["id"],)
+        ).fetchall()
+        end = run["end_time"] or max(
+            [s["end_time"] or s["start_time"] for s in spans] or [0]
+        )
+        total = max(end - run["start_time"], 1)
+        started = datetime.datetime.fromtimestamp(run["start_time"])
+        print(
+            "Run {0}: {1} of {2} to {3}/{4} on {5:%Y-%m-%d %H:%M}, {6} in {7:.0f} "
+            "seconds".format(
+                run["id"],
+                run["command"],
+                run["changeset"] or "unknown changeset",
+                run["deployment"],
+                run["environment"],
+                started,
+                run["status"] or "unfinished",
+                total,
+            )
+        )
+        print("")
+        by_id = dict((s["id"], s) for s in spans)
+        for s in spans:
+            offset = int((s["start_time"] - run["start_time"]) / total * width)
+            length = max(
+                int(((s["end_time"] or end) - s["start_time"]) / total * width), 1
+            )
+            label = "  " * _depth(s, by_id) + _label(s)
+            print(
+                "{0:<45.45} {1:>6.0f}s |{2}{3}{4}|".format(
+                    label,
+                    (s["end_time"] or end) - s["start_time"],
+                    " " * offset,
+                    ("#" if s["status"] != "failed" else "X") * length,
+                    " " * max(width - offset - length, 0),
+                )
+            )
+        print("")
+        print("Critical path:")
+        for s in critical_path(spans):
+            print(
+                "  {0:<45.45} {1:>6.0f}s".format(
+                    _label(s), s["end_time"] - s["start_time"]
+                )
+            )
+        previous = conn.execute(
+            "SELECT id FROM runs WHERE command = ? AND deployment = ? AND "
+            "environment = ? AND status = 'ok' AND id < ? ORDER BY start_time DESC "
+            "LIMIT ?",
+            (
+                run["command"],
+                run["deployment"],
+                run["environment"],
+                run["id"],
+                int(compare),
+            ),
+        ).fetchall()
+        if not previous:
+            return
+        print("")
+        print(
+            "Compared with the median of the last {0} successful runs:".format(
+                len(previous)
+            )
+        )
+        current = _totals(conn, run["id"])
+        history = [_totals(conn, row["id"]) for row in previous]
+        for name, seconds in sorted(current.items(), key=lambda item: -item[1]):
+            past = [totals[name] for totals in history if name in totals]
+            if not past:
+                print("  {0:<45.45} {1:>6.0f}s (new)".format(name, seconds))
+                continue
+            median = _median(past)
+            flag = ""
+            if seconds > median * 1.25 and seconds - median > 30:
+                flag = "  <-- slower"
+            print(
+                "  {0:<45.45} {1:>6.0f}s vs {2:>6.0f}s{3}".format(
+                    name, seconds, median, flag
+                )
+            )
+    finally:
+        conn.close()
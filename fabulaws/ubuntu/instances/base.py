@@ -6,7 +6,7 @@ from decimal import Decimal
 from getpass import getpass
 
 import boto.exception
-from fabric.api import hide, put, run, sudo
+from fabric.api import hide, put, run, settings, sudo
 from fabric.contrib import files
 
 from fabulaws.api import answer_sudo, call_python
@@ -31,6 +31,12 @@ class UbuntuInstance(BaseAptMixin, EC2Instance):
     fs_encrypt = False
     ebs_encrypt = False
     ubuntu_mirror = None
+    # an APT caching proxy (e.g., http://10.0.0.5:3142) for all package
+    # downloads, and an HTTP artifact cache (see ``artifact_url()``) with the
+    # hosts it serves
+    apt_proxy = None
+    artifact_cache = None
+    artifact_cache_hosts = []
     mount_script = "/mount-deferred.sh"
 
     def __init__(self, *args, **kwargs):
@@ -141,17 +147,26 @@ class UbuntuInstance(BaseAptMixin, EC2Instance):
         else:
             files.append("/etc/fstab", fstab_entry, use_sudo=True)
 
+    @uses_fabric
+    def _is_mounted(self, path):
+        """Returns whether a file system is mounted at the given path."""
+        with settings(hide("everything"), warn_only=True):
+            return run("mountpoint -q {0}".format(path)).succeeded
+
     @uses_fabric
     def _format_volume(self, device, mount_point, passwd=None):
         """
         Creates an EBS volume of size ``vol_size``, manifests the device at
         ``device`` in this instance, and mounts it at ``mount_point``.
         """
+        if self._is_mounted(mount_point):
+            logger.info("{0} is already mounted".format(mount_point))
+            return
         logger.info("Formatting {0}".format(device))
         if self.fs_encrypt:
             device = self._encrypt_device(device, passwd)
         sudo("mkfs.{0} {1}".format(self.fs_type, device))
-        sudo("mkdir {0}".format(mount_point))
+        sudo("mkdir -p {0}".format(mount_point))
         self._mount_and_persist(device, mount_point)
 
     def _set_volume_tags(self, vol, device, tags=None):
@@ -236,6 +251,26 @@ class UbuntuInstance(BaseAptMixin, EC2Instance):
             self._server_memory = int(mem.split()[1]) / 1024
         return self._server_memory
 
+    @uses_fabric
+    def instance_store_devices(self):
+        """
+        Returns the paths of this instance's instance store volumes: those
+        mapped to Xen device names when it was created (see
+        ``EC2Instance.instance_storage_devices``), and any NVMe instance store
+        volumes. NVMe devices are numbered in the order the kernel finds them,
+        along with the EBS volumes, and the numbering can change after a
+        reboot, so they're returned by their serial number under
+        ``/dev/disk/by-id`` instead.
+        """
+        devices = [dev for dev in self.instance_storage_devices() if files.exists(dev)]
+        with hide("stdout"):
+            disks = run("lsblk -d -n -o SERIAL,MODEL")
+        for line in disks.splitlines():
+            if "Instance Storage" in line:
+                dev = "/dev/disk/by-id/nvme-Amazon_EC2_NVMe_Instance_Storage_{0}"
+                devices.append(dev.format(line.split()[0]))
+        return devices
+
     @property
     @uses_fabric
     def ubuntu_release(self):
@@ -250,7 +285,73 @@ class UbuntuInstance(BaseAptMixin, EC2Instance):
         if mirror:
             orig = "{region}.ec2.archive.ubuntu.com".format(region=self.region)
             mirror = mirror.format(region=self.region)
-            files.sed("/etc/apt/sources.list", orig, mirror, use_sudo=True)
+            # only touch sources.list when needed, so the package index is
+            # not considered stale (see update_apt_sources())
+            if files.contains("/etc/apt/sources.list", orig, use_sudo=True):
+                files.sed("/etc/apt/sources.list", orig, mirror, use_sudo=True)
+
+    @uses_fabric
+    def setup_apt_proxy(self, proxy=None):
+        """
+        Downloads packages through the given APT caching proxy (by default,
+        ``apt_proxy``).  HTTPS repositories are tunnelled through it, but not
+        cached.
+        """
+        if not proxy:
+            proxy = self.apt_proxy
+        if proxy:
+            files.append(
+                "/etc/apt/apt.conf.d/01proxy",
+                'Acquire::http::Proxy "{0}";'.format(proxy),
+                use_sudo=True,
+            )
+
+    def artifact_url(self, url):
+        """
+        Returns the URL to download the given HTTPS ``url`` from, through the
+        ``artifact_cache`` if one is set and serves the URL's host.
+        """
+        if not self.artifact_cache or not url.startswith("https://"):
+            return url
+        path = url[len("https://") :]
+        if path.split("/")[0] not in (self.artifact_cache_hosts or []):
+            return url
+        return "/".join([self.artifact_cache.rstrip("/"), path])
+
+    def cloud_config(self):
+        """
+        Configures the mirror and updates apt sources during boot, and
+        installs the packages needed to create volumes.
+        """
+        config = super(UbuntuInstance, self).cloud_config()
+        config["package_update"] = True
+        packages = config.setdefault("packages", [])
+        packages.append("nvme-cli")
+        if self.fs_encrypt:
+            packages.extend(["python3-pexpect", "cryptsetup"])
+        if self.apt_proxy:
+            config.setdefault("apt", {})["http_proxy"] = self.apt_proxy
+        if self.ubuntu_mirror:
+            mirror = self.ubuntu_mirror.format(region=self.region)
+            config.setdefault("apt", {})["primary"] = [
+                {"arches": ["default"], "uri": "http://{0}/ubuntu/".format(mirror)}
+            ]
+        return config
+
+    @uses_fabric
+    def wait_for_cloud_init(self):
+        """
+        Waits for cloud-init to finish setting up the instance, and raises an
+        exception with the tail of its output log if it failed.
+        """
+        logger.info("Waiting for cloud-init to finish")
+        with settings(warn_only=True):
+            result = sudo("cloud-init status --wait")
+        if result.failed or "error" in result:
+            sudo("tail -n 50 /var/log/cloud-init-output.log")
+            raise Exception(
+                "cloud-init failed on {0}: {1}".format(self.instance.id, result)
+            )
 
     def setup(self):
         """
@@ -259,13 +360,19 @@ class UbuntuInstance(BaseAptMixin, EC2Instance):
         the ``volume_info`` list on this instance.
         """
         super(UbuntuInstance, self).setup()
-        # this is required because we may need to install cryptsetup when
-        # creating volumes
-        self.setup_mirror()
-        self.update_apt_sources()
-        # the first apt-get update may update sources.list, so re-run it here
-        self.setup_mirror()
-        self.update_apt_sources()
+        if self.cloud_init:
+            # the mirror and apt sources were set up while booting
+            self.wait_for_cloud_init()
+        else:
+            # this is required because we may need to install cryptsetup when
+            # creating volumes
+            self.setup_apt_proxy()
+            self.setup_mirror()
+            self.setup_step(self.update_apt_sources)
+            # the first apt-get update may update sources.list, so re-run it
+            # here (it's skipped if sources.list didn't change)
+            self.setup_mirror()
+            self.setup_step(self.update_apt_sources)
         for vol in self.volume_info:
             if len(vol) == 5:
                 device, mount_point, vol_size, vol_type, passwd = vol
@@ -279,11 +386,19 @@ class UbuntuInstance(BaseAptMixin, EC2Instance):
                     device = run("mount|grep /mnt|cut -d' ' -f1").strip()
                     sudo("umount {0}".format(device))
             else:
+                # a failed attempt destroys the volume it created
                 self.volumes.append(
-                    self._create_volume(device, mount_point, vol_size, vol_type, passwd)
+                    self.setup_step(
+                        self._create_volume,
+                        device,
+                        mount_point,
+                        vol_size,
+                        vol_type,
+                        passwd,
+                    )
                 )
-            device = self._wait_for_device(device)
-            self._format_volume(device, mount_point, passwd)
+            device = self.setup_step(self._wait_for_device, device)
+            self.setup_step(self._format_volume, device, mount_point, passwd)
 
     @uses_fabric
     def create_users(self, users, ignore_existing=True):
@@ -334,6 +449,9 @@ class UbuntuInstance(BaseAptMixin, EC2Instance):
         """
         assert files.exists(app_root)
         for app_dir in app_dirs:
+            if self._is_mounted(app_dir):
+                logger.info("{0} is already bound".format(app_dir))
+                continue
             bound_app_dir = "".join([app_root, app_dir])
             bound_parent_dir = call_python("os.path.dirname", bound_app_dir)
             if files.exists(app_dir):
@@ -1,13 +1,57 @@
 import logging
 from decimal import Decimal
 
-from fabric.api import settings, sudo
+from fabric.api import hide, settings, sudo
 from fabric.contrib import files
 
 from fabulaws.decorators import uses_fabric
 
 logger = logging.getLogger(__name__)
 
+# touched on each host after a successful ``apt-get update``
+APT_UPDATE_STAMP = "/var/lib/apt/fabulaws-update-stamp"
+# the package index is updated again once it's older than this (in minutes),
+# even if no sources were changed
+APT_INDEX_MAX_AGE = 60
+APT_SOURCES = [
+    "/etc/apt/sources.list",
+    "/etc/apt/sources.list.d",
+    "/etc/apt/trusted.gpg",
+    "/etc/apt/trusted.gpg.d",
+]
+
+
+def apt_index_is_fresh():
+    """
+    Returns whether the package index on the current host was updated in the
+    last ``APT_INDEX_MAX_AGE`` minutes, and no APT sources or keys have
+    changed since.
+    """
+    test = (
+        'test -n "$(find {stamp} -mmin -{age} 2>/dev/null)" && '
+        'test -z "$(find {sources} -newer {stamp} 2>/dev/null)"'
+    ).format(
+        stamp=APT_UPDATE_STAMP, age=APT_INDEX_MAX_AGE, sources=" ".join(APT_SOURCES)
+    )
+    with settings(hide("everything"), warn_only=True):
+        return sudo(test).succeeded
+
+
+def apt_update(force=False):
+    """
+    Updates the package index on the current host, unless it's still fresh
+    (see ``apt_index_is_fresh()``) and ``force`` is False.
+    """
+    if not force and apt_index_is_fresh():
+        logger.info("Package index is up to date; skipping apt-get update.")
+        return
+    with settings(warn_only=True):
+        sudo(
+            "export DEBIAN_FRONTEND=noninteractive ; "
+            "(apt-get -qq update || apt-get -qq update) && touch {0}"
+            "".format(APT_UPDATE_STAMP)
+        )
+
 
 class BaseAptMixin(object):
     """
@@ -35,13 +79,10 @@ class BaseAptMixin(object):
         self.install_packages(self._read_lines_from_file(file_name))
 
     @uses_fabric
-    def update_apt_sources(self):
-        """Update apt source."""
+    def update_apt_sources(self, force=False):
+        """Update apt source, unless the package index is still fresh."""
         logger.info("Update apt source.")
-        with settings(warn_only=True):
-            sudo(
-                "export DEBIAN_FRONTEND=noninteractive ; apt-get -qq update || apt-get -qq update"
-            )
+        apt_update(force=force)
 
     @uses_fabric
     def upgrade_packages(self):
@@ -58,24 +99,31 @@ class BaseAptMixin(object):
         )
 
     @uses_fabric
-    def add_ppa(self, name):
-        """Add personal package archive."""
+    def add_ppa(self, name, update=True):
+        """
+        Add personal package archive.  Pass ``update=False`` to add several
+        sources before updating the package index once.
+        """
 
         if self.ubuntu_release >= Decimal("12.04"):
             sudo("apt-add-repository -y %s" % name)
         else:
             sudo("apt-add-repository %s" % name)
-        self.update_apt_sources()
+        if update:
+            self.update_apt_sources()
 
     @uses_fabric
-    def add_aptrepo(self, url, dist, repo_name, key_name=None, key_server=None):
+    def add_aptrepo(
+        self, url, dist, repo_name, key_name=None, key_server=None, update=True
+    ):
         repo = " ".join(["deb", url, dist, repo_name])
         files.append("/etc/apt/sources.list", repo, use_sudo=True)
         if key_server is None:
             key_server = "keyserver.ubuntu.com"
         if key_name:
             sudo("apt-key adv --keyserver {0} --recv {1}".format(key_server, key_name))
-        self.update_apt_sources()
+        if update:
+            self.update_apt_sources()
 
     @uses_fabric
     def add_ppas_from_file(self, file_name):
@@ -103,14 +151,58 @@ class AptMixinMetaclass(type):
 
 
 class AptMixin(BaseAptMixin, metaclass=AptMixinMetaclass):
-    def setup(self, propagate=True):
-        super(AptMixin, self).setup()
-        for attr_prefix in self._package_names:
+    def cloud_config(self):
+        """
+        Adds the declared PPAs, APT repositories and packages to the
+        cloud-init configuration, so they're installed while booting.
+        """
+        config = super(AptMixin, self).cloud_config()
+        sources = config.setdefault("apt", {}).setdefault("sources", {})
+        ppas, aptrepos, packages = self.apt_transaction()
+        for i, ppa in enumerate(ppas):
+            sources["fabulaws-ppa-%s.list" % i] = {"source": ppa}
+        for i, aptrepo in enumerate(aptrepos):
+            # (url, dist, repo_name[, key_name[, key_server]]), as for add_aptrepo()
+            key_name, key_server = (list(aptrepo[3:]) + [None, None])[:2]
+            source = {"source": " ".join(["deb"] + list(aptrepo[:3]))}
+            if key_name:
+                source["keyid"] = key_name
+                source["keyserver"] = key_server or "keyserver.ubuntu.com"
+            sources["fabulaws-repo-%s.list" % i] = source
+        config_packages = config.setdefault("packages", [])
+        config_packages.extend(p for p in packages if p not in config_packages)
+        return config
+
+    def apt_transaction(self):
+        """
+        Returns a tuple of (ppas, aptrepos, packages) declared by all the
+        mixins of this instance, so they can be set up with a single index
+        update and a single install.
+        """
+        ppas, aptrepos, packages = [], [], []
+        for attr_prefix in sorted(self._package_names):
             ppa = getattr(self, "%s_ppa" % attr_prefix, None)
             aptrepo = getattr(self, "%s_aptrepo" % attr_prefix, None)
-            packages = getattr(self, "%s_packages" % attr_prefix, [])
-            if ppa:
-                self.add_ppa(ppa)
-            if aptrepo:
-                self.add_aptrepo(*aptrepo)
-            self.install_packages(packages)
+            if ppa and ppa not in ppas:
+                ppas.append(ppa)
+            if aptrepo and aptrepo not in aptrepos:
+                aptrepos.append(aptrepo)
+            for package in getattr(self, "%s_packages" % attr_prefix, []):
+                if package not in packages:
+                    packages.append(package)
+        return ppas, aptrepos, packages
+
+    def setup(self, propagate=True):
+        super(AptMixin, self).setup()
+        if self.cloud_init:
+            # the packages were installed by cloud-init (see cloud_config())
+            return
+        ppas, aptrepos, packages = self.apt_transaction()
+        for ppa in ppas:
+            self.setup_step(self.add_ppa, ppa, update=False)
+        for aptrepo in aptrepos:
+            self.setup_step(self.add_aptrepo, *aptrepo, update=False)
+        # skipped if no sources were added since the last update
+        self.setup_step(self.update_apt_sources)
+        if packages:
+            self.setup_step(self.install_packages, packages)
@@ -60,4 +60,4 @@ class MemcachedMixin(AptMixin):
         """memcached mixin"""
 
         super(MemcachedMixin, self).setup()
-        self.memcached_configure()
+        self.setup_step(self.memcached_configure)
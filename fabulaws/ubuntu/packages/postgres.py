@@ -295,6 +295,12 @@ class PostgresMixin(AptMixin):
             user="postgres",
         )
 
+    @uses_fabric
+    def pg_in_recovery(self):
+        """Returns whether this server is still a replica (i.e., in recovery)."""
+        result = sudo('psql -tA -c "SELECT pg_is_in_recovery();"', user="postgres")
+        return result.strip() == "t"
+
     def bind_app_directories(self, *args, **kwargs):
         # make sure we stop first in case we're being moved to a secure directory
         self.pg_cmd("stop", fail=False)
@@ -21,7 +21,8 @@ class PythonMixin(AptMixin):
         Installs the required Python tools from PyPI.
         """
 
-        sudo("curl https://bootstrap.pypa.io/get-pip.py --output /tmp/get-pip.py")
+        get_pip_url = self.artifact_url("https://bootstrap.pypa.io/get-pip.py")
+        sudo("curl %s --output /tmp/get-pip.py" % get_pip_url)
         sudo("python3 /tmp/get-pip.py")
         version = ""
         if self.python_virtualenv_version:
@@ -35,4 +36,4 @@ class PythonMixin(AptMixin):
         """
         super(PythonMixin, self).setup()
         if self.python_install_tools:
-            self.install_python_tools()
+            self.setup_step(self.install_python_tools)
@@ -78,7 +78,7 @@ class RabbitMqMixin(AptMixin):
         """Redis mixin"""
 
         super(RabbitMqMixin, self).setup()
-        self.rabbitmq_configure()
+        self.setup_step(self.rabbitmq_configure)
 
 
 class RabbitMqOfficialMixin(RabbitMqMixin):
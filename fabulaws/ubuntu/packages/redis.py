@@ -61,4 +61,4 @@ class RedisMixin(AptMixin):
         """Redis mixin"""
 
         super(RedisMixin, self).setup()
-        self.redis_configure()
+        self.setup_step(self.redis_configure)